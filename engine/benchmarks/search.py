@@ -0,0 +1,365 @@
+"""
+Benchmarks SearchEngine against a synthetic drive.
+
+Prints one JSON document, so results of different commits can be compared
+by a script.
+
+    python3 -m benchmarks.search --nodes 2000000 --output result.json
+"""
+
+import asyncio
+import json
+import random
+import re
+import resource
+import sys
+import time
+from argparse import ArgumentParser
+from collections.abc import AsyncIterator, Awaitable, Callable
+from dataclasses import asdict, dataclass, replace
+from datetime import datetime, timezone
+from pathlib import Path, PurePath
+from string import ascii_lowercase
+from typing import Any, cast
+
+from wcpan.drive.core.exceptions import NodeNotFoundError
+from wcpan.drive.core.types import Drive, Node
+
+from engine.search import SearchEngine
+
+
+@dataclass(frozen=True, kw_only=True)
+class Config:
+    nodes: int
+    depth: int
+    folder_ratio: float
+    vocabulary: int
+    skew: float
+    words: int
+    queries: int
+    rounds: int
+    batches: int
+    batch_size: int
+    cache_size: int
+    index: bool
+    seed: int
+
+
+class SyntheticDrive:
+    """
+    Just enough of Drive for SearchEngine, backed by plain dicts.
+
+    Folders are spread evenly over the levels, every folder picks a parent
+    from the level above, files pick any folder.
+    """
+
+    def __init__(self, config: Config, rng: random.Random) -> None:
+        now = datetime.now(timezone.utc)
+        self._template = Node(
+            id="",
+            parent_id=None,
+            name="",
+            is_directory=True,
+            is_trashed=False,
+            created_time=now,
+            modified_time=now,
+            changed_time=now,
+            mime_type="",
+            hash="",
+            size=0,
+            is_image=False,
+            is_video=False,
+            width=0,
+            height=0,
+            ms_duration=0,
+            private=None,
+        )
+        self.root = replace(self._template, id="root")
+        self.names = NameGenerator(config, rng)
+        self._nodes: dict[str, Node] = {"root": self.root}
+        self._children: dict[str, dict[str, Node]] = {}
+        self.levels: list[list[str]] = [["root"]]
+
+        folder_count = max(config.depth, int(config.nodes * config.folder_ratio))
+        per_level = folder_count // config.depth
+        for level in range(1, config.depth + 1):
+            parents = self.levels[level - 1]
+            ids: list[str] = []
+            for _ in range(per_level):
+                node = self._add(rng.choice(parents), self.names.folder(), None)
+                ids.append(node.id)
+            self.levels.append(ids)
+
+        folders = [_ for level in self.levels[1:] for _ in level]
+        for _ in range(config.nodes - len(self._nodes) + 1):
+            size = int(rng.lognormvariate(13, 2))
+            self._add(rng.choice(folders), self.names.file(), size)
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def get_top_level_paths(self) -> list[str]:
+        return [f"/{self._nodes[_].name}" for _ in self.levels[1]]
+
+    def pick_file(self, rng: random.Random) -> Node:
+        while True:
+            node = self._nodes[str(rng.randrange(1, len(self._nodes)))]
+            if not node.is_directory:
+                return node
+
+    async def get_root(self) -> Node:
+        return self.root
+
+    async def get_node_by_id(self, id_: str) -> Node:
+        node = self._nodes.get(id_, None)
+        if node is None:
+            raise NodeNotFoundError(id_)
+        return node
+
+    async def get_node_by_path(self, path: PurePath) -> Node:
+        node = self.root
+        for part in path.parts[1:]:
+            child = self._children.get(node.id, {}).get(part, None)
+            if child is None:
+                raise NodeNotFoundError(str(path))
+            node = child
+        return node
+
+    async def resolve_path(self, node: Node) -> PurePath:
+        parts: list[str] = []
+        while node.parent_id is not None:
+            parts.append(node.name)
+            node = self._nodes[node.parent_id]
+        return PurePath("/", *reversed(parts))
+
+    async def find_nodes_by_regex(self, pattern: str) -> list[Node]:
+        regex = re.compile(pattern, re.I)
+        return [_ for _ in self._nodes.values() if regex.search(_.name)]
+
+    async def walk(
+        self, node: Node, *, include_trashed: bool = False
+    ) -> AsyncIterator[tuple[Node, list[Node], list[Node]]]:
+        queue = [node]
+        while queue:
+            node = queue.pop()
+            children = self._children.get(node.id, {}).values()
+            folders = [_ for _ in children if _.is_directory]
+            files = [_ for _ in children if not _.is_directory]
+            yield node, folders, files
+            queue.extend(folders)
+
+    def _add(self, parent_id: str, name: str, size: int | None) -> Node:
+        id_ = str(len(self._nodes))
+        siblings = self._children.setdefault(parent_id, {})
+        if name in siblings:
+            # Paths have to be unique.
+            name = f"{name} ({id_})"
+        node = replace(
+            self._template,
+            id=id_,
+            parent_id=parent_id,
+            name=name,
+            is_directory=size is None,
+            mime_type="" if size is None else "image/jpeg",
+            size=size or 0,
+        )
+        siblings[name] = node
+        self._nodes[id_] = node
+        return node
+
+
+class NameGenerator:
+    """Draws names from a random vocabulary with Zipf distributed words."""
+
+    def __init__(self, config: Config, rng: random.Random) -> None:
+        self._rng = rng
+        self._max_words = config.words
+        self.vocabulary = [
+            "".join(rng.choices(ascii_lowercase, k=rng.randint(3, 9)))
+            for _ in range(config.vocabulary)
+        ]
+        weights = [1 / (_ + 1) ** config.skew for _ in range(config.vocabulary)]
+        self._cum_weights: list[float] = []
+        total = 0.0
+        for weight in weights:
+            total += weight
+            self._cum_weights.append(total)
+
+    def words(self, k: int) -> list[str]:
+        return self._rng.choices(self.vocabulary, cum_weights=self._cum_weights, k=k)
+
+    def folder(self) -> str:
+        return " ".join(self.words(self._rng.randint(1, self._max_words)))
+
+    def file(self) -> str:
+        words = self.words(self._rng.randint(1, self._max_words))
+        return f"[{words[0]}] {' '.join(words[1:])}.jpg"
+
+
+def make_queries(
+    drive: SyntheticDrive, config: Config, rng: random.Random
+) -> list[dict[str, Any]]:
+    vocabulary = drive.names.vocabulary
+    frequent = vocabulary[: max(2, len(vocabulary) // 100)]
+    top_level = drive.get_top_level_paths()
+    kinds: list[Callable[[], dict[str, Any]]] = [
+        lambda: {"name": rng.choice(frequent)},
+        lambda: {"name": rng.choice(vocabulary)},
+        lambda: {"name": " ".join(rng.sample(frequent, 2)), "fuzzy": True},
+        lambda: {
+            "name": rng.choice(frequent),
+            "parent_path": rng.choice(top_level),
+        },
+        lambda: {"name": rng.choice(frequent), "size": 1024 * 1024},
+    ]
+    if config.index:
+        # Searches without a name are only served from the node index.
+        kinds.append(lambda: {"size": 1024 * 1024 * 1024})
+    return [kinds[_ % len(kinds)]() for _ in range(config.queries)]
+
+
+async def run(config: Config) -> dict[str, Any]:
+    rng = random.Random(config.seed)
+    result: dict[str, Any] = {"config": asdict(config)}
+
+    elapsed, drive = await _measure(_async(lambda: SyntheticDrive(config, rng)))
+    result["drive"] = {"nodes": len(drive), "seconds": elapsed}
+    result["memory"] = {"drive_rss": _get_rss()}
+
+    engine = SearchEngine(cast(Drive, drive), cache_size=config.cache_size)
+    if config.index:
+        elapsed, _ = await _measure(engine.build_index())
+        result["index"] = {"seconds": elapsed}
+        result["memory"]["index_rss"] = _get_rss()
+
+    queries = make_queries(drive, config, rng)
+    cold: list[float] = []
+    warm: list[float] = []
+    for _ in range(config.rounds):
+        await engine.clear_cache()
+        for query in queries:
+            elapsed, _ = await _measure(engine(**query))
+            cold.append(elapsed)
+        for query in queries:
+            elapsed, _ = await _measure(engine(**query))
+            warm.append(elapsed)
+    result["search"] = {"cold": _summarize(cold), "warm": _summarize(warm)}
+    result["memory"]["cache_rss"] = _get_rss()
+    result["memory"]["cache"] = engine.get_cache_stats()
+
+    batches: list[float] = []
+    for _ in range(config.batches):
+        for query in queries:
+            await engine(**query)
+        nodes = [
+            replace(drive.pick_file(rng), name=drive.names.file())
+            for _ in range(config.batch_size)
+        ]
+        started = time.perf_counter()
+        engine.invalidate_cache_by_nodes(nodes)
+        batches.append(time.perf_counter() - started)
+    result["invalidate"] = {
+        "batch_size": config.batch_size,
+        "batch": _summarize(batches),
+    }
+
+    result["memory"]["peak_rss"] = _get_peak_rss()
+    return result
+
+
+async def _measure[T](aw: Awaitable[T]) -> tuple[float, T]:
+    started = time.perf_counter()
+    rv = await aw
+    return time.perf_counter() - started, rv
+
+
+async def _async[T](fn: Callable[[], T]) -> T:
+    return fn()
+
+
+def _summarize(samples: list[float]) -> dict[str, float | int]:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "p50": _percentile(ordered, 50),
+        "p99": _percentile(ordered, 99),
+        "max": ordered[-1],
+    }
+
+
+def _percentile(ordered: list[float], p: int) -> float:
+    # Nearest rank.
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[rank - 1]
+
+
+def _get_rss() -> int | None:
+    """Current resident set size in bytes, Linux only."""
+    try:
+        with open("/proc/self/statm", "r") as fin:
+            pages = int(fin.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * resource.getpagesize()
+
+
+def _get_peak_rss() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def parse_args(args: list[str]) -> tuple[Config, str | None]:
+    parser = ArgumentParser("benchmarks.search")
+    parser.add_argument("--nodes", type=int, default=1_000_000)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument(
+        "--folder-ratio",
+        type=float,
+        default=0.05,
+        help="fraction of nodes being folders",
+    )
+    parser.add_argument(
+        "--vocabulary", type=int, default=50_000, help="distinct words in names"
+    )
+    parser.add_argument(
+        "--skew", type=float, default=1.1, help="Zipf exponent of word frequency"
+    )
+    parser.add_argument("--words", type=int, default=5, help="max words per name")
+    parser.add_argument("--queries", type=int, default=60)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument(
+        "--cache-size", type=int, default=256, help="search cache budget in MiB"
+    )
+    parser.add_argument(
+        "--no-index",
+        dest="index",
+        action="store_false",
+        help="search through the drive instead of the node index",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", type=str, help="defaults to stdout")
+
+    kwargs = vars(parser.parse_args(args))
+    output = kwargs.pop("output")
+    kwargs["cache_size"] *= 1024 * 1024
+    return Config(**kwargs), output
+
+
+async def amain(args: list[str]) -> int:
+    config, output = parse_args(args)
+    result = await run(config)
+    text = json.dumps(result, indent=2)
+    if output:
+        Path(output).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(amain(sys.argv[1:])))
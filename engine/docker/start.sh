@@ -10,6 +10,18 @@ if [ -n "$DVD_ENGINE_TOKEN" ] ; then
     CMD="$CMD -t $DVD_ENGINE_TOKEN"
 fi
 
+if [ -n "$DVD_ENGINE_SEARCH_SNAPSHOT" ] ; then
+    CMD="$CMD --search-snapshot $DVD_ENGINE_SEARCH_SNAPSHOT"
+fi
+
+if [ -n "$DVD_ENGINE_STORAGE" ] ; then
+    CMD="$CMD --storage $DVD_ENGINE_STORAGE"
+fi
+
+if [ -n "$DVD_ENGINE_STORAGE_BUDGET" ] ; then
+    CMD="$CMD --storage-budget $DVD_ENGINE_STORAGE_BUDGET"
+fi
+
 export TMPDIR="$DVD_ENGINE_TMP"
 
 exec $CMD
@@ -2,6 +2,7 @@ import json
 import shlex
 from asyncio import create_subprocess_exec, gather
 from collections.abc import Callable, Iterable
+from contextlib import contextmanager
 from datetime import datetime
 from functools import partial
 from logging import getLogger
@@ -12,17 +13,19 @@ from aiohttp.web import FileResponse, Request, Response, StreamResponse, View
 from aiohttp.web_exceptions import (
     HTTPBadRequest,
     HTTPConflict,
+    HTTPGone,
     HTTPInternalServerError,
     HTTPNoContent,
     HTTPNotFound,
     HTTPNotModified,
+    HTTPServiceUnavailable,
     HTTPUnauthorized,
 )
 from multidict import MultiMapping
-from wcpan.drive.core.lib import dispatch_change
-from wcpan.drive.core.types import ChangeAction, Node
+from wcpan.drive.core.types import Node
 
 from .app import KEY_DRIVE, KEY_SEARCH_ENGINE, KEY_UNPACK_ENGINE
+from .image import get_output_types
 from .lib import NodeDict, dict_from_change, dict_from_node, get_node, json_decoder_hook
 from .mixins import HasTokenMixin, NodeObjectMixin, NodeRandomAccessMixin
 from .rest import (
@@ -34,15 +37,27 @@ from .rest import (
     json_response,
 )
 from .search import (
+    CursorExpiredError,
+    IndexNotReadyError,
     InvalidPatternError,
-    SearchEngine,
     SearchFailedError,
     SearchNodeDict,
 )
-from .types import ImageDict, ImageListCacheDict, ImageSizeDict, VideoSizeDict
+from .types import (
+    CacheStatsDict,
+    ImageDict,
+    ImageListCacheDict,
+    ImageSizeDict,
+    SearchPageDict,
+    SuggestionDict,
+    UnpackQueueDict,
+    VideoSizeDict,
+)
 from .unpack import UnpackFailedError
 
 
+_DEFAULT_SUGGESTION_LIMIT = 10
+_MAX_SUGGESTION_LIMIT = 100
 _L = getLogger(__name__)
 
 
@@ -97,29 +112,51 @@ class NodeView(
 class NodeListView(
     HasTokenMixin, ListAPIMixin[SearchNodeDict], CreateAPIMixin[NodeDict], View
 ):
+    async def get(self) -> Response:
+        # Paginated results are not a plain list, handle them separately.
+        if "limit" not in self.request.query:
+            return await super().get()
+
+        if not await self.has_permission():
+            await self.raise_permission_error()
+        rv = await self.list_page()
+        return json_response(rv, status=200)
+
     async def list_(self):
-        # node name
-        name = _get_query_value(self.request.query, str, "name")
-        # fuzzy match name
-        fuzzy = _get_query_value(self.request.query, bool, "fuzzy")
-        # node parent path
-        parent_path = _get_query_value(self.request.query, str, "parent_path")
-        # node size
-        size = _get_query_value(self.request.query, int, "size")
+        kwargs = self._get_search_kwargs()
+        se = self.request.app[KEY_SEARCH_ENGINE]
+        with _handle_search_error(kwargs["name"] or kwargs["query"]):
+            return await se(**kwargs)
+
+    async def list_page(self) -> SearchPageDict:
+        kwargs = self._get_search_kwargs()
+        # page size
+        limit = _get_query_value(self.request.query, int, "limit")
+        # opaque cursor from the previous page
+        cursor = _get_query_value(self.request.query, str, "cursor")
+        if limit is None or limit <= 0:
+            raise HTTPBadRequest(text="limit must be > 0")
 
         se = self.request.app[KEY_SEARCH_ENGINE]
-        try:
-            nodes = await se(name=name, fuzzy=fuzzy, parent_path=parent_path, size=size)
-        except InvalidPatternError:
-            _L.exception(f"invalid pattern: {name}")
-            raise HTTPBadRequest()
-        except SearchFailedError:
-            _L.exception(f"search failed")
-            raise HTTPInternalServerError()
-        except Exception:
-            _L.exception(f"unexpected error")
-            raise HTTPInternalServerError()
-        return nodes
+        with _handle_search_error(kwargs["name"] or kwargs["query"]):
+            return await se.get_page(**kwargs, cursor=cursor, limit=limit)
+
+    def _get_search_kwargs(self) -> dict[str, Any]:
+        return {
+            # node name
+            "name": _get_query_value(self.request.query, str, "name"),
+            # fuzzy match name
+            "fuzzy": _get_query_value(self.request.query, bool, "fuzzy"),
+            # node parent path
+            "parent_path": _get_query_value(self.request.query, str, "parent_path"),
+            # node size
+            "size": _get_query_value(self.request.query, int, "size"),
+            # boolean query, see engine.query
+            "query": _get_query_value(self.request.query, str, "query"),
+            # only the best matches, ordered by relevance, or the largest
+            # ones without a name
+            "top": _get_query_value(self.request.query, int, "top"),
+        }
 
     async def create(self):
         kwargs = await self.request.json()
@@ -211,8 +248,16 @@ class NodeDownloadView(NodeObjectMixin, NodeRandomAccessMixin, View):
 class NodeImageListView(
     NodeObjectMixin, HasTokenMixin, ListAPIMixin[ImageSizeDict], View
 ):
+    async def get(self) -> Response:
+        self._complete = True
+        response = await super().get()
+        response.headers["X-Manifest-Complete"] = "true" if self._complete else "false"
+        return response
+
     async def list_(self) -> list[ImageSizeDict]:
         node = await self.get_object()
+        # Returns what is extracted so far instead of waiting for all.
+        progressive = _get_query_value(self.request.query, bool, "progressive")
 
         # Parse and validate max_size parameter
         max_size = _get_query_value(self.request.query, int, "max_size")
@@ -223,7 +268,10 @@ class NodeImageListView(
 
         ue = self.request.app[KEY_UNPACK_ENGINE]
         try:
-            manifest = await ue.get_manifest(node, max_size)
+            if progressive:
+                manifest, self._complete = await ue.get_partial_manifest(node, max_size)
+            else:
+                manifest = await ue.get_manifest(node, max_size)
         except UnpackFailedError as e:
             _L.exception(f"failed to get image list from node {node.id}")
             raise HTTPInternalServerError(
@@ -234,7 +282,18 @@ class NodeImageListView(
                     }
                 )
             )
+        ue.prefetch(node)
 
+        if not self._complete:
+            # Positions change once complete, pages are fetched by path.
+            return [
+                {
+                    "width": _["width"],
+                    "height": _["height"],
+                    "path": ue.get_entry_path(node, _),
+                }
+                for _ in manifest
+            ]
         return [
             {
                 "width": _["width"],
@@ -246,10 +305,11 @@ class NodeImageListView(
 
 class NodeImageView(NodeObjectMixin, View):
     async def get(self):
+        # Either the position in the manifest or the path in the archive.
         image_id = self.request.match_info.get("image_id")
-        if not image_id:
+        path = self.request.match_info.get("path")
+        if not image_id and not path:
             raise HTTPBadRequest()
-        image_id = int(image_id)
 
         # Parse and validate max_size parameter
         max_size = _get_query_value(self.request.query, int, "max_size")
@@ -259,19 +319,30 @@ class NodeImageView(NodeObjectMixin, View):
             raise HTTPBadRequest(text="max_size must be >= 0")
 
         node = await self.get_object()
-        manifest = await self._get_manifest(node)
-        data = self._get_manifest_item(manifest, image_id)
+        if path:
+            data = await self._get_manifest_entry(node, path)
+        else:
+            assert image_id is not None
+            data = await self._get_manifest_item(node, int(image_id))
 
         if node.is_directory:
             return await self._get_directory_image(data)
-        return await self._get_archive_image(node, image_id, data, max_size)
+        return await self._get_archive_image(node, data, max_size)
 
-    async def _get_archive_image(
-        self, node: Node, image_id: int, data: ImageDict, max_size: int
-    ):
+    async def _get_archive_image(self, node: Node, data: ImageDict, max_size: int):
         ue = self.request.app[KEY_UNPACK_ENGINE]
-        path = await ue.get_local_image_path(node, image_id, data, max_size)
-        return FileResponse(path)
+        if max_size == 0:
+            path = await ue.get_local_image_path(node, data, max_size)
+            return FileResponse(path)
+
+        type_ = _negotiate_type(
+            self.request.headers.get("Accept", ""), get_output_types(data["type"])
+        )
+        path = await ue.get_local_image_path(node, data, max_size, type_)
+        response = FileResponse(path)
+        # Resized images depend on what the client accepts.
+        response.headers["Vary"] = "Accept"
+        return response
 
     async def _get_directory_image(self, data: ImageDict) -> StreamResponse:
         response = self._create_not_modified_response(data)
@@ -279,19 +350,26 @@ class NodeImageView(NodeObjectMixin, View):
             return response
         return await self._create_stream_response(data)
 
-    async def _get_manifest(self, node: Node) -> list[ImageDict]:
+    async def _get_manifest_item(self, node: Node, image_id: int) -> ImageDict:
         ue = self.request.app[KEY_UNPACK_ENGINE]
         try:
-            return await ue.get_manifest(node, 0)
+            return await ue.get_manifest_item(node, image_id)
+        except IndexError:
+            raise HTTPNotFound()
         except UnpackFailedError:
             _L.exception(f"failed to get image list from node {node.id}")
             raise HTTPInternalServerError()
 
-    def _get_manifest_item(self, manifest: list[ImageDict], image_id: int) -> ImageDict:
+    async def _get_manifest_entry(self, node: Node, path: str) -> ImageDict:
+        # Does not wait for pages after this one to be extracted.
+        ue = self.request.app[KEY_UNPACK_ENGINE]
         try:
-            return manifest[image_id]
-        except IndexError:
+            return await ue.get_manifest_entry(node, path)
+        except KeyError:
             raise HTTPNotFound()
+        except UnpackFailedError:
+            _L.exception(f"failed to get image list from node {node.id}")
+            raise HTTPInternalServerError()
 
     def _create_not_modified_response(self, data: ImageDict) -> Response | None:
         if _entity_modified(
@@ -379,11 +457,9 @@ class ChangesView(HasTokenMixin, View):
 
         drive = self.request.app[KEY_DRIVE]
         se = self.request.app[KEY_SEARCH_ENGINE]
-        cache_invalidation = (
-            _invalidate_cache_by_change(se, _) async for _ in drive.sync()
-        )
-        changes = [dict_from_change(_) async for _ in cache_invalidation]
-        return json_response(changes)
+        changes = [_ async for _ in drive.sync()]
+        se.apply_changes(changes)
+        return json_response([dict_from_change(_) for _ in changes])
 
 
 class ApplyView(HasTokenMixin, View):
@@ -444,7 +520,11 @@ class CachesImagesView(
         ue.clear_cache()
 
 
-class CachesSearchesView(HasTokenMixin, View):
+class CachesSearchesView(HasTokenMixin, RetriveAPIMixin[CacheStatsDict], View):
+    async def retrive(self) -> CacheStatsDict:
+        se = self.request.app[KEY_SEARCH_ENGINE]
+        return se.get_cache_stats()
+
     async def post(self):
         if not await self.has_permission():
             raise HTTPUnauthorized()
@@ -453,11 +533,16 @@ class CachesSearchesView(HasTokenMixin, View):
         nodes: list[Node] = await self.request.json(loads=parser)
 
         se = self.request.app[KEY_SEARCH_ENGINE]
-        for node in nodes:
-            se.invalidate_cache_by_node(node)
+        se.invalidate_cache_by_nodes(nodes)
         raise HTTPNoContent()
 
 
+class UnpacksView(HasTokenMixin, RetriveAPIMixin[UnpackQueueDict], View):
+    async def retrive(self) -> UnpackQueueDict:
+        ue = self.request.app[KEY_UNPACK_ENGINE]
+        return ue.get_queue_status()
+
+
 class HistoryView(HasTokenMixin, ListAPIMixin[dict[str, Any]], View):
     async def list_(self) -> list[dict[str, Any]]:
         se = self.request.app[KEY_SEARCH_ENGINE]
@@ -465,6 +550,75 @@ class HistoryView(HasTokenMixin, ListAPIMixin[dict[str, Any]], View):
         return history
 
 
+class SuggestView(HasTokenMixin, ListAPIMixin[SuggestionDict], View):
+    async def list_(self) -> list[SuggestionDict]:
+        # partial search text
+        prefix = _get_query_value(self.request.query, str, "q")
+        # max number of suggestions
+        limit = _get_query_value(self.request.query, int, "limit")
+        if limit is None:
+            limit = _DEFAULT_SUGGESTION_LIMIT
+        if not 0 < limit <= _MAX_SUGGESTION_LIMIT:
+            raise HTTPBadRequest(text=f"limit must be in (0, {_MAX_SUGGESTION_LIMIT}]")
+        if not prefix:
+            return []
+
+        se = self.request.app[KEY_SEARCH_ENGINE]
+        return se.suggest(prefix, limit=limit)
+
+
+class DuplicatesView(HasTokenMixin, View):
+    async def get(self):
+        if not await self.has_permission():
+            raise HTTPUnauthorized()
+
+        # ignore smaller files
+        min_size = _get_query_value(self.request.query, int, "min_size") or 0
+        # max number of groups
+        limit = _get_query_value(self.request.query, int, "limit")
+        if limit is not None and limit <= 0:
+            raise HTTPBadRequest(text="limit must be > 0")
+
+        se = self.request.app[KEY_SEARCH_ENGINE]
+        groups = se.iter_duplicates(min_size=min_size)
+        try:
+            first = await anext(groups, None)
+        except IndexNotReadyError:
+            raise HTTPServiceUnavailable(text="node index is not ready")
+
+        # One group per line, so clients can show them as they arrive.
+        response = StreamResponse(status=200)
+        response.content_type = "application/x-ndjson"
+        await response.prepare(self.request)
+        count = 0
+        group = first
+        while group is not None and (limit is None or count < limit):
+            await response.write(json.dumps(group).encode("utf-8") + b"\n")
+            count += 1
+            group = await anext(groups, None)
+        await groups.aclose()
+        await response.write_eof()
+        return response
+
+
+@contextmanager
+def _handle_search_error(name: str | None):
+    try:
+        yield
+    except InvalidPatternError:
+        _L.exception(f"invalid pattern: {name}")
+        raise HTTPBadRequest()
+    except CursorExpiredError:
+        _L.warning("cursor expired")
+        raise HTTPGone()
+    except SearchFailedError:
+        _L.exception(f"search failed")
+        raise HTTPInternalServerError()
+    except Exception:
+        _L.exception(f"unexpected error")
+        raise HTTPInternalServerError()
+
+
 def _unpack_dict(d: dict[str, Any], keys: Iterable[str]) -> dict[str, Any]:
     common_keys = set(keys) & set(d.keys())
     return {key: d[key] for key in common_keys}
@@ -482,15 +636,26 @@ def _get_query_value[T](
     return fn(value)
 
 
-def _invalidate_cache_by_change(
-    engine: SearchEngine, change: ChangeAction
-) -> ChangeAction:
-    dispatch_change(
-        change,
-        on_remove=lambda _: None,
-        on_update=lambda node: engine.invalidate_cache_by_node(node),
-    )
-    return change
+def _negotiate_type(accept: str, types: list[str]) -> str | None:
+    """
+    The first of types the Accept header asks for by name, None for none.
+
+    Wildcards don't count, old clients send them too.
+    """
+    accepted: set[str] = set()
+    for item in accept.split(","):
+        media_type, *params = (_.strip() for _ in item.split(";"))
+        quality = 1.0
+        for param in params:
+            name, _sep, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(media_type.lower())
+    return next((_ for _ in types if _ in accepted), None)
 
 
 def _entity_modified(request: Request, *, etag: str, last_modified: datetime) -> bool:
@@ -0,0 +1,211 @@
+"""
+Random access to ZIP archives on the drive.
+
+Only the central directory and the requested entries are downloaded, through
+ranged reads. Everything here blocks, run it in a thread.
+"""
+
+import errno
+import io
+import struct
+import zlib
+from asyncio import AbstractEventLoop, run_coroutine_threadsafe
+from logging import getLogger
+from pathlib import Path, PurePosixPath
+from tempfile import NamedTemporaryFile
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+from PIL import Image
+from wcpan.drive.core.types import Drive, Node
+
+
+# Bytes per ranged read, also the read-ahead of the central directory.
+_READ_SIZE = 64 * 1024
+# Enough for the header of most images, decoded from the head of an entry.
+_HEAD_SIZE = 64 * 1024
+_LOCAL_HEADER = struct.Struct("<4s22xHH")
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+_ZIP_TYPES = {
+    "application/zip",
+    "application/x-zip-compressed",
+    "application/x-cbz",
+    "application/vnd.comicbook+zip",
+}
+_ZIP_SUFFIXES = {".zip", ".cbz"}
+# What the unpack helper reads besides ZIP files.
+_ARCHIVE_TYPES = {
+    "application/vnd.rar",
+    "application/x-rar",
+    "application/x-rar-compressed",
+    "application/x-cbr",
+    "application/vnd.comicbook-rar",
+    "application/x-7z-compressed",
+    "application/x-cb7",
+    "application/x-tar",
+    "application/x-cbt",
+}
+_ARCHIVE_SUFFIXES = {".rar", ".cbr", ".7z", ".cb7", ".tar", ".cbt"}
+_L = getLogger(__name__)
+
+
+def is_zip(node: Node) -> bool:
+    if node.is_directory:
+        return False
+    if node.mime_type in _ZIP_TYPES:
+        return True
+    return PurePosixPath(node.name).suffix.lower() in _ZIP_SUFFIXES
+
+
+def is_archive(node: Node) -> bool:
+    if is_zip(node):
+        return True
+    if node.is_directory:
+        return False
+    if node.mime_type in _ARCHIVE_TYPES:
+        return True
+    return PurePosixPath(node.name).suffix.lower() in _ARCHIVE_SUFFIXES
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    Seekable file over ranged reads of a drive node.
+
+    Reads are run on loop, the caller has to be another thread.
+    """
+
+    def __init__(self, drive: Drive, node: Node, loop: AbstractEventLoop) -> None:
+        assert node.size is not None
+        self._drive = drive
+        self._node = node
+        self._loop = loop
+        self._size = node.size
+        self._offset = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._offset
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._offset
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise OSError(errno.EINVAL, f"negative offset: {offset}")
+        self._offset = offset
+        return offset
+
+    def readinto(self, buffer: memoryview) -> int:  # type: ignore[override]
+        length = min(len(buffer), self._size - self._offset)
+        if length <= 0:
+            return 0
+        future = run_coroutine_threadsafe(self._read(self._offset, length), self._loop)
+        chunk = future.result()
+        buffer[: len(chunk)] = chunk
+        self._offset += len(chunk)
+        return len(chunk)
+
+    async def _read(self, offset: int, length: int) -> bytes:
+        rv = bytearray()
+        async with self._drive.download_file(self._node) as fin:
+            await fin.seek(offset)
+            while len(rv) < length:
+                chunk = await fin.read(length - len(rv))
+                if not chunk:
+                    break
+                rv.extend(chunk)
+        return bytes(rv)
+
+
+def open_zip(drive: Drive, node: Node, loop: AbstractEventLoop) -> ZipFile:
+    """Reads the central directory, raises BadZipFile for other formats."""
+    fin = io.BufferedReader(RemoteFile(drive, node, loop), _READ_SIZE)
+    try:
+        return ZipFile(fin)
+    except Exception:
+        fin.close()
+        raise
+
+
+def get_entry_path(top: Path, info: ZipInfo) -> Path | None:
+    """Where the entry extracts to, None if it points out of top."""
+    parts = [_ for _ in PurePosixPath(info.filename).parts if _ not in ("", ".")]
+    if not parts or ".." in parts or PurePosixPath(info.filename).is_absolute():
+        return None
+    return top.joinpath(*parts)
+
+
+def probe_zip_entry(
+    drive: Drive, node: Node, loop: AbstractEventLoop, zip_file: ZipFile, info: ZipInfo
+) -> tuple[int, int] | None:
+    """
+    Probe (width, height) of an image entry, None if it fails.
+
+    Decodes the head of the entry through its own reads, so probes can run
+    in parallel. Falls back to the whole entry if the head is not enough.
+    """
+    try:
+        head = _read_entry_head(drive, node, loop, info)
+        if head is not None:
+            try:
+                with Image.open(io.BytesIO(head)) as image:
+                    return image.size
+            except Exception:
+                pass
+        with zip_file.open(info) as fin, Image.open(fin) as image:
+            return image.size
+    except Exception as e:
+        _L.exception(f"failed to probe entry: {e}")
+        return None
+
+
+def extract_zip_entry(zip_file: ZipFile, info: ZipInfo, path: Path) -> None:
+    """Extracts one entry, atomically so readers never see a partial file."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with NamedTemporaryFile(
+        dir=path.parent,
+        prefix=f".{path.name}.",
+        suffix=".tmp",
+        delete=False,
+    ) as fout:
+        tmp_path = Path(fout.name)
+        try:
+            with zip_file.open(info) as fin:
+                while chunk := fin.read(_READ_SIZE):
+                    fout.write(chunk)
+        except Exception:
+            fout.close()
+            tmp_path.unlink(missing_ok=True)
+            raise
+    tmp_path.replace(path)
+
+
+def _read_entry_head(
+    drive: Drive, node: Node, loop: AbstractEventLoop, info: ZipInfo
+) -> bytes | None:
+    if info.flag_bits & 0x1:
+        # Encrypted.
+        return None
+    if info.compress_type not in (ZIP_STORED, ZIP_DEFLATED):
+        return None
+
+    fin = RemoteFile(drive, node, loop)
+    fin.seek(info.header_offset)
+    # Local header, name and extra, then the head of the data in one read.
+    chunk = fin.read(_LOCAL_HEADER.size + len(info.orig_filename) * 4 + _HEAD_SIZE)
+    if chunk is None or len(chunk) < _LOCAL_HEADER.size:
+        return None
+    signature, name_length, extra_length = _LOCAL_HEADER.unpack_from(chunk)
+    if signature != _LOCAL_HEADER_SIGNATURE:
+        return None
+    start = _LOCAL_HEADER.size + name_length + extra_length
+    data = chunk[start : start + info.compress_size]
+
+    if info.compress_type == ZIP_STORED:
+        return data
+    return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data, _HEAD_SIZE)
@@ -11,6 +11,13 @@ class Arguments:
     static: str | None
     token: str | None
     log_path: str | None
+    search_cache_size: int
+    search_snapshot: str | None
+    storage: str | None
+    unpack_concurrency: int
+    prefetch: int
+    prefetch_budget: int
+    storage_budget: int | None
 
 
 def parse_args(args: list[str]) -> Arguments:
@@ -23,6 +30,45 @@ def parse_args(args: list[str]) -> Arguments:
     parser.add_argument("-s", "--static", type=str)
     parser.add_argument("-t", "--token", type=str)
     parser.add_argument("--log-path", type=str)
+    parser.add_argument(
+        "--search-cache-size",
+        type=int,
+        default=256,
+        help="memory budget of the search cache in MiB",
+    )
+    parser.add_argument(
+        "--search-snapshot",
+        type=str,
+        help="file to keep the search cache and history across restarts",
+    )
+    parser.add_argument(
+        "--storage",
+        type=str,
+        help="folder to keep extracted archives across restarts",
+    )
+    parser.add_argument(
+        "--unpack-concurrency",
+        type=int,
+        default=2,
+        help="archives to download and extract at once",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        help="archives after the opened one to unpack ahead, 0 to disable",
+    )
+    parser.add_argument(
+        "--prefetch-budget",
+        type=int,
+        default=4096,
+        help="storage size in MiB above which nothing is prefetched",
+    )
+    parser.add_argument(
+        "--storage-budget",
+        type=int,
+        help="storage size in MiB, least recently read archives are evicted",
+    )
 
     kwargs = parser.parse_args(args)
     return Arguments(**vars(kwargs))
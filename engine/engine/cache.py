@@ -0,0 +1,77 @@
+from collections import OrderedDict
+from collections.abc import Hashable, Iterator
+
+from .types import CacheStatsDict
+
+
+class LruCache[K: Hashable, V]:
+    """
+    LRU cache bounded by the total estimated size of its values in bytes.
+
+    Sizes are given by the caller on insertion. The most recent entry is
+    always kept, even if it alone exceeds the budget.
+    """
+
+    def __init__(self, budget: int) -> None:
+        self._budget = budget
+        self._data: OrderedDict[K, tuple[V, int]] = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._data
+
+    def __iter__(self) -> Iterator[K]:
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def items(self) -> Iterator[tuple[K, V]]:
+        """Iterates from the least recently used entry."""
+        return ((k, v) for k, (v, _size) in self._data.items())
+
+    def get(self, key: K) -> V | None:
+        """Returns the value and marks it as recently used."""
+        item = self._data.get(key, None)
+        if item is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        self._data.move_to_end(key)
+        return item[0]
+
+    def peek(self, key: K) -> V | None:
+        """Returns the value without touching the order or the counters."""
+        item = self._data.get(key, None)
+        return None if item is None else item[0]
+
+    def set(self, key: K, value: V, size: int) -> None:
+        self.discard(key)
+        self._data[key] = (value, size)
+        self._size += size
+        while self._size > self._budget and len(self._data) > 1:
+            _key, (_value, evicted) = self._data.popitem(last=False)
+            self._size -= evicted
+            self._evictions += 1
+
+    def discard(self, key: K) -> None:
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._size -= item[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._size = 0
+
+    def get_stats(self) -> CacheStatsDict:
+        return {
+            "budget": self._budget,
+            "size": self._size,
+            "count": len(self._data),
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+        }
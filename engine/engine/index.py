@@ -0,0 +1,813 @@
+import heapq
+import itertools
+import re
+from array import array
+from asyncio import to_thread
+from bisect import bisect_left, bisect_right
+from collections.abc import Iterable, Iterator, MutableSequence, Sequence
+from logging import getLogger
+
+from wcpan.drive.core.types import Drive, Node
+
+
+_GRAM_SIZE = 3
+# Names are also looked up from their first few words, see _PrefixTable.
+_MAX_PREFIX_KEYS = 8
+# Low bits of a _PrefixTable entry, the offset into the name.
+_OFFSET_BITS = 16
+# Letters and digits not after one, the same as str.isalnum.
+_WORD_START = re.compile(r"(?<![^\W_])[^\W_]")
+# Sorts after any character, so [prefix, prefix + _MAX_CHAR) covers it.
+_MAX_CHAR = "\U0010ffff"
+# Pairs per block of _SortedKeys, a block is split at twice as many.
+_BLOCK_SIZE = 1024
+_RUN_SIZE = 64 * 1024
+_L = getLogger(__name__)
+
+
+class NodeIndex:
+    """
+    In-memory index over node names and parents.
+
+    Name lookups go through a trigram index and only narrow down the
+    candidates, callers still have to confirm every candidate with the real
+    pattern.
+
+    Node ids are interned as numbers, everything else only holds numbers, in
+    machine arrays where possible. Postings are sorted arrays of numbers.
+    """
+
+    def __init__(self) -> None:
+        self._numbers: dict[str, int] = {}
+        # By number, None once released.
+        self._ids: list[str | None] = []
+        # By number, None for ids only known as a parent, e.g. the root.
+        self._names: list[str | None] = []
+        self._parents = array("i")
+        # Children are linked through their siblings, a folder only keeps its
+        # first child.
+        self._first_children = array("i")
+        self._next_siblings = array("i")
+        self._previous_siblings = array("i")
+        self._changed_times = array("d")
+        self._sizes = array("q")
+        self._mime_codes = array("I")
+        self._trashed = bytearray()
+        self._hashes: list[str] = []
+        self._count = 0
+        self._postings: dict[str, array[int]] = {}
+        # Few distinct mime types, stored once and referred to by code.
+        self._mime_types: list[str] = []
+        self._mime_lookup: dict[str, int] = {}
+        self._mime_postings: dict[int, array[int]] = {}
+        # Almost every hash belongs to one node, only shared ones get a set.
+        self._hash_owners: dict[str, int] = {}
+        self._duplicates: dict[str, set[int]] = {}
+        # None while build() sorts them, see _sort.
+        self._sorted_sizes: _SortedKeys[int] | None = _SortedKeys(typecode="q")
+        self._sorted_changed_times: _SortedKeys[float] | None = _SortedKeys(
+            typecode="d"
+        )
+        self._sorted_prefixes: _PrefixTable | None = _PrefixTable()
+        # Nodes changed while build() sorts, replayed afterwards.
+        self._touched: set[int] | None = None
+        # The latest changed time ever seen, tells how current the index is.
+        self._checkpoint: float | None = None
+        self._is_ready = False
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def is_ready(self) -> bool:
+        return self._is_ready
+
+    @property
+    def checkpoint(self) -> float | None:
+        return self._checkpoint
+
+    async def build(self, drive: Drive) -> None:
+        # Sorting once in the end is a lot cheaper than inserting one by one.
+        self._sorted_sizes = None
+        self._sorted_changed_times = None
+        self._sorted_prefixes = None
+        root = await drive.get_root()
+        async for _root, folders, files in drive.walk(root, include_trashed=True):
+            for node in itertools.chain(folders, files):
+                self.add(node)
+        await self._sort()
+        self._is_ready = True
+        _L.info(f"node index ready, {self._count} nodes")
+
+    def add(self, node: Node) -> None:
+        """Indexes the node, or re-indexes it if it is already indexed."""
+        number = self._intern(node.id)
+        if self._touched is not None:
+            self._touched.add(number)
+        old_name = self._names[number]
+        is_new = old_name is None
+        if old_name != node.name:
+            if old_name is not None:
+                self._remove_grams(number, old_name)
+                self._remove_prefixes(number)
+            for gram in _to_grams(node.name):
+                _insert(self._postings.setdefault(gram, array("I")), number)
+            if self._sorted_prefixes is not None:
+                self._sorted_prefixes.add(number, node.name)
+        if is_new:
+            self._count += 1
+        self._names[number] = node.name
+        self._set_parent(number, node.parent_id)
+        self._trashed[number] = node.is_trashed
+
+        # Folders have no content.
+        hash_ = "" if node.is_directory else node.hash
+        old_hash = self._hashes[number]
+        if old_hash != hash_:
+            if old_hash:
+                self._remove_hash(number, old_hash)
+            if hash_:
+                self._add_hash(number, hash_)
+
+        old_size = None if is_new else self._sizes[number]
+        if old_size != node.size:
+            _update_sorted(self._sorted_sizes, number, old_size, node.size)
+            self._sizes[number] = node.size
+
+        mime_code = self._intern_mime_type(node.mime_type)
+        old_mime_code = None if is_new else self._mime_codes[number]
+        if old_mime_code != mime_code:
+            if old_mime_code is not None:
+                self._remove_mime_type(number, old_mime_code)
+            _insert(self._mime_postings.setdefault(mime_code, array("I")), number)
+            self._mime_codes[number] = mime_code
+
+        changed_time = node.changed_time.timestamp()
+        old_changed_time = None if is_new else self._changed_times[number]
+        if old_changed_time != changed_time:
+            _update_sorted(
+                self._sorted_changed_times, number, old_changed_time, changed_time
+            )
+            self._changed_times[number] = changed_time
+        if self._checkpoint is None or changed_time > self._checkpoint:
+            self._checkpoint = changed_time
+
+    def remove(self, id_: str) -> None:
+        number = self._lookup(id_)
+        if number is None:
+            return
+        if self._touched is not None:
+            self._touched.add(number)
+        name = self._names[number]
+        assert name is not None
+        self._names[number] = None
+        self._count -= 1
+        self._set_parent(number, None)
+        _update_sorted(
+            self._sorted_changed_times, number, self._changed_times[number], None
+        )
+        _update_sorted(self._sorted_sizes, number, self._sizes[number], None)
+        self._remove_mime_type(number, self._mime_codes[number])
+        self._trashed[number] = False
+        old_hash = self._hashes[number]
+        if old_hash:
+            self._remove_hash(number, old_hash)
+        self._remove_grams(number, name)
+        self._remove_prefixes(number)
+        self._release(number)
+
+    def get_name(self, id_: str) -> str | None:
+        number = self._numbers.get(id_, None)
+        return None if number is None else self._names[number]
+
+    def get_parent_id(self, id_: str) -> str | None:
+        number = self._lookup(id_)
+        if number is None or self._parents[number] < 0:
+            return None
+        return self._ids[self._parents[number]]
+
+    def is_trashed(self, id_: str) -> bool:
+        number = self._lookup(id_)
+        return number is not None and bool(self._trashed[number])
+
+    def get_size(self, id_: str) -> int | None:
+        number = self._lookup(id_)
+        return None if number is None else self._sizes[number]
+
+    def get_mime_type(self, id_: str) -> str | None:
+        number = self._lookup(id_)
+        return None if number is None else self._mime_types[self._mime_codes[number]]
+
+    def get_changed_time(self, id_: str) -> float | None:
+        number = self._lookup(id_)
+        return None if number is None else self._changed_times[number]
+
+    def count_by_size(self, lower: int | None, upper: int | None) -> int:
+        """Counts nodes with lower <= size <= upper, None means unbounded."""
+        return self._get_sorted_sizes().count(lower, _to_exclusive(upper))
+
+    def find_by_size(self, lower: int | None, upper: int | None) -> Sequence[str]:
+        """Returns ids with lower <= size <= upper, smallest first."""
+        sorted_sizes = self._get_sorted_sizes()
+        return self._to_ids(sorted_sizes.iter_range(lower, _to_exclusive(upper)))
+
+    def iter_largest(self, upper: int | None = None) -> Iterator[str]:
+        """Yields ids with size <= upper, largest first."""
+        for number in self._get_sorted_sizes().iter_reversed(_to_exclusive(upper)):
+            yield self._to_id(number)
+
+    def count_by_changed_time(self, begin: float | None, end: float | None) -> int:
+        """Counts nodes with begin <= changed time < end."""
+        return self._get_sorted_changed_times().count(begin, end)
+
+    def find_by_changed_time(
+        self, begin: float | None, end: float | None
+    ) -> Sequence[str]:
+        """Returns ids with begin <= changed time < end, oldest first."""
+        sorted_changed_times = self._get_sorted_changed_times()
+        return self._to_ids(sorted_changed_times.iter_range(begin, end))
+
+    def find_by_prefix(self, prefix: str) -> Iterator[str]:
+        """
+        Yields ids whose name, or any of its first words, starts with prefix.
+
+        Case insensitive, in the order of the matched text. An id may be
+        yielded more than once.
+        """
+        prefix = prefix.lower()
+        sorted_prefixes = self._get_sorted_prefixes()
+        # Lazy, callers usually only need the first few.
+        for number in sorted_prefixes.iter_range(prefix):
+            yield self._to_id(number)
+
+    def find_by_hash(self, hash_: str) -> set[str]:
+        numbers = self._duplicates.get(hash_, None)
+        if numbers is not None:
+            return {self._to_id(_) for _ in numbers}
+        number = self._hash_owners.get(hash_, None)
+        return set() if number is None else {self._to_id(number)}
+
+    def iter_duplicate_hashes(self) -> Iterable[str]:
+        """Hashes shared by more than one node, trashed or not."""
+        return self._duplicates.keys()
+
+    def iter_mime_types(self) -> Iterable[str]:
+        return (self._mime_types[_] for _ in self._mime_postings)
+
+    def count_by_mime_type(self, mime_type: str) -> int:
+        return len(self._get_mime_posting(mime_type))
+
+    def find_by_mime_type(self, mime_type: str) -> set[str]:
+        return {self._to_id(_) for _ in self._get_mime_posting(mime_type)}
+
+    def find_changed_since(self, checkpoint: float) -> Iterator[str]:
+        for number, changed_time in enumerate(self._changed_times):
+            if changed_time > checkpoint and self._names[number] is not None:
+                yield self._to_id(number)
+
+    def find(self, terms: list[list[str]]) -> set[str] | None:
+        """
+        Returns candidate ids for the given terms.
+
+        The terms are alternatives of token lists, a name is a candidate if it
+        contains all tokens of any alternative. Returns None if the terms are
+        too short to narrow down, i.e. every node is a candidate.
+        """
+        rv: set[int] = set()
+        for tokens in terms:
+            candidates = self._find_all(tokens)
+            if candidates is None:
+                return None
+            rv |= candidates
+        return {self._to_id(_) for _ in rv}
+
+    def iter_all(self) -> Iterator[str]:
+        for number, name in enumerate(self._names):
+            if name is not None:
+                yield self._to_id(number)
+
+    def iter_subtree(self, root_id: str) -> Iterator[str]:
+        """Yields all descendants of root_id, excluding itself."""
+        # The root may only be known as a parent.
+        root = self._numbers.get(root_id, None)
+        if root is None:
+            return
+        stack = [root]
+        while stack:
+            child = self._first_children[stack.pop()]
+            while child >= 0:
+                yield self._to_id(child)
+                stack.append(child)
+                child = self._next_siblings[child]
+
+    def filter_subtree(self, ids: Iterable[str], root_id: str) -> Iterator[str]:
+        """
+        Yields ids which are descendants of root_id.
+
+        Ancestors are memoized, so each of them is visited once per call.
+        """
+        root = self._numbers.get(root_id, None)
+        if root is None:
+            return
+        memo: dict[int, bool] = {root: True}
+        for id_ in ids:
+            number = self._lookup(id_)
+            if number is None:
+                continue
+            chain: list[int] = []
+            current = self._parents[number]
+            while current >= 0 and current not in memo:
+                chain.append(current)
+                current = self._parents[current]
+            rv = memo.get(current, False) if current >= 0 else False
+            for ancestor in chain:
+                memo[ancestor] = rv
+            if rv:
+                yield id_
+
+    def _intern(self, id_: str) -> int:
+        number = self._numbers.get(id_, None)
+        if number is not None:
+            return number
+        number = len(self._ids)
+        self._numbers[id_] = number
+        self._ids.append(id_)
+        self._names.append(None)
+        self._parents.append(-1)
+        self._first_children.append(-1)
+        self._next_siblings.append(-1)
+        self._previous_siblings.append(-1)
+        self._changed_times.append(0.0)
+        self._sizes.append(0)
+        self._mime_codes.append(0)
+        self._trashed.append(False)
+        self._hashes.append("")
+        return number
+
+    def _release(self, number: int) -> None:
+        """Forgets the id once it is neither a node nor a parent."""
+        if self._names[number] is not None or self._first_children[number] >= 0:
+            return
+        id_ = self._ids[number]
+        assert id_ is not None
+        del self._numbers[id_]
+        # The slot is left behind, numbers are never reused.
+        self._ids[number] = None
+
+    def _lookup(self, id_: str) -> int | None:
+        """The number of an indexed node, None for unknown ids and parents."""
+        number = self._numbers.get(id_, None)
+        if number is None or self._names[number] is None:
+            return None
+        return number
+
+    def _to_id(self, number: int) -> str:
+        id_ = self._ids[number]
+        assert id_ is not None
+        return id_
+
+    def _to_ids(self, numbers: Iterable[int]) -> list[str]:
+        return [self._to_id(_) for _ in numbers]
+
+    def _intern_mime_type(self, mime_type: str) -> int:
+        code = self._mime_lookup.get(mime_type, None)
+        if code is None:
+            code = len(self._mime_types)
+            self._mime_types.append(mime_type)
+            self._mime_lookup[mime_type] = code
+        return code
+
+    def _get_mime_posting(self, mime_type: str) -> Sequence[int]:
+        code = self._mime_lookup.get(mime_type, None)
+        if code is None:
+            return ()
+        return self._mime_postings.get(code, ())
+
+    def _find_all(self, tokens: list[str]) -> set[int] | None:
+        grams = set(itertools.chain.from_iterable(_to_grams(_) for _ in tokens))
+        if not grams:
+            return None
+
+        postings = sorted(
+            (self._postings.get(_, ()) for _ in grams),
+            key=len,
+        )
+        rv = set(postings[0])
+        for posting in postings[1:]:
+            if not rv:
+                break
+            # Only look up what is left, instead of walking the whole posting.
+            rv = {_ for _ in rv if _contains(posting, _)}
+        return rv
+
+    def _get_sorted_sizes(self) -> "_SortedKeys[int]":
+        if self._sorted_sizes is None:
+            raise RuntimeError("node index is being built")
+        return self._sorted_sizes
+
+    def _get_sorted_changed_times(self) -> "_SortedKeys[float]":
+        if self._sorted_changed_times is None:
+            raise RuntimeError("node index is being built")
+        return self._sorted_changed_times
+
+    async def _sort(self) -> None:
+        """
+        Sorts what build() has added in a thread, then replays the changes
+        made in the meantime.
+        """
+        self._touched = set()
+        names = self._names.copy()
+        sizes = array("q", self._sizes)
+        changed_times = array("d", self._changed_times)
+        try:
+            sorted_sizes, sorted_changed_times, sorted_prefixes = await to_thread(
+                _sort_fields, names, sizes, changed_times
+            )
+        finally:
+            touched, self._touched = self._touched, None
+
+        for number in touched:
+            old_name = names[number] if number < len(names) else None
+            if old_name is not None:
+                sorted_sizes.remove(sizes[number], number)
+                sorted_changed_times.remove(changed_times[number], number)
+                sorted_prefixes.discard(number)
+            name = self._names[number]
+            if name is not None:
+                sorted_sizes.add(self._sizes[number], number)
+                sorted_changed_times.add(self._changed_times[number], number)
+                sorted_prefixes.add(number, name)
+        self._sorted_sizes = sorted_sizes
+        self._sorted_changed_times = sorted_changed_times
+        self._sorted_prefixes = sorted_prefixes
+
+    def _get_sorted_prefixes(self) -> "_PrefixTable":
+        if self._sorted_prefixes is None:
+            raise RuntimeError("node index is being built")
+        return self._sorted_prefixes
+
+    def _set_parent(self, number: int, parent_id: str | None) -> None:
+        old_parent = self._parents[number]
+        parent = -1 if parent_id is None else self._intern(parent_id)
+        if old_parent == parent:
+            return
+        if old_parent >= 0:
+            previous = self._previous_siblings[number]
+            next_ = self._next_siblings[number]
+            if previous >= 0:
+                self._next_siblings[previous] = next_
+            else:
+                self._first_children[old_parent] = next_
+            if next_ >= 0:
+                self._previous_siblings[next_] = previous
+            self._previous_siblings[number] = -1
+            self._next_siblings[number] = -1
+        if parent >= 0:
+            head = self._first_children[parent]
+            self._next_siblings[number] = head
+            if head >= 0:
+                self._previous_siblings[head] = number
+            self._first_children[parent] = number
+        self._parents[number] = parent
+        if old_parent >= 0:
+            self._release(old_parent)
+
+    def _add_hash(self, number: int, hash_: str) -> None:
+        numbers = self._duplicates.get(hash_, None)
+        if numbers is not None:
+            numbers.add(number)
+        elif hash_ in self._hash_owners:
+            self._duplicates[hash_] = {self._hash_owners.pop(hash_), number}
+        else:
+            self._hash_owners[hash_] = number
+        self._hashes[number] = hash_
+
+    def _remove_hash(self, number: int, hash_: str) -> None:
+        numbers = self._duplicates.get(hash_, None)
+        if numbers is None:
+            del self._hash_owners[hash_]
+        else:
+            numbers.discard(number)
+            if len(numbers) < 2:
+                del self._duplicates[hash_]
+                self._hash_owners[hash_] = numbers.pop()
+        self._hashes[number] = ""
+
+    def _remove_mime_type(self, number: int, code: int) -> None:
+        posting = self._mime_postings[code]
+        _discard(posting, number)
+        if not posting:
+            del self._mime_postings[code]
+
+    def _remove_prefixes(self, number: int) -> None:
+        if self._sorted_prefixes is not None:
+            self._sorted_prefixes.discard(number)
+
+    def _remove_grams(self, number: int, name: str) -> None:
+        for gram in _to_grams(name):
+            posting = self._postings.get(gram, None)
+            if posting is None:
+                continue
+            _discard(posting, number)
+            if not posting:
+                del self._postings[gram]
+
+
+class _SortedKeys[K: (float, str)]:
+    """
+    Node numbers sorted by (key, number), in blocks of parallel arrays.
+
+    An insert or a removal only shifts one block, and a block is found by
+    bisecting the last pair of every block. Numeric keys are packed into
+    machine number arrays with the given typecode.
+    """
+
+    def __init__(
+        self, items: Iterable[tuple[int, K]] = (), *, typecode: str | None = None
+    ) -> None:
+        self._typecode = typecode
+        self._key_blocks: list[MutableSequence[K]] = []
+        self._number_blocks: list[array[int]] = []
+        # The last (key, number) of each block.
+        self._maxes: list[tuple[K, int]] = []
+        self._length = 0
+
+        # Sorted in runs and then merged in Python, so a build in a thread
+        # never holds the GIL for the whole sort.
+        runs = [
+            sorted((key, number) for number, key in run)
+            for run in itertools.batched(items, _RUN_SIZE)
+        ]
+        for block in itertools.batched(heapq.merge(*runs), _BLOCK_SIZE):
+            self._key_blocks.append(self._new_keys(_ for _, __ in block))
+            self._number_blocks.append(array("I", (_ for __, _ in block)))
+            self._maxes.append(block[-1])
+            self._length += len(block)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def add(self, key: K, number: int) -> None:
+        if not self._maxes:
+            self._key_blocks.append(self._new_keys([key]))
+            self._number_blocks.append(array("I", [number]))
+            self._maxes.append((key, number))
+            self._length = 1
+            return
+
+        b = min(bisect_left(self._maxes, (key, number)), len(self._maxes) - 1)
+        keys = self._key_blocks[b]
+        numbers = self._number_blocks[b]
+        i = _locate(keys, numbers, key, number)
+        keys.insert(i, key)
+        numbers.insert(i, number)
+        self._maxes[b] = (keys[-1], numbers[-1])
+        self._length += 1
+
+        if len(numbers) > 2 * _BLOCK_SIZE:
+            self._key_blocks.insert(b + 1, self._new_keys(keys[_BLOCK_SIZE:]))
+            self._number_blocks.insert(b + 1, numbers[_BLOCK_SIZE:])
+            del keys[_BLOCK_SIZE:]
+            del numbers[_BLOCK_SIZE:]
+            self._maxes.insert(b, (keys[-1], numbers[-1]))
+
+    def remove(self, key: K, number: int) -> None:
+        b = bisect_left(self._maxes, (key, number))
+        if b >= len(self._maxes):
+            return
+        keys = self._key_blocks[b]
+        numbers = self._number_blocks[b]
+        i = _locate(keys, numbers, key, number)
+        if i >= len(numbers) or numbers[i] != number or keys[i] != key:
+            return
+        del keys[i]
+        del numbers[i]
+        self._length -= 1
+        if numbers:
+            self._maxes[b] = (keys[-1], numbers[-1])
+        else:
+            del self._key_blocks[b]
+            del self._number_blocks[b]
+            del self._maxes[b]
+
+    def count(self, lower: K | None, upper: K | None) -> int:
+        """Counts lower <= key < upper."""
+        begin, end = self._to_bounds(lower, upper)
+        if begin >= end:
+            return 0
+        (b1, i1), (b2, i2) = begin, end
+        if b1 == b2:
+            return i2 - i1
+        middle = sum(len(_) for _ in self._number_blocks[b1 + 1 : b2])
+        return len(self._number_blocks[b1]) - i1 + middle + i2
+
+    def iter_range(self, lower: K | None, upper: K | None) -> Iterator[int]:
+        """Yields numbers of lower <= key < upper, by key."""
+        begin, end = self._to_bounds(lower, upper)
+        if begin >= end:
+            return
+        (b1, i1), (b2, i2) = begin, end
+        for b in range(b1, min(b2, len(self._number_blocks) - 1) + 1):
+            numbers = self._number_blocks[b]
+            yield from numbers[i1 if b == b1 else 0 : i2 if b == b2 else len(numbers)]
+
+    def iter_reversed(self, upper: K | None = None) -> Iterator[int]:
+        """Yields numbers of key < upper, largest key first."""
+        b, i = (len(self._maxes), 0) if upper is None else self._position(upper)
+        if b < len(self._number_blocks):
+            yield from reversed(self._number_blocks[b][:i])
+        for numbers in reversed(self._number_blocks[:b]):
+            yield from reversed(numbers)
+
+    def _to_bounds(
+        self, lower: K | None, upper: K | None
+    ) -> tuple[tuple[int, int], tuple[int, int]]:
+        begin = (0, 0) if lower is None else self._position(lower)
+        end = (len(self._maxes), 0) if upper is None else self._position(upper)
+        return begin, end
+
+    def _position(self, key: K) -> tuple[int, int]:
+        """(block, offset) of the first pair with at least key."""
+        # (key,) sorts before any (key, number).
+        b = bisect_left(self._maxes, (key,))
+        if b >= len(self._maxes):
+            return len(self._maxes), 0
+        return b, bisect_left(self._key_blocks[b], key)
+
+    def _new_keys(self, keys: Iterable[K]) -> MutableSequence[K]:
+        if self._typecode is None:
+            return list(keys)
+        return array(self._typecode, keys)
+
+
+class _PrefixTable:
+    """
+    Tails of names from each of their first words, sorted case insensitively.
+
+    An entry packs the node number and the offset of the tail into one
+    machine number, the text is read from the name on every comparison, so
+    none is copied. Kept in blocks like _SortedKeys.
+    """
+
+    def __init__(self, names: list[str | None] | None = None) -> None:
+        # Names as indexed, a renamed node is found by the old one.
+        self._names: list[str | None] = [] if names is None else names
+        self._blocks: list[array[int]] = []
+        # The last entry of each block.
+        self._maxes: list[int] = []
+
+        entries = (
+            number << _OFFSET_BITS | offset
+            for number, name in enumerate(self._names)
+            if name is not None
+            for offset in _to_prefix_offsets(name)
+        )
+        # Same as _SortedKeys, never holds the GIL for the whole sort.
+        runs = [
+            sorted(run, key=self._key) for run in itertools.batched(entries, _RUN_SIZE)
+        ]
+        merged = heapq.merge(*runs, key=self._key)
+        for block in itertools.batched(merged, _BLOCK_SIZE):
+            self._blocks.append(array("Q", block))
+            self._maxes.append(block[-1])
+
+    def add(self, number: int, name: str) -> None:
+        if number >= len(self._names):
+            self._names.extend([None] * (number + 1 - len(self._names)))
+        self._names[number] = name
+        for offset in _to_prefix_offsets(name):
+            self._insert(number << _OFFSET_BITS | offset)
+
+    def discard(self, number: int) -> None:
+        name = self._names[number] if number < len(self._names) else None
+        if name is None:
+            return
+        for offset in _to_prefix_offsets(name):
+            self._remove(number << _OFFSET_BITS | offset)
+        self._names[number] = None
+
+    def iter_range(self, prefix: str) -> Iterator[int]:
+        """Yields numbers of tails which start with prefix in lower case."""
+        b1, i1 = self._position((prefix,))
+        b2, i2 = self._position((prefix + _MAX_CHAR,))
+        for b in range(b1, min(b2, len(self._blocks) - 1) + 1):
+            block = self._blocks[b]
+            for entry in block[i1 if b == b1 else 0 : i2 if b == b2 else len(block)]:
+                yield entry >> _OFFSET_BITS
+
+    def _key(self, entry: int) -> tuple[str, int]:
+        name = self._names[entry >> _OFFSET_BITS]
+        assert name is not None
+        return name[entry & ((1 << _OFFSET_BITS) - 1) :].lower(), entry
+
+    def _position(self, key: tuple[str] | tuple[str, int]) -> tuple[int, int]:
+        """(block, offset) of the first entry with at least key."""
+        b = bisect_left(self._maxes, key, key=self._key)
+        if b >= len(self._maxes):
+            return len(self._maxes), 0
+        return b, bisect_left(self._blocks[b], key, key=self._key)
+
+    def _insert(self, entry: int) -> None:
+        if not self._maxes:
+            self._blocks.append(array("Q", [entry]))
+            self._maxes.append(entry)
+            return
+
+        b, i = self._position(self._key(entry))
+        if b >= len(self._blocks):
+            b, i = b - 1, len(self._blocks[b - 1])
+        block = self._blocks[b]
+        block.insert(i, entry)
+        self._maxes[b] = block[-1]
+
+        if len(block) > 2 * _BLOCK_SIZE:
+            self._blocks.insert(b + 1, block[_BLOCK_SIZE:])
+            del block[_BLOCK_SIZE:]
+            self._maxes.insert(b, block[-1])
+
+    def _remove(self, entry: int) -> None:
+        b, i = self._position(self._key(entry))
+        if b >= len(self._blocks):
+            return
+        block = self._blocks[b]
+        if i >= len(block) or block[i] != entry:
+            return
+        del block[i]
+        if block:
+            self._maxes[b] = block[-1]
+        else:
+            del self._blocks[b]
+            del self._maxes[b]
+
+
+def _locate[K: (float, str)](
+    keys: Sequence[K], numbers: Sequence[int], key: K, number: int
+) -> int:
+    lo = bisect_left(keys, key)
+    hi = bisect_right(keys, key, lo)
+    return bisect_left(numbers, number, lo, hi)
+
+
+def _sort_fields(
+    names: list[str | None], sizes: array[int], changed_times: array[float]
+) -> tuple["_SortedKeys[int]", "_SortedKeys[float]", "_PrefixTable"]:
+    numbers = [_ for _, name in enumerate(names) if name is not None]
+    return (
+        _SortedKeys(((_, sizes[_]) for _ in numbers), typecode="q"),
+        _SortedKeys(((_, changed_times[_]) for _ in numbers), typecode="d"),
+        # Its own copy, the caller still reads the old names.
+        _PrefixTable(names.copy()),
+    )
+
+
+def _update_sorted[K: (float, str)](
+    sorted_keys: _SortedKeys[K] | None,
+    number: int,
+    old_key: K | None,
+    new_key: K | None,
+) -> None:
+    if sorted_keys is None:
+        return
+    if old_key is not None:
+        sorted_keys.remove(old_key, number)
+    if new_key is not None:
+        sorted_keys.add(new_key, number)
+
+
+def _insert(posting: array[int], number: int) -> None:
+    """Inserts into a sorted posting, new numbers usually go to the end."""
+    if not posting or posting[-1] < number:
+        posting.append(number)
+        return
+    i = bisect_left(posting, number)
+    if posting[i] != number:
+        posting.insert(i, number)
+
+
+def _discard(posting: array[int], number: int) -> None:
+    i = bisect_left(posting, number)
+    if i < len(posting) and posting[i] == number:
+        del posting[i]
+
+
+def _contains(posting: Sequence[int], number: int) -> bool:
+    i = bisect_left(posting, number)
+    return i < len(posting) and posting[i] == number
+
+
+def _to_exclusive(upper: int | None) -> int | None:
+    return None if upper is None else upper + 1
+
+
+def _to_prefix_offsets(name: str) -> list[int]:
+    """Where the name and its first words start, "alice" of "[circle] alice"."""
+    starts = _WORD_START.finditer(name, 0, 1 << _OFFSET_BITS)
+    rv = [_.start() for _ in itertools.islice(starts, _MAX_PREFIX_KEYS)]
+    if name and (not rv or rv[0] != 0):
+        rv.insert(0, 0)
+    return rv
+
+
+def _to_grams(name: str) -> set[str]:
+    name = name.lower()
+    return {name[_ : _ + _GRAM_SIZE] for _ in range(len(name) - _GRAM_SIZE + 1)}
@@ -10,9 +10,10 @@ from aiohttp.web import Application, AppRunner, TCPSite
 from wcpan.drive.cli.lib import create_drive_from_config
 from wcpan.logging import ConfigBuilder
 
-from . import api, search, view
+from . import api, view
 from .app import KEY_DRIVE, KEY_SEARCH_ENGINE, KEY_STATIC, KEY_TOKEN, KEY_UNPACK_ENGINE
 from .args import parse_args
+from .search import create_search_engine
 from .unpack import create_unpack_engine
 
 
@@ -46,6 +47,17 @@ async def amain(args: list[str]) -> int:
             drive_path=kwargs.drive,
             static_path=kwargs.static,
             token=kwargs.token,
+            search_cache_size=kwargs.search_cache_size * 1024 * 1024,
+            search_snapshot_path=kwargs.search_snapshot,
+            storage_path=kwargs.storage,
+            unpack_concurrency=kwargs.unpack_concurrency,
+            prefetch=kwargs.prefetch,
+            prefetch_budget=kwargs.prefetch_budget * 1024 * 1024,
+            storage_budget=(
+                kwargs.storage_budget * 1024 * 1024
+                if kwargs.storage_budget is not None
+                else None
+            ),
         ) as app,
         _server_context(
             app,
@@ -85,6 +97,13 @@ async def _application_context(
     drive_path: str,
     static_path: str | None,
     token: str | None,
+    search_cache_size: int,
+    search_snapshot_path: str | None,
+    storage_path: str | None = None,
+    unpack_concurrency: int = 2,
+    prefetch: int = 0,
+    prefetch_budget: int | None = None,
+    storage_budget: int | None = None,
 ):
     app = Application()
 
@@ -102,11 +121,25 @@ async def _application_context(
     # context
     async with (
         create_drive_from_config(config_path) as drive,
-        create_unpack_engine(drive, port, unpack_path) as ue,
+        create_unpack_engine(
+            drive,
+            port,
+            unpack_path,
+            storage_path=Path(storage_path) if storage_path else None,
+            concurrency=unpack_concurrency,
+            prefetch=prefetch,
+            prefetch_budget=prefetch_budget,
+            storage_budget=storage_budget,
+        ) as ue,
+        create_search_engine(
+            drive,
+            cache_size=search_cache_size,
+            snapshot_path=Path(search_snapshot_path) if search_snapshot_path else None,
+        ) as se,
     ):
         app[KEY_DRIVE] = drive
         app[KEY_UNPACK_ENGINE] = ue
-        app[KEY_SEARCH_ENGINE] = search.SearchEngine(drive)
+        app[KEY_SEARCH_ENGINE] = se
         app[KEY_TOKEN] = token
 
         yield app
@@ -139,13 +172,17 @@ def _setup_api_path(app: Application) -> None:
     app.router.add_view(r"/api/v1/nodes/{id}/download", api.NodeDownloadView)
     app.router.add_view(r"/api/v1/nodes/{id}/images", api.NodeImageListView)
     app.router.add_view(r"/api/v1/nodes/{id}/images/{image_id}", api.NodeImageView)
+    app.router.add_view(r"/api/v1/nodes/{id}/entries/{path:.+}", api.NodeImageView)
     app.router.add_view(r"/api/v1/nodes/{id}/videos", api.NodeVideoListView)
     app.router.add_view(r"/api/v1/changes", api.ChangesView)
     app.router.add_view(r"/api/v1/apply", api.ApplyView)
     app.router.add_view(r"/api/v1/cache", api.CachesImagesView)
     app.router.add_view(r"/api/v1/caches/images", api.CachesImagesView)
     app.router.add_view(r"/api/v1/caches/searches", api.CachesSearchesView)
+    app.router.add_view(r"/api/v1/unpacks", api.UnpacksView)
     app.router.add_view(r"/api/v1/history", api.HistoryView)
+    app.router.add_view(r"/api/v1/suggest", api.SuggestView)
+    app.router.add_view(r"/api/v1/duplicates", api.DuplicatesView)
 
 
 def _setup_static_path(app: Application, path: str) -> None:
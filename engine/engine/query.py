@@ -0,0 +1,552 @@
+"""
+A small query language over node fields.
+
+Terms are joined by AND unless OR is given, NOT (or a leading "-") negates
+a term, and parentheses group terms. A bare word or a quoted string matches
+names, other fields are given as "field:value":
+
+    (ext:mkv OR ext:mp4) size:>1G changed:2026-10
+    mime:image/* -name:"cover" (size:1M..10M OR changed:>7d)
+
+Sizes and times are compared with >, >=, <, <= or given as a range a..b.
+Sizes accept K, M, G and T suffixes. Times are UTC dates (YYYY, YYYY-MM,
+YYYY-MM-DD), ISO datetimes, or ages like 12h, 30d and 2w. A date covers the
+whole period, so changed:2026-10 matches the entire month, and an age is a
+point in time, so changed:>7d matches the last week.
+
+Ages count from the start of the current hour, and are normalized to the
+absolute times they stand for. So the normalized text of changed:>7d moves
+on every hour, and never names a result which has gone stale.
+
+A query is evaluated against the node index. Every AND starts from its most
+selective term, and only tests the rest against what is left.
+"""
+
+import re
+from abc import ABCMeta, abstractmethod
+from collections.abc import Callable, Iterable, Iterator
+from datetime import datetime, timedelta, timezone
+
+from wcpan.drive.core.types import Node
+
+from .index import NodeIndex
+
+
+_TOKEN = re.compile(
+    r"""
+    \s*(?:
+        (?P<paren>[()])
+        | (?P<negate>-)(?=[^\s()])
+        | (?P<field>name|ext|mime|size|changed):
+          (?:"(?P<quoted_value>[^"]*)"|(?P<value>[^\s()"]+))
+        | "(?P<quoted>[^"]*)"
+        | (?P<word>[^\s()"]+)
+    )
+    """,
+    re.VERBOSE,
+)
+_SIZE_UNITS = {"": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+_SIZE = re.compile(r"(?P<number>\d+(?:\.\d+)?)\s*(?P<unit>[kmgt]?)(?:i?b)?", re.I)
+_AGE_UNITS = {"h": timedelta(hours=1), "d": timedelta(days=1), "w": timedelta(weeks=1)}
+_AGE = re.compile(r"(?P<number>\d+)(?P<unit>[hdw])")
+_COMPARISON = re.compile(r"(?P<operator>>=|<=|>|<)?(?P<operand>.+)")
+
+
+class QuerySyntaxError(Exception):
+    def __init__(self, message: str) -> None:
+        self._message = message
+
+    def __str__(self) -> str:
+        return self._message
+
+
+class Query(metaclass=ABCMeta):
+    @abstractmethod
+    def __str__(self) -> str:
+        """Normalized text, equivalent queries share the same text."""
+
+    @abstractmethod
+    def estimate(self, index: NodeIndex) -> int:
+        """Upper bound of the number of matches, used to order terms."""
+
+    @abstractmethod
+    def evaluate(self, index: NodeIndex) -> set[str]:
+        """Returns ids of all matching nodes."""
+
+    @abstractmethod
+    def test(self, index: NodeIndex, id_: str) -> bool:
+        """Tests one indexed node."""
+
+    @abstractmethod
+    def test_node(self, node: Node) -> bool:
+        """Tests a node directly, for when there is no index."""
+
+
+class And(Query):
+    def __init__(self, terms: list[Query]) -> None:
+        self.terms = terms
+
+    def __str__(self) -> str:
+        return " ".join(f"({_})" if isinstance(_, Or) else str(_) for _ in self.terms)
+
+    def estimate(self, index: NodeIndex) -> int:
+        positives = [_ for _ in self.terms if not isinstance(_, Not)]
+        if not positives:
+            return len(index)
+        return min(_.estimate(index) for _ in positives)
+
+    def evaluate(self, index: NodeIndex) -> set[str]:
+        positives = [_ for _ in self.terms if not isinstance(_, Not)]
+        negatives = [_ for _ in self.terms if isinstance(_, Not)]
+        if positives:
+            ordered = sorted(((_.estimate(index), _) for _ in positives), key=_first)
+            rv = ordered[0][1].evaluate(index)
+            rest = [_ for __, _ in ordered[1:]]
+        else:
+            rv = set(index.iter_all())
+            rest = []
+        for term in rest:
+            if not rv:
+                break
+            rv = {_ for _ in rv if term.test(index, _)}
+        for term in negatives:
+            if not rv:
+                break
+            rv = {_ for _ in rv if not term.term.test(index, _)}
+        return rv
+
+    def test(self, index: NodeIndex, id_: str) -> bool:
+        return all(_.test(index, id_) for _ in self.terms)
+
+    def test_node(self, node: Node) -> bool:
+        return all(_.test_node(node) for _ in self.terms)
+
+
+class Or(Query):
+    def __init__(self, terms: list[Query]) -> None:
+        self.terms = terms
+
+    def __str__(self) -> str:
+        return " OR ".join(str(_) for _ in self.terms)
+
+    def estimate(self, index: NodeIndex) -> int:
+        return min(len(index), sum(_.estimate(index) for _ in self.terms))
+
+    def evaluate(self, index: NodeIndex) -> set[str]:
+        rv: set[str] = set()
+        for term in self.terms:
+            rv |= term.evaluate(index)
+        return rv
+
+    def test(self, index: NodeIndex, id_: str) -> bool:
+        return any(_.test(index, id_) for _ in self.terms)
+
+    def test_node(self, node: Node) -> bool:
+        return any(_.test_node(node) for _ in self.terms)
+
+
+class Not(Query):
+    def __init__(self, term: Query) -> None:
+        self.term = term
+
+    def __str__(self) -> str:
+        term = self.term
+        return f"NOT ({term})" if isinstance(term, (And, Or)) else f"NOT {term}"
+
+    def estimate(self, index: NodeIndex) -> int:
+        return len(index)
+
+    def evaluate(self, index: NodeIndex) -> set[str]:
+        return {_ for _ in index.iter_all() if not self.term.test(index, _)}
+
+    def test(self, index: NodeIndex, id_: str) -> bool:
+        return not self.term.test(index, id_)
+
+    def test_node(self, node: Node) -> bool:
+        return not self.term.test_node(node)
+
+
+class Name(Query):
+    """Case insensitive substring of the name."""
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self._folded = text.lower()
+        self._candidates: set[str] | None = None
+        self._is_searched = False
+
+    def __str__(self) -> str:
+        return f"name:{_quote(self.text)}"
+
+    def estimate(self, index: NodeIndex) -> int:
+        candidates = self._find(index)
+        return len(index) if candidates is None else len(candidates)
+
+    def evaluate(self, index: NodeIndex) -> set[str]:
+        candidates = self._find(index)
+        ids = index.iter_all() if candidates is None else candidates
+        return {_ for _ in ids if self.test(index, _)}
+
+    def test(self, index: NodeIndex, id_: str) -> bool:
+        return self._match(index.get_name(id_) or "")
+
+    def test_node(self, node: Node) -> bool:
+        return self._match(node.name)
+
+    def _match(self, name: str) -> bool:
+        return self._folded in name.lower()
+
+    def _find(self, index: NodeIndex) -> set[str] | None:
+        # Shared by estimate() and evaluate() of the same run.
+        if not self._is_searched:
+            self._candidates = index.find([[self._folded]])
+            self._is_searched = True
+        return self._candidates
+
+
+class Extension(Name):
+    def __init__(self, text: str) -> None:
+        super().__init__(f".{text.lstrip('.')}")
+
+    def __str__(self) -> str:
+        return f"ext:{_quote(self.text[1:])}"
+
+    def _match(self, name: str) -> bool:
+        return name.lower().endswith(self._folded)
+
+
+class MimeType(Query):
+    """Exact mime type, or any subtype with "type/*"."""
+
+    def __init__(self, mime_type: str) -> None:
+        self.mime_type = mime_type.lower()
+        self._prefix = self.mime_type[:-1] if self.mime_type.endswith("*") else None
+
+    def __str__(self) -> str:
+        return f"mime:{_quote(self.mime_type)}"
+
+    def estimate(self, index: NodeIndex) -> int:
+        return sum(index.count_by_mime_type(_) for _ in self._iter_keys(index))
+
+    def evaluate(self, index: NodeIndex) -> set[str]:
+        rv: set[str] = set()
+        for key in self._iter_keys(index):
+            rv |= index.find_by_mime_type(key)
+        return rv
+
+    def test(self, index: NodeIndex, id_: str) -> bool:
+        return self._match(index.get_mime_type(id_) or "")
+
+    def test_node(self, node: Node) -> bool:
+        return self._match(node.mime_type)
+
+    def _match(self, mime_type: str) -> bool:
+        if self._prefix is None:
+            return mime_type == self.mime_type
+        return mime_type.startswith(self._prefix)
+
+    def _iter_keys(self, index: NodeIndex) -> Iterator[str]:
+        if self._prefix is None:
+            yield self.mime_type
+        else:
+            yield from (_ for _ in index.iter_mime_types() if self._match(_))
+
+
+class Size(Query):
+    """lower <= size <= upper, None means unbounded."""
+
+    def __init__(self, raw: str, lower: int | None, upper: int | None) -> None:
+        self._raw = raw
+        self.lower = lower
+        self.upper = upper
+
+    def __str__(self) -> str:
+        return f"size:{self._raw}"
+
+    def estimate(self, index: NodeIndex) -> int:
+        return index.count_by_size(self.lower, self.upper)
+
+    def evaluate(self, index: NodeIndex) -> set[str]:
+        return set(index.find_by_size(self.lower, self.upper))
+
+    def test(self, index: NodeIndex, id_: str) -> bool:
+        size = index.get_size(id_)
+        return size is not None and self._match(size)
+
+    def test_node(self, node: Node) -> bool:
+        return self._match(node.size)
+
+    def _match(self, size: int) -> bool:
+        if self.lower is not None and size < self.lower:
+            return False
+        if self.upper is not None and size > self.upper:
+            return False
+        return True
+
+
+class ChangedTime(Query):
+    """begin <= changed time < end, in POSIX timestamps."""
+
+    def __init__(self, raw: str, begin: float | None, end: float | None) -> None:
+        self._raw = raw
+        self.begin = begin
+        self.end = end
+
+    def __str__(self) -> str:
+        if not _is_relative(self._raw):
+            return f"changed:{self._raw}"
+        begin = "" if self.begin is None else _format_time(self.begin)
+        end = "" if self.end is None else _format_time(self.end)
+        return f"changed:{begin}..{end}"
+
+    def estimate(self, index: NodeIndex) -> int:
+        return index.count_by_changed_time(self.begin, self.end)
+
+    def evaluate(self, index: NodeIndex) -> set[str]:
+        return set(index.find_by_changed_time(self.begin, self.end))
+
+    def test(self, index: NodeIndex, id_: str) -> bool:
+        changed_time = index.get_changed_time(id_)
+        return changed_time is not None and self._match(changed_time)
+
+    def test_node(self, node: Node) -> bool:
+        return self._match(node.changed_time.timestamp())
+
+    def _match(self, changed_time: float) -> bool:
+        if self.begin is not None and changed_time < self.begin:
+            return False
+        if self.end is not None and changed_time >= self.end:
+            return False
+        return True
+
+
+def parse_query(text: str, *, now: datetime | None = None) -> Query:
+    """
+    Parses the query text.
+
+    `now` is the reference of ages like 30d, defaults to the start of the
+    current hour.
+    """
+    if now is None:
+        now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    parser = _Parser(_tokenize(text), now)
+    return parser.parse()
+
+
+type _Token = tuple[str, str]
+
+
+class _Parser:
+    def __init__(self, tokens: Iterable[_Token], now: datetime) -> None:
+        self._tokens = list(tokens)
+        self._position = 0
+        self._now = now
+
+    def parse(self) -> Query:
+        if not self._tokens:
+            raise QuerySyntaxError("empty query")
+        rv = self._parse_or()
+        if self._peek() is not None:
+            raise QuerySyntaxError(f"unexpected {self._peek_text()}")
+        return rv
+
+    def _parse_or(self) -> Query:
+        terms = [self._parse_and()]
+        while self._peek() == ("word", "OR"):
+            self._position += 1
+            terms.append(self._parse_and())
+        return terms[0] if len(terms) == 1 else Or(terms)
+
+    def _parse_and(self) -> Query:
+        terms = [self._parse_unary()]
+        while True:
+            token = self._peek()
+            if token is None or token in (("paren", ")"), ("word", "OR")):
+                break
+            if token == ("word", "AND"):
+                self._position += 1
+            terms.append(self._parse_unary())
+        return terms[0] if len(terms) == 1 else And(terms)
+
+    def _parse_unary(self) -> Query:
+        token = self._peek()
+        if token in (("negate", "-"), ("word", "NOT")):
+            self._position += 1
+            return Not(self._parse_unary())
+        return self._parse_atom()
+
+    def _parse_atom(self) -> Query:
+        token = self._next()
+        match token:
+            case ("paren", "("):
+                rv = self._parse_or()
+                if self._next() != ("paren", ")"):
+                    raise QuerySyntaxError("missing )")
+                return rv
+            case ("word", "AND" | "OR" | "NOT") | ("paren", ")"):
+                raise QuerySyntaxError(f"unexpected {token[1]}")
+            case ("word" | "quoted", text):
+                return Name(text)
+            case (field, value):
+                return _to_predicate(field, value, self._now)
+
+    def _peek(self) -> _Token | None:
+        if self._position >= len(self._tokens):
+            return None
+        return self._tokens[self._position]
+
+    def _peek_text(self) -> str:
+        token = self._peek()
+        return "end of query" if token is None else token[1]
+
+    def _next(self) -> _Token:
+        token = self._peek()
+        if token is None:
+            raise QuerySyntaxError("unexpected end of query")
+        self._position += 1
+        return token
+
+
+def _tokenize(text: str) -> Iterator[_Token]:
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        m = _TOKEN.match(text, position)
+        if not m:
+            raise QuerySyntaxError(f"unexpected {text[position:]}")
+        position = m.end()
+        if m["paren"]:
+            yield "paren", m["paren"]
+        elif m["negate"]:
+            yield "negate", "-"
+        elif m["field"]:
+            value = m["quoted_value"] if m["value"] is None else m["value"]
+            yield m["field"], value
+        elif m["quoted"] is not None:
+            yield "quoted", m["quoted"]
+        else:
+            yield "word", m["word"]
+
+
+def _to_predicate(field: str, value: str, now: datetime) -> Query:
+    if not value:
+        raise QuerySyntaxError(f"{field} needs a value")
+    match field:
+        case "name":
+            return Name(value)
+        case "ext":
+            return Extension(value)
+        case "mime":
+            return MimeType(value)
+        case "size":
+            lower, upper = _parse_range(value, _parse_size)
+            begin, end = _begin_of(lower), _end_of(upper)
+            # Sizes are integers, the last one of [begin, end) is end - 1.
+            return Size(
+                value,
+                None if begin is None else int(begin),
+                None if end is None else int(end) - 1,
+            )
+        case "changed":
+            begin, end = _parse_range(value, lambda _: _parse_time(_, now))
+            return ChangedTime(value, _begin_of(begin), _end_of(end))
+        case _:
+            raise QuerySyntaxError(f"unknown field {field}")
+
+
+def _parse_range(
+    value: str, parse: Callable[[str], tuple[float, float]]
+) -> tuple[tuple[float, float] | None, tuple[float, float] | None]:
+    """
+    Returns the (lower, upper) periods bounding the range.
+
+    Every operand is a period [begin, end), a comparison picks the side of
+    the period, e.g. ">2026-10" begins after October and "<=2026-10" ends
+    with it.
+    """
+    if ".." in value:
+        lower, upper = value.split("..", 1)
+        return (
+            parse(lower) if lower else None,
+            parse(upper) if upper else None,
+        )
+
+    m = _COMPARISON.fullmatch(value)
+    if not m:
+        raise QuerySyntaxError(f"invalid range {value}")
+    period = parse(m["operand"])
+    begin, end = period
+    match m["operator"]:
+        case ">":
+            return (end, end), None
+        case ">=":
+            return period, None
+        case "<":
+            return None, (begin, begin)
+        case "<=":
+            return None, period
+        case _:
+            return period, period
+
+
+def _begin_of(period: tuple[float, float] | None) -> float | None:
+    return None if period is None else period[0]
+
+
+def _end_of(period: tuple[float, float] | None) -> float | None:
+    return None if period is None else period[1]
+
+
+def _parse_size(value: str) -> tuple[int, int]:
+    m = _SIZE.fullmatch(value)
+    if not m:
+        raise QuerySyntaxError(f"invalid size {value}")
+    size = int(float(m["number"]) * _SIZE_UNITS[m["unit"].lower()])
+    return size, size + 1
+
+
+def _parse_time(value: str, now: datetime) -> tuple[float, float]:
+    m = _AGE.fullmatch(value)
+    if m:
+        point = (now - int(m["number"]) * _AGE_UNITS[m["unit"]]).timestamp()
+        return point, point
+
+    try:
+        match value.count("-"):
+            case 0 if len(value) == 4:
+                begin = datetime(int(value), 1, 1, tzinfo=timezone.utc)
+                end = begin.replace(year=begin.year + 1)
+            case 1:
+                year, month = map(int, value.split("-"))
+                begin = datetime(year, month, 1, tzinfo=timezone.utc)
+                end = (begin + timedelta(days=32)).replace(day=1)
+            case 2 if len(value) == 10:
+                begin = datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+                end = begin + timedelta(days=1)
+            case _:
+                begin = datetime.fromisoformat(value)
+                if begin.tzinfo is None:
+                    begin = begin.replace(tzinfo=timezone.utc)
+                end = begin
+    except ValueError:
+        raise QuerySyntaxError(f"invalid time {value}")
+    return begin.timestamp(), end.timestamp()
+
+
+def _is_relative(value: str) -> bool:
+    operands = value.lstrip("<>=").split("..")
+    return any(_AGE.fullmatch(_) for _ in operands)
+
+
+def _format_time(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+def _quote(text: str) -> str:
+    if re.fullmatch(r"[^\s()\"]+", text) and not text.startswith("-"):
+        return text
+    return f'"{text}"'
+
+
+def _first[T](pair: tuple[int, T]) -> int:
+    return pair[0]
@@ -0,0 +1,75 @@
+"""
+Relevance of a name to search terms, for ranked search.
+
+Terms have the same shape as NodeIndex.find, alternatives of token lists.
+A name scores higher when it has more of the tokens, in order, close to each
+other, near its beginning, and with little else around them.
+"""
+
+import heapq
+from collections.abc import Callable, Iterable
+
+
+_TOKEN_WEIGHT = 0.4
+_CONTIGUITY_WEIGHT = 0.2
+_PREFIX_WEIGHT = 0.2
+_COVERAGE_WEIGHT = 0.2
+
+
+def score_name(name: str, terms: list[list[str]]) -> float:
+    """Returns a score in [0, 1], the best of all alternatives."""
+    folded = name.lower()
+    return max(
+        (_score_tokens(folded, [_.lower() for _ in tokens if _]) for tokens in terms),
+        default=0.0,
+    )
+
+
+def top_k[T](items: Iterable[T], k: int, key: Callable[[T], float]) -> list[T]:
+    """
+    Returns the k items with the highest keys, highest first.
+
+    Only k items are kept in a heap at any time, the rest are never sorted.
+    """
+    return heapq.nlargest(k, items, key=key)
+
+
+def _score_tokens(name: str, tokens: list[str]) -> float:
+    if not name or not tokens:
+        return 0.0
+
+    # Leftmost in order match of as many tokens as possible.
+    spans: list[tuple[int, int]] = []
+    start = 0
+    for token in tokens:
+        begin = name.find(token, start)
+        if begin < 0:
+            break
+        start = begin + len(token)
+        spans.append((begin, start))
+    if not spans:
+        return 0.0
+
+    token_score = len(spans) / len(tokens)
+    # Separators between tokens do not count as gaps.
+    gap = sum(
+        sum(1 for _ in name[spans[i][1] : spans[i + 1][0]] if _.isalnum())
+        for i in range(len(spans) - 1)
+    )
+    contiguity_score = 1 / (1 + gap)
+    first = spans[0][0]
+    if first == 0:
+        prefix_score = 1.0
+    elif not name[first - 1].isalnum():
+        # Start of a word, e.g. after "[Circle] ".
+        prefix_score = 0.5
+    else:
+        prefix_score = 0.0
+    coverage_score = sum(end - begin for begin, end in spans) / len(name)
+
+    return (
+        _TOKEN_WEIGHT * token_score
+        + _CONTIGUITY_WEIGHT * contiguity_score
+        + _PREFIX_WEIGHT * prefix_score
+        + _COVERAGE_WEIGHT * coverage_score
+    )
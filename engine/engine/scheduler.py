@@ -0,0 +1,133 @@
+import heapq
+import time
+from asyncio import Future, get_running_loop
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from enum import IntEnum
+from logging import getLogger
+
+from .types import UnpackJobDict, UnpackQueueDict
+
+
+_L = getLogger(__name__)
+
+
+class Priority(IntEnum):
+    # Lower goes first.
+    INTERACTIVE = 0
+    PREFETCH = 1
+
+
+@dataclass(order=True)
+class _Job:
+    priority: Priority
+    sequence: int
+    key: str = field(compare=False)
+    created: float = field(compare=False)
+    started: float | None = field(default=None, compare=False)
+    future: Future[None] | None = field(default=None, compare=False)
+
+
+class UnpackScheduler:
+    """
+    Runs at most concurrency jobs at once, the rest wait by priority and then
+    by arrival.
+
+    Usage:
+        async with scheduler.slot(node.id, Priority.INTERACTIVE):
+            await unpack(node)
+    """
+
+    def __init__(self, concurrency: int) -> None:
+        if concurrency < 1:
+            raise ValueError(f"concurrency must be >= 1, got {concurrency}")
+        self._concurrency = concurrency
+        self._sequence = 0
+        self._queue: list[_Job] = []
+        self._running: dict[int, _Job] = {}
+
+    @asynccontextmanager
+    async def slot(self, key: str, priority: Priority):
+        job = _Job(
+            priority=priority,
+            sequence=self._sequence,
+            key=key,
+            created=time.time(),
+        )
+        self._sequence += 1
+
+        if len(self._running) >= self._concurrency or self._queue:
+            await self._wait(job)
+        else:
+            self._start(job)
+
+        try:
+            yield
+        finally:
+            del self._running[job.sequence]
+            self._next()
+
+    def promote(self, key: str, priority: Priority) -> None:
+        """Moves queued jobs of key up to priority."""
+        changed = False
+        for job in self._queue:
+            if job.key == key and job.priority > priority:
+                job.priority = priority
+                changed = True
+        if changed:
+            heapq.heapify(self._queue)
+            _L.debug(f"promoted {key} to {priority.name}")
+
+    def get_queued_priority(self, key: str) -> Priority | None:
+        """Priority of key if it is waiting, None if it is running or unknown."""
+        priorities = [_.priority for _ in self._queue if _.key == key]
+        return min(priorities, default=None)
+
+    def get_status(self) -> UnpackQueueDict:
+        now = time.time()
+        return {
+            "concurrency": self._concurrency,
+            "running": [
+                _to_job_dict(_, now)
+                for _ in sorted(self._running.values(), key=lambda _: _.sequence)
+            ],
+            "queued": [_to_job_dict(_, now) for _ in sorted(self._queue)],
+        }
+
+    async def _wait(self, job: _Job) -> None:
+        job.future = get_running_loop().create_future()
+        heapq.heappush(self._queue, job)
+        try:
+            await job.future
+        except BaseException:
+            if job.sequence in self._running:
+                # Granted and then canceled, pass the slot on.
+                del self._running[job.sequence]
+                self._next()
+            elif job in self._queue:
+                self._queue.remove(job)
+                heapq.heapify(self._queue)
+            raise
+
+    def _start(self, job: _Job) -> None:
+        job.started = time.time()
+        self._running[job.sequence] = job
+
+    def _next(self) -> None:
+        while self._queue and len(self._running) < self._concurrency:
+            job = heapq.heappop(self._queue)
+            assert job.future is not None
+            if job.future.done():
+                # Canceled but not yet woken up, it leaves on its own.
+                continue
+            self._start(job)
+            job.future.set_result(None)
+
+
+def _to_job_dict(job: _Job, now: float) -> UnpackJobDict:
+    return {
+        "id": job.key,
+        "priority": job.priority.name.lower(),
+        "waited": (job.started or now) - job.created,
+        "running": 0.0 if job.started is None else now - job.started,
+    }
@@ -1,20 +1,39 @@
 import itertools
+import json
 import re
-from asyncio import as_completed
-from collections.abc import AsyncIterator, Callable, Iterator
+import sys
+from asyncio import CancelledError, create_task, gather, sleep, to_thread
+from collections.abc import AsyncIterator, Callable, Iterable, Iterator
+from contextlib import asynccontextmanager
 from dataclasses import asdict, dataclass
 from logging import getLogger
-from pathlib import PurePath
-from typing import cast
-
-from wcpan.drive.core.types import Drive, Node
-
-from .lib import dict_from_node
+from pathlib import Path, PurePath
+from tempfile import NamedTemporaryFile
+from typing import Any, cast
+
+from wcpan.drive.core.lib import dispatch_change
+from wcpan.drive.core.types import ChangeAction, Drive, Node
+
+from .cache import LruCache
+from .index import NodeIndex
+from .lib import dict_from_node, get_node
+from .query import Query, QuerySyntaxError, parse_query
+from .rank import score_name, top_k
 from .singleflight import SingleFlight
-from .types import SearchNodeDict
+from .types import (
+    CacheStatsDict,
+    DuplicateGroupDict,
+    SearchNodeDict,
+    SearchPageDict,
+    SearchSnapshotDict,
+    SuggestionDict,
+)
 
 
 _MAX_HISTORY = 10
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_INTERVAL = 10 * 60
+_DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
 _L = getLogger(__name__)
 
 
@@ -24,6 +43,11 @@ class SearchParam:
     fuzzy: bool | None
     parent_path: str | None
     size: int | None
+    # Normalized query text, see engine.query.
+    query: str | None = None
+    # Only keeps this many best matches, ordered by relevance, or by size
+    # without a name.
+    top: int | None = None
 
     def is_valid(self) -> bool:
         return (
@@ -31,12 +55,22 @@ class SearchParam:
             or self.fuzzy is not None
             or bool(self.parent_path)
             or self.size is not None
+            or bool(self.query)
+            or self.top is not None
         )
 
     def to_dict(self):
         return asdict(self)
 
 
+@dataclass(frozen=True)
+class _CacheEntry:
+    nodes: list[SearchNodeDict]
+    # Compiled once, cache invalidation runs it against every change.
+    matcher: re.Pattern[str] | None
+    generation: int
+
+
 class SearchFailedError(Exception):
     def __init__(self, message: str) -> None:
         self._message = message
@@ -45,6 +79,22 @@ class SearchFailedError(Exception):
         return self._message
 
 
+class CursorExpiredError(Exception):
+    def __init__(self, message: str) -> None:
+        self._message = message
+
+    def __str__(self) -> str:
+        return self._message
+
+
+class IndexNotReadyError(Exception):
+    def __init__(self, message: str) -> None:
+        self._message = message
+
+    def __str__(self) -> str:
+        return self._message
+
+
 class InvalidPatternError(Exception):
     def __init__(self, message: str) -> None:
         self._message = message
@@ -53,19 +103,55 @@ class InvalidPatternError(Exception):
         return self._message
 
 
+@asynccontextmanager
+async def create_search_engine(
+    drive: Drive,
+    *,
+    cache_size: int = _DEFAULT_CACHE_SIZE,
+    snapshot_path: Path | None = None,
+):
+    engine = SearchEngine(drive, cache_size=cache_size)
+    if snapshot_path:
+        await _load_snapshot(engine, snapshot_path)
+
+    tasks = [create_task(engine.build_index())]
+    if snapshot_path:
+        tasks.append(create_task(_save_snapshot_periodically(engine, snapshot_path)))
+    try:
+        yield engine
+    finally:
+        for task in tasks:
+            task.cancel()
+            try:
+                await task
+            except CancelledError:
+                pass
+        if snapshot_path:
+            await _save_snapshot(engine, snapshot_path)
+
+
 class SearchEngine(object):
-    def __init__(self, drive: Drive) -> None:
+    def __init__(self, drive: Drive, *, cache_size: int = _DEFAULT_CACHE_SIZE) -> None:
         super(SearchEngine, self).__init__()
         # NOTE only takes a reference, not owning
         self._drive = drive
-        self._cache: dict[SearchParam, list[SearchNodeDict]] = {}
-        self._singleflight = SingleFlight[SearchParam, list[SearchNodeDict]]()
+        # Independent from the history, bounded by the estimated bytes.
+        self._cache = LruCache[SearchParam, _CacheEntry](cache_size)
+        self._singleflight = SingleFlight[SearchParam, _CacheEntry]()
         self._history: dict[SearchParam, None] = {}
+        self._index = NodeIndex()
+        # Bumped for every new cache entry, page cursors refer to it.
+        self._generation = 0
+        # Checkpoint of a restored snapshot, pending until the index is ready.
+        self._restored_checkpoint: float | None = None
 
     @property
     def history(self) -> Iterator[SearchParam]:
         return reversed(self._history.keys())
 
+    def get_cache_stats(self) -> CacheStatsDict:
+        return self._cache.get_stats()
+
     async def __call__(
         self,
         *,
@@ -73,8 +159,129 @@ class SearchEngine(object):
         fuzzy: bool | None = None,
         parent_path: str | None = None,
         size: int | None = None,
+        query: str | None = None,
+        top: int | None = None,
     ) -> list[SearchNodeDict]:
-        param = SearchParam(name=name, fuzzy=fuzzy, parent_path=parent_path, size=size)
+        param = _to_search_param(name, fuzzy, parent_path, size, query, top)
+        entry = await self._search(param)
+        return entry.nodes
+
+    async def get_page(
+        self,
+        *,
+        name: str | None = None,
+        fuzzy: bool | None = None,
+        parent_path: str | None = None,
+        size: int | None = None,
+        query: str | None = None,
+        top: int | None = None,
+        cursor: str | None = None,
+        limit: int,
+    ) -> SearchPageDict:
+        """
+        Returns a slice of the sorted results.
+
+        Only the first page (without cursor) may run the search, following
+        pages are sliced from the same cached result. The cursor expires
+        once that result is invalidated.
+        """
+        param = _to_search_param(name, fuzzy, parent_path, size, query, top)
+        if cursor is None:
+            entry = await self._search(param)
+            offset = 0
+        else:
+            generation, offset = _parse_cursor(cursor)
+            entry = self._cache.get(param)
+            if entry is None or entry.generation != generation:
+                raise CursorExpiredError(f"{cursor} is expired")
+
+        end = offset + limit
+        return {
+            "items": entry.nodes[offset:end],
+            "next_cursor": (
+                f"{entry.generation}-{end}" if end < len(entry.nodes) else None
+            ),
+            "total": len(entry.nodes),
+        }
+
+    async def iter_duplicates(
+        self, *, min_size: int = 0
+    ) -> AsyncIterator[DuplicateGroupDict]:
+        """
+        Yields groups of nodes with the same content, most wasted bytes first.
+
+        Groups come from the hash index, and nodes are only fetched for the
+        group being yielded. Trashed nodes do not count.
+        """
+        if not self._index.is_ready:
+            raise IndexNotReadyError("node index is not ready")
+
+        groups: list[tuple[int, str, list[str]]] = []
+        for hash_ in self._index.iter_duplicate_hashes():
+            ids = [
+                _
+                for _ in self._index.find_by_hash(hash_)
+                if not self._index.is_trashed(_)
+            ]
+            if len(ids) < 2:
+                continue
+            size = self._index.get_size(ids[0]) or 0
+            if size < min_size:
+                continue
+            groups.append((size * (len(ids) - 1), hash_, sorted(ids)))
+        groups.sort(key=lambda _: (-_[0], _[1]))
+
+        for _wasted, hash_, ids in groups:
+            node_list = await gather(*(get_node(self._drive, _) for _ in ids))
+            nodes = [dict_from_node(_) for _ in node_list if _ and not _.is_trashed]
+            if len(nodes) < 2:
+                continue
+            size = nodes[0]["size"]
+            yield {
+                "hash": hash_,
+                "size": size,
+                "wasted": size * (len(nodes) - 1),
+                "nodes": nodes,
+            }
+
+    def suggest(self, prefix: str, *, limit: int) -> list[SuggestionDict]:
+        """
+        Completes a partial search, from the history and then node names.
+
+        Served from memory only, neither the cache nor the history changes.
+        Names are only available once the index is ready.
+        """
+        folded = prefix.strip().lower()
+        if not folded:
+            return []
+
+        rv: list[SuggestionDict] = []
+        seen: set[str] = set()
+
+        def collect(text: str, kind: str) -> None:
+            if text not in seen:
+                seen.add(text)
+                rv.append({"text": text, "kind": kind})
+
+        for param in self.history:
+            text = param.name or param.query
+            if text and text.lower().startswith(folded):
+                collect(text, "history")
+                if len(rv) >= limit:
+                    return rv
+
+        if not self._index.is_ready:
+            return rv
+        for id_ in self._index.find_by_prefix(folded):
+            name = self._index.get_name(id_)
+            if name is None or self._index.is_trashed(id_):
+                continue
+            collect(name, "name")
+            if len(rv) >= limit:
+                break
+        return rv
+
+    async def _search(self, param: SearchParam) -> _CacheEntry:
         if not param.is_valid():
             raise SearchFailedError(f"empty search param")
 
@@ -82,18 +289,29 @@ class SearchEngine(object):
         self._update_history(param)
 
         # Fast path: check cache first
-        nodes = self._cache.get(param, None)
-        if nodes is not None:
-            return nodes
+        entry = self._cache.get(param)
+        if entry is not None:
+            return entry
 
         # Use singleflight to coordinate concurrent searches
         async def on_first():
-            result = await self._do_search(param)
-            self._cache[param] = result
-            return result
+            result = self._refine_from_cache(param)
+            if result is None:
+                result = await self._do_search(param)
+            self._generation += 1
+            entry = _CacheEntry(
+                nodes=result,
+                matcher=_to_matcher(param),
+                generation=self._generation,
+            )
+            self._cache.set(param, entry, _estimate_size(result))
+            return entry
 
         async def on_middle():
-            return self._cache[param]
+            entry = self._cache.peek(param)
+            if entry is None:
+                raise KeyError(param)
+            return entry
 
         try:
             return await self._singleflight(
@@ -102,48 +320,219 @@ class SearchEngine(object):
         except KeyError:
             raise SearchFailedError(f"{param} search was canceled")
 
+    async def build_index(self) -> None:
+        try:
+            await self._index.build(self._drive)
+        except CancelledError:
+            raise
+        except Exception:
+            _L.exception("failed to build node index, fallback to drive")
+            if self._restored_checkpoint is not None:
+                # Nothing to tell what is stale.
+                self._restored_checkpoint = None
+                self._cache.clear()
+            return
+
+        if self._restored_checkpoint is not None:
+            self._revalidate_cache(self._restored_checkpoint)
+            self._restored_checkpoint = None
+
+    def dump_snapshot(self) -> SearchSnapshotDict | None:
+        """
+        Dumps the history and the cache, stamped with the index checkpoint.
+
+        Returns None if the index can not tell how current the cache is yet.
+        """
+        checkpoint = self._index.checkpoint
+        if not self._index.is_ready or checkpoint is None:
+            return None
+        return {
+            "version": _SNAPSHOT_VERSION,
+            "checkpoint": checkpoint,
+            "history": [_.to_dict() for _ in self._history],
+            "cache": [
+                {
+                    "param": k.to_dict(),
+                    "nodes": v.nodes,
+                }
+                for k, v in self._cache.items()
+            ],
+        }
+
+    def load_snapshot(self, snapshot: SearchSnapshotDict) -> None:
+        """
+        Restores the history and the cache.
+
+        Restored entries are served right away, and revalidated against the
+        drive once the index is ready. A snapshot which fails to parse restores
+        nothing.
+        """
+        if snapshot["version"] != _SNAPSHOT_VERSION:
+            _L.warning(f"unknown snapshot version {snapshot['version']}, skipped")
+            return
+
+        # Parsed in full first, a bad snapshot must not leave entries behind
+        # without the checkpoint to revalidate them.
+        history = [SearchParam(**_) for _ in snapshot["history"]]
+        entries: list[tuple[SearchParam, _CacheEntry, int]] = []
+        for offset, raw in enumerate(snapshot["cache"], 1):
+            param = SearchParam(**raw["param"])
+            entry = _CacheEntry(
+                nodes=raw["nodes"],
+                matcher=_to_matcher(param),
+                generation=self._generation + offset,
+            )
+            entries.append((param, entry, _estimate_size(entry.nodes)))
+        checkpoint = float(snapshot["checkpoint"])
+
+        for param in history:
+            self._update_history(param)
+        for param, entry, size in entries:
+            self._cache.set(param, entry, size)
+        self._generation += len(entries)
+        self._restored_checkpoint = checkpoint
+
     async def clear_cache(self) -> None:
         await self._singleflight.wait_all()
-        self._cache: dict[SearchParam, list[SearchNodeDict]] = {}
+        self._cache.clear()
+
+    def apply_changes(self, changes: Iterable[ChangeAction]) -> None:
+        """Applies changes from the drive to the index and the cache."""
+        names: list[str] = []
+        for change in changes:
+            dispatch_change(
+                change,
+                on_remove=lambda _: self._remove_node(_, names),
+                on_update=lambda _: self._update_node(_, names),
+            )
+        self._invalidate_cache_by_names(names)
 
     def invalidate_cache_by_node(self, node: Node) -> None:
-        keys = list(self._cache.keys())
+        self._invalidate_cache_by_names([node.name])
+
+    def invalidate_cache_by_nodes(self, nodes: Iterable[Node]) -> None:
+        self._invalidate_cache_by_names([_.name for _ in nodes])
+
+    def _revalidate_cache(self, checkpoint: float) -> None:
+        changed = self._index.find_changed_since(checkpoint)
+        names = [_ for _ in map(self._index.get_name, changed) if _ is not None]
+        self._invalidate_cache_by_names(names)
+
+        for k, entry in list(self._cache.items()):
+            if names and not entry.matcher:
+                # No way to tell, drop it.
+                self._cache.discard(k)
+            elif any(self._index.get_name(_["id"]) is None for _ in entry.nodes):
+                # Some nodes were removed after the snapshot.
+                self._cache.discard(k)
+        _L.info(f"revalidated restored search cache, {len(self._cache)} left")
+
+    def _update_node(self, node: Node, names: list[str]) -> None:
+        # Renamed nodes are still in the caches of the old name.
+        old_name = self._index.get_name(node.id)
+        if old_name is not None and old_name != node.name:
+            names.append(old_name)
+        self._index.add(node)
+        names.append(node.name)
+
+    def _remove_node(self, id_: str, names: list[str]) -> None:
+        name = self._index.get_name(id_)
+        self._index.remove(id_)
+        if name is not None:
+            names.append(name)
+
+    def _invalidate_cache_by_names(self, names: list[str]) -> None:
+        if not names:
+            return
+
+        # Patterns never match across lines, so one scan covers every name.
+        haystack = "\n".join(names)
+        keys = list(self._cache)
         for k in keys:
             if k in self._singleflight:
                 # Going to be updated.
                 continue
-            if _is_node_match_param(node, k):
-                del self._cache[k]
+            entry = self._cache.peek(k)
+            if not entry:
+                continue
+            # Without a name any change may affect the result.
+            if entry.matcher is None or entry.matcher.search(haystack):
+                self._cache.discard(k)
                 _L.debug(f"invalidated search param {k}")
 
-    def _invalidate_cache_by_param(self, param: SearchParam) -> None:
-        if param in self._cache:
-            del self._cache[param]
+    def _refine_from_cache(self, param: SearchParam) -> list[SearchNodeDict] | None:
+        """
+        Filters the smallest cached superset of the results, if any.
+
+        Cached results are kept up to date by invalidation, so are the ones
+        filtered from them.
+        """
+        best: _CacheEntry | None = None
+        for key in self._cache:
+            if key in self._singleflight or not _is_superset(key, param):
+                continue
+            entry = self._cache.peek(key)
+            if entry and (best is None or len(entry.nodes) < len(best.nodes)):
+                best = entry
+        if best is None:
+            return None
+
+        _L.debug(f"refine {param} from {len(best.nodes)} cached nodes")
+        matcher = _to_matcher(param)
+        size_bounds = _to_size_bounds(param.size) if param.size is not None else None
+        scope = PurePath(param.parent_path) if param.parent_path else None
+
+        def is_match(node: SearchNodeDict) -> bool:
+            if matcher and not matcher.search(node["name"]):
+                return False
+            if size_bounds:
+                lower, upper = size_bounds
+                if lower is not None and node["size"] < lower:
+                    return False
+                if upper is not None and node["size"] > upper:
+                    return False
+            if scope and not PurePath(node["parent_path"]).is_relative_to(scope):
+                return False
+            return True
+
+        # Still in order, the superset is sorted the same way.
+        return [_ for _ in best.nodes if is_match(_)]
 
     async def _do_search(self, param: SearchParam) -> list[SearchNodeDict]:
         try:
             nodes = await self._pure_search(param)
-            g = (_ for _ in nodes if not _.is_trashed)
-            g = as_completed(self._make_item(_) for _ in g)
-            results = [await _ for _ in g]
+            nodes = [_ for _ in nodes if not _.is_trashed]
+            results = await self._make_items(nodes)
+            if param.top:
+                # Already ranked, keep the order.
+                order = {node.id: i for i, node in enumerate(nodes)}
+                return sorted(results, key=lambda _: order[_["id"]])
             nodes = sorted(results, key=lambda _: (_["parent_path"], _["name"]))
             return nodes
         except Exception as e:
             _L.exception("search failed, abort")
             raise SearchFailedError(str(e))
 
-    async def _make_item(self, node: Node) -> SearchNodeDict:
-        assert node.parent_id
-        parent_node = await self._drive.get_node_by_id(node.parent_id)
-        assert parent_node
-        parent_path = await self._drive.resolve_path(parent_node)
-        rv = cast(SearchNodeDict, dict_from_node(node))
-        rv["parent_path"] = str(parent_path)
+    async def _make_items(self, nodes: list[Node]) -> list[SearchNodeDict]:
+        # Siblings share the parent path, so only resolve it once per parent.
+        groups: dict[str, list[Node]] = {}
+        for node in nodes:
+            assert node.parent_id
+            groups.setdefault(node.parent_id, []).append(node)
+
+        resolver = _PathResolver(self._drive)
+        rv: list[SearchNodeDict] = []
+        for parent_id, children in groups.items():
+            parent_path = str(await resolver(parent_id))
+            for node in children:
+                item = cast(SearchNodeDict, dict_from_node(node))
+                item["parent_path"] = parent_path
+                rv.append(item)
         return rv
 
     async def _pure_search(self, param: SearchParam) -> list[Node]:
         name = param.name
-        fuzzy = param.name
+        fuzzy = param.fuzzy
         parent_path = param.parent_path
         size = param.size
 
@@ -152,28 +541,35 @@ class SearchEngine(object):
         else:
             parent_node = None
 
-        if not name:
-            pattern = ""
-        else:
-            if fuzzy:
-                pattern = _to_fuzzy_search_pattern(name)
-            else:
-                pattern = _to_normal_search_pattern(name)
+        if param.query:
+            return await self._query(parse_query(param.query), parent_node)
 
-        if parent_node:
+        matcher = _to_matcher(param)
+
+        if (
+            parent_node or matcher or size is not None or param.top
+        ) and self._index.is_ready:
+            return await self._search_index(
+                _to_search_terms(name, fuzzy) if name else None,
+                matcher,
+                parent_node.id if parent_node else None,
+                _to_size_bounds(size) if size is not None else None,
+                param.top,
+            )
+        elif parent_node:
             node_list = [
                 node
                 async for node in _walk_node(
                     self._drive,
                     parent_node,
-                    (
-                        None
-                        if pattern
-                        else lambda n: re.match(pattern, n.name, re.I) is not None
-                    ),
+                    (lambda n: matcher.search(n.name) is not None) if matcher else None,
                 )
             ]
-        elif pattern:
+        elif name:
+            if fuzzy:
+                pattern = _to_fuzzy_search_pattern(name)
+            else:
+                pattern = _to_normal_search_pattern(name)
             node_list = await self._drive.find_nodes_by_regex(pattern)
         else:
             raise SearchFailedError("invalid query")
@@ -182,11 +578,123 @@ class SearchEngine(object):
             if size >= 0:
                 g = filter(lambda n: n.size >= size, node_list)
             else:
-                g = filter(lambda n: n.size <= size, node_list)
+                g = filter(lambda n: n.size <= -size, node_list)
             node_list = list(g)
 
+        if param.top and name:
+            terms = _to_search_terms(name, fuzzy)
+            node_list = top_k(
+                (_ for _ in node_list if not _.is_trashed),
+                param.top,
+                key=lambda _: score_name(_.name, terms),
+            )
+        elif param.top:
+            node_list = top_k(
+                (_ for _ in node_list if not _.is_trashed),
+                param.top,
+                key=lambda _: _.size,
+            )
+
         return node_list
 
+    async def _search_index(
+        self,
+        terms: list[list[str]] | None,
+        matcher: re.Pattern[str] | None,
+        parent_id: str | None,
+        size_bounds: tuple[int | None, int | None] | None,
+        top: int | None,
+    ) -> list[Node]:
+        if top and not terms:
+            id_list = self._find_largest(parent_id, size_bounds, top)
+            node_list = await gather(*(get_node(self._drive, _) for _ in id_list))
+            return [_ for _ in node_list if _]
+
+        candidates = self._index.find(terms) if terms else None
+        if size_bounds is not None:
+            candidates = self._narrow_by_size(candidates, parent_id, size_bounds)
+
+        if parent_id is None:
+            id_list = self._index.iter_all() if candidates is None else candidates
+        elif candidates is None:
+            # Nothing narrows the names down, the subtree is the smaller set.
+            id_list = self._index.iter_subtree(parent_id)
+        else:
+            id_list = self._index.filter_subtree(candidates, parent_id)
+
+        if matcher:
+            id_list = (
+                _ for _ in id_list if matcher.search(self._index.get_name(_) or "")
+            )
+
+        if top and terms:
+            ranked_terms = terms
+            # Only the best ones are fetched from the drive.
+            id_list = top_k(
+                (_ for _ in id_list if not self._index.is_trashed(_)),
+                top,
+                key=lambda _: score_name(self._index.get_name(_) or "", ranked_terms),
+            )
+
+        node_list = await gather(*(get_node(self._drive, _) for _ in id_list))
+        return [_ for _ in node_list if _]
+
+    def _find_largest(
+        self,
+        parent_id: str | None,
+        size_bounds: tuple[int | None, int | None] | None,
+        top: int,
+    ) -> list[str]:
+        lower, upper = size_bounds or (None, None)
+        ids = self._index.iter_largest(upper)
+        if lower is not None:
+            # Largest first, nothing after this one is large enough.
+            ids = itertools.takewhile(
+                lambda _: (self._index.get_size(_) or 0) >= lower, ids
+            )
+        ids = (_ for _ in ids if not self._index.is_trashed(_))
+        if parent_id is not None:
+            ids = self._index.filter_subtree(ids, parent_id)
+        return list(itertools.islice(ids, top))
+
+    async def _query(self, query: Query, parent_node: Node | None) -> list[Node]:
+        if not self._index.is_ready:
+            # Slow but still correct.
+            root = parent_node or await self._drive.get_root()
+            return [_ async for _ in _walk_node(self._drive, root, query.test_node)]
+
+        ids: Iterable[str] = query.evaluate(self._index)
+        if parent_node:
+            ids = self._index.filter_subtree(ids, parent_node.id)
+        node_list = await gather(*(get_node(self._drive, _) for _ in ids))
+        return [_ for _ in node_list if _]
+
+    def _narrow_by_size(
+        self,
+        candidates: set[str] | None,
+        parent_id: str | None,
+        size_bounds: tuple[int | None, int | None],
+    ) -> set[str] | None:
+        lower, upper = size_bounds
+
+        def in_bounds(id_: str) -> bool:
+            size = self._index.get_size(id_)
+            if size is None:
+                return False
+            return (lower is None or size >= lower) and (upper is None or size <= upper)
+
+        if candidates is None and parent_id is not None:
+            # Leave it to the subtree walk, most subtrees are small.
+            return {_ for _ in self._index.iter_subtree(parent_id) if in_bounds(_)}
+
+        # Start from whichever side is more selective.
+        count = self._index.count_by_size(lower, upper)
+        if candidates is None:
+            return set(self._index.find_by_size(lower, upper))
+        if count < len(candidates):
+            return candidates.intersection(self._index.find_by_size(lower, upper))
+        return {_ for _ in candidates if in_bounds(_)}
+
     def _update_history(self, param: SearchParam):
         if param in self._history:
             del self._history[param]
@@ -195,34 +703,137 @@ class SearchEngine(object):
         if len(self._history) > _MAX_HISTORY:
             oldest = next(iter(self._history))
             del self._history[oldest]
-            self._invalidate_cache_by_param(oldest)
+
+
+async def _load_snapshot(engine: SearchEngine, path: Path) -> None:
+    try:
+        snapshot = await to_thread(_read_json, path)
+        engine.load_snapshot(snapshot)
+    except FileNotFoundError:
+        return
+    except Exception:
+        _L.exception(f"failed to restore search snapshot {path}")
+        return
+    _L.info(f"restored search snapshot {path}")
+
+
+async def _save_snapshot(engine: SearchEngine, path: Path) -> None:
+    snapshot = engine.dump_snapshot()
+    if snapshot is None:
+        return
+    try:
+        await to_thread(_write_json, path, snapshot)
+    except Exception:
+        _L.exception(f"failed to write search snapshot {path}")
+
+
+async def _save_snapshot_periodically(engine: SearchEngine, path: Path) -> None:
+    while True:
+        await sleep(_SNAPSHOT_INTERVAL)
+        await _save_snapshot(engine, path)
+
+
+def _read_json(path: Path) -> Any:
+    with path.open("r", encoding="utf-8") as fin:
+        return json.load(fin)
+
+
+def _write_json(path: Path, data: Any) -> None:
+    # Write to a sibling and then move it, a crash never leaves half a file.
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with NamedTemporaryFile(
+        dir=path.parent,
+        prefix=f".{path.name}.",
+        suffix=".tmp",
+        delete=False,
+    ) as f:
+        tmp_path = Path(f.name)
+
+    try:
+        with tmp_path.open("w", encoding="utf-8") as fout:
+            json.dump(data, fout)
+        tmp_path.replace(path)
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+class _PathResolver:
+    """
+    Resolves node paths, memoizing every ancestor it has resolved.
+
+    Ancestors are resolved from the top down, so a query costs one drive
+    lookup per distinct ancestor instead of one path walk per hit.
+    """
+
+    def __init__(self, drive: Drive) -> None:
+        self._drive = drive
+        self._paths: dict[str, PurePath] = {}
+
+    async def __call__(self, id_: str) -> PurePath:
+        chain: list[Node] = []
+        current_id = id_
+        while current_id not in self._paths:
+            node = await self._drive.get_node_by_id(current_id)
+            if not node.parent_id:
+                self._paths[node.id] = await self._drive.resolve_path(node)
+                break
+            chain.append(node)
+            current_id = node.parent_id
+
+        for node in reversed(chain):
+            assert node.parent_id
+            parent_path = self._paths[node.parent_id]
+            if parent_path.parent == parent_path:
+                # Top level names are up to the drive, e.g. multiple sources.
+                self._paths[node.id] = await self._drive.resolve_path(node)
+            else:
+                self._paths[node.id] = parent_path / node.name
+        return self._paths[id_]
 
 
 def _to_normal_search_pattern(raw: str) -> str:
-    safe = re.escape(raw)
-    return f".*{safe}.*"
+    return f".*{_to_normal_search_body(raw)}.*"
+
+
+def _to_normal_search_body(raw: str) -> str:
+    return re.escape(raw)
 
 
 def _to_fuzzy_search_pattern(raw: str) -> str:
-    rv = re.match(r"(.+?)\s*\((.+)\)", raw)
-    if rv:
-        rv = rv.groups()
-    else:
-        rv = (raw,)
+    return f".*({_to_fuzzy_search_body(raw)}).*"
+
+
+def _to_fuzzy_search_body(raw: str) -> str:
+    rv = _to_fuzzy_search_terms(raw)
     rv = map(_inner_fuzzy_search_pattern, rv)
     rv = "|".join(rv)
-    rv = f".*({rv}).*"
     return rv
 
 
-def _inner_fuzzy_search_pattern(raw: str) -> str:
-    rv = re.split(r"(?:\s|-)+", raw)
-    rv = map(re.escape, rv)
+def _inner_fuzzy_search_pattern(tokens: list[str]) -> str:
+    rv = map(re.escape, tokens)
     rv = map(str, rv)
     rv = ".*".join(rv)
     return rv
 
 
+def _to_fuzzy_search_terms(raw: str) -> list[list[str]]:
+    rv = re.match(r"(.+?)\s*\((.+)\)", raw)
+    if rv:
+        rv = rv.groups()
+    else:
+        rv = (raw,)
+    return [re.split(r"(?:\s|-)+", _) for _ in rv]
+
+
+def _to_search_terms(raw: str, fuzzy: bool | None) -> list[list[str]]:
+    # Mirrors the patterns above, see NodeIndex.find for the shape.
+    if fuzzy:
+        return _to_fuzzy_search_terms(raw)
+    return [[raw]]
+
+
 async def _walk_node(
     drive: Drive, root: Node, fn: Callable[[Node], bool] | None
 ) -> AsyncIterator[Node]:
@@ -232,15 +843,99 @@ async def _walk_node(
                 yield f
 
 
-def _is_node_match_param(node: Node, param: SearchParam) -> bool:
-    name = param.name
-    fuzzy = param.fuzzy
+def _to_search_param(
+    name: str | None,
+    fuzzy: bool | None,
+    parent_path: str | None,
+    size: int | None,
+    query: str | None,
+    top: int | None,
+) -> SearchParam:
+    if top is not None and top <= 0:
+        raise InvalidPatternError("top must be > 0")
+    if query is None:
+        return SearchParam(
+            name=name, fuzzy=fuzzy, parent_path=parent_path, size=size, top=top
+        )
 
-    if not name:
+    if name or fuzzy is not None or size is not None or top is not None:
+        raise InvalidPatternError("query only works with parent_path")
+    try:
+        # Equivalent queries share one cache entry.
+        query = str(parse_query(query))
+    except QuerySyntaxError as e:
+        raise InvalidPatternError(str(e)) from e
+    return SearchParam(
+        name=None, fuzzy=None, parent_path=parent_path, size=None, query=query
+    )
+
+
+def _is_superset(wider: SearchParam, narrower: SearchParam) -> bool:
+    """
+    Tells if every result of narrower is also a result of wider.
+
+    Only plain substring searches qualify, a fuzzy pattern does not get
+    narrower by adding more text.
+    """
+    for param in (wider, narrower):
+        if param.fuzzy or param.query or param.top:
+            return False
+    if wider == narrower:
         return False
 
+    if wider.name:
+        if not narrower.name or wider.name.lower() not in narrower.name.lower():
+            return False
+
+    if wider.parent_path:
+        if not narrower.parent_path:
+            return False
+        if not PurePath(narrower.parent_path).is_relative_to(wider.parent_path):
+            return False
+
+    if wider.size is not None:
+        # Same direction, and at least as strict.
+        if narrower.size is None or (wider.size >= 0) != (narrower.size >= 0):
+            return False
+        if narrower.size < wider.size:
+            return False
+
+    return True
+
+
+def _to_size_bounds(size: int) -> tuple[int | None, int | None]:
+    # A positive size is a lower bound, a negative one is an upper bound.
+    if size >= 0:
+        return size, None
+    return None, -size
+
+
+def _estimate_size(nodes: list[SearchNodeDict]) -> int:
+    # Rough but stable: the list, each dict and its string values.
+    rv = sys.getsizeof(nodes)
+    for node in nodes:
+        rv += sys.getsizeof(node)
+        rv += sum(sys.getsizeof(_) for _ in node.values() if isinstance(_, str))
+    return rv
+
+
+def _parse_cursor(cursor: str) -> tuple[int, int]:
+    try:
+        generation, offset = cursor.split("-")
+        return int(generation), int(offset)
+    except ValueError:
+        raise CursorExpiredError(f"{cursor} is not a valid cursor")
+
+
+def _to_matcher(param: SearchParam) -> re.Pattern[str] | None:
+    if not param.name:
+        return None
+
+    # Finds the same names as the patterns for the drive, but without the .*
+    # around it search does not backtrack from every position of a haystack.
     pattern = (
-        _to_fuzzy_search_pattern(name) if fuzzy else _to_normal_search_pattern(name)
+        _to_fuzzy_search_body(param.name)
+        if param.fuzzy
+        else _to_normal_search_body(param.name)
     )
-    rv = re.search(pattern, node.name, re.I)
-    return rv is not None
+    return re.compile(pattern, re.I)
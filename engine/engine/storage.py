@@ -1,37 +1,165 @@
+import json
+import os
 import shutil
+import sqlite3
 import time
-from asyncio import CancelledError, create_task, sleep
-from collections.abc import Callable
-from contextlib import AsyncExitStack, asynccontextmanager
+from asyncio import CancelledError, create_task, sleep, to_thread
+from collections import Counter
+from collections.abc import Awaitable, Callable
+from contextlib import AsyncExitStack, asynccontextmanager, closing, contextmanager
+from datetime import datetime
 from logging import getLogger
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from typing import Any
 
+from .lib import json_decoder_hook
 from .types import ImageDict
 
 
+_INDEX_NAME = "manifest.sqlite"
+# Evicted folders are moved here first, then removed in the background.
+_TRASH_NAME = "trash"
+# Don't write the access time to disk more often than this.
+_TOUCH_INTERVAL = 60
 _L = getLogger(__name__)
 
 
 @asynccontextmanager
-async def create_storage_manager():
+async def create_storage_manager(
+    path: Path | None = None, *, budget: int | None = None
+):
+    """
+    Without a path, everything lives in a temporary directory.
+
+    With a path, manifests are indexed on disk as well, so extractions can be
+    reattached after a restart.
+
+    With a budget in bytes, least recently used archives are evicted to stay
+    within it.
+    """
     async with AsyncExitStack() as stack:
-        tmp = stack.enter_context(TemporaryDirectory())
-        path = Path(tmp)
-        storage = StorageManager(path)
+        if path is None:
+            tmp = stack.enter_context(TemporaryDirectory())
+            storage = StorageManager(Path(tmp), budget=budget)
+        else:
+            path.mkdir(parents=True, exist_ok=True)
+            index = stack.enter_context(closing(_open_index(path / _INDEX_NAME)))
+            storage = StorageManager(path, index, budget=budget)
+        await to_thread(storage.scan)
         await stack.enter_async_context(_watch(storage.check))
         yield storage
 
 
 class StorageManager:
-    def __init__(self, path: Path):
+    """
+    Extracted files are laid out by content, nodes with the same hash share
+    them. Nodes not bound to a hash are laid out by id.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        index: sqlite3.Connection | None = None,
+        *,
+        budget: int | None = None,
+    ):
         self._cache: dict[int, dict[str, list[ImageDict]]] = {}
         self._path = path
+        # Bytes on disk by storage key, over all sizes.
+        self._budget = budget
+        self._usage: dict[str, int] = {}
+        self._accessed: dict[str, float] = {}
+        # Storage keys being written, never evicted.
+        self._pinned = Counter[str]()
+        # Bytes admitted for writes in flight, by storage key, see reserve.
+        self._reserved = Counter[str]()
+        # Manifests of archives, kept across restarts.
+        self._index = index
+        # Node id to hash, to storage key, and back.
+        self._hashes: dict[str, str] = {}
+        self._keys: dict[str, str] = {}
+        self._ids: dict[str, set[str]] = {}
+
+    def bind(self, id_: str, hash_: str) -> None:
+        """
+        Lays the node out by its hash from now on.
+
+        Manifests cached for the node are dropped if the hash has changed.
+        """
+        old_hash = self._hashes.get(id_, None)
+        if old_hash == hash_:
+            return
+
+        key = hash_ if _is_safe_key(hash_) else id_
+        if old_hash is None and any(id_ in _ for _ in self._cache.values()):
+            # Cached before being bound, so it is laid out by id.
+            key = id_
+        if old_hash is not None:
+            self._ids[self._keys[id_]].discard(id_)
+            for manifests in self._cache.values():
+                manifests.pop(id_, None)
+        self._hashes[id_] = hash_
+        self._keys[id_] = key
+        self._ids.setdefault(key, set()).add(id_)
+
+    def get_key(self, id_: str) -> str:
+        return self._keys.get(id_, id_)
 
     def clear_cache(self):
         self._cache = {}
+        self._usage = {}
+        self._accessed = {}
         for child in self._path.iterdir():
-            shutil.rmtree(str(child))
+            if child.is_dir():
+                shutil.rmtree(str(child))
+        if self._index is not None:
+            with self._index:
+                self._index.execute("DELETE FROM manifest")
+
+    def get_indexed(self) -> list[tuple[str, str]]:
+        """Lists (node id, hash) of manifests on disk."""
+        if self._index is None:
+            return []
+        cursor = self._index.execute("SELECT DISTINCT node_id, hash FROM manifest")
+        return cursor.fetchall()
+
+    def restore(self, id_: str, hash_: str) -> None:
+        """Loads manifests of the node from disk, if they are for this hash."""
+        if self._index is None:
+            return
+        cursor = self._index.execute(
+            "SELECT max_size, manifest FROM manifest WHERE node_id = ? AND hash = ?",
+            (id_, hash_),
+        )
+        self.bind(id_, hash_)
+        for max_size, text in cursor:
+            manifest = _load_manifest(text, self._path)
+            self._cache.setdefault(max_size, {})[id_] = manifest
+
+    def drop(self, id_: str) -> None:
+        """
+        Forgets the node, in memory and on disk.
+
+        Files still used by other nodes with the same content are kept.
+        """
+        for manifests in self._cache.values():
+            manifests.pop(id_, None)
+        self._hashes.pop(id_, None)
+        key = self._keys.pop(id_, id_)
+        ids = self._ids.get(key, set())
+        ids.discard(id_)
+        if not ids:
+            self._ids.pop(key, None)
+            self._usage.pop(key, None)
+            self._accessed.pop(key, None)
+            for size_dir in self._iter_size_dirs():
+                node_dir = size_dir / key
+                if node_dir.is_dir():
+                    shutil.rmtree(str(node_dir))
+        if self._index is not None:
+            with self._index:
+                self._index.execute("DELETE FROM manifest WHERE node_id = ?", (id_,))
 
     def get_cache(self, id_: str, max_size: int = 0) -> list[ImageDict]:
         return self._cache[max_size][id_]
@@ -39,46 +167,219 @@ class StorageManager:
     def get_cache_or_none(self, id_: str, max_size: int = 0) -> list[ImageDict] | None:
         return self._cache.get(max_size, {}).get(id_, None)
 
-    def set_cache(self, id_: str, max_size: int, manifest: list[ImageDict]) -> None:
+    def get_shared_cache_or_none(
+        self, id_: str, max_size: int = 0
+    ) -> list[ImageDict] | None:
+        """Like get_cache_or_none, but also takes one of a node with the same hash."""
+        manifests = self._cache.get(max_size, {})
+        manifest = manifests.get(id_, None)
+        if manifest is not None:
+            return manifest
+        for other_id in self._ids.get(self.get_key(id_), ()):
+            manifest = manifests.get(other_id, None)
+            if manifest is not None:
+                return manifest
+        return None
+
+    def set_cache(
+        self,
+        id_: str,
+        max_size: int,
+        manifest: list[ImageDict],
+        *,
+        hash_: str | None = None,
+    ) -> None:
+        """
+        Caches the manifest, manifests of extracted archives should come with
+        the hash of the archive to be indexed on disk.
+        """
         if max_size not in self._cache:
             self._cache[max_size] = {}
         self._cache[max_size][id_] = manifest
 
+        if self._index is None or not hash_:
+            return
+        with self._index:
+            self._index.execute(
+                "INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?)",
+                (id_, max_size, hash_, _dump_manifest(manifest, self._path)),
+            )
+
     def get_path(self, id_: str, max_size: int = 0) -> Path:
-        return self._path / str(max_size) / id_
+        return self._path / str(max_size) / self.get_key(id_)
 
     def get_cache_by_max_size(self, max_size: int):
         return self._cache[max_size]
 
+    def get_usage(self) -> int:
+        """Bytes of extracted files as tracked, and of writes in flight."""
+        return sum(self._usage.values()) + self._reserved.total()
+
+    def scan(self) -> None:
+        """Takes usage and access times from disk, blocks on the file system."""
+        self._usage = {}
+        self._accessed = {}
+        shutil.rmtree(self._path / _TRASH_NAME, ignore_errors=True)
+        for size_dir in self._iter_size_dirs():
+            for node_dir in size_dir.iterdir():
+                if not node_dir.is_dir():
+                    continue
+                key = node_dir.name
+                self._usage[key] = self._usage.get(key, 0) + _get_size(node_dir)
+                accessed = node_dir.stat().st_mtime
+                self._accessed[key] = max(self._accessed.get(key, 0.0), accessed)
+
+    def touch(self, id_: str) -> None:
+        """Marks the node as used, so it is evicted last."""
+        key = self.get_key(id_)
+        now = time.time()
+        if now - self._accessed.get(key, 0.0) > _TOUCH_INTERVAL:
+            # Keeps the order across restarts, see scan.
+            try:
+                os.utime(self._path / "0" / key)
+            except FileNotFoundError:
+                pass
+        self._accessed[key] = now
+
+    def add_usage(self, id_: str, size: int) -> None:
+        """Records bytes written for the node."""
+        key = self.get_key(id_)
+        self._usage[key] = self._usage.get(key, 0) + size
+        self._accessed.setdefault(key, time.time())
+
+    async def measure(self, id_: str) -> None:
+        """Records what is on disk for the node."""
+        key = self.get_key(id_)
+        # Only the walk runs in a thread, the loop reads the records.
+        size = await to_thread(self._get_key_size, key)
+        self._usage[key] = size
+        self._accessed.setdefault(key, time.time())
+
+    @contextmanager
+    def pin(self, id_: str):
+        """Keeps the node from being evicted while it is written."""
+        key = self.get_key(id_)
+        self._pinned[key] += 1
+        try:
+            yield
+        finally:
+            self._pinned[key] -= 1
+            if self._pinned[key] <= 0:
+                del self._pinned[key]
+
+    async def make_room(self, id_: str, size: int) -> None:
+        """Evicts least recently used archives until size more bytes fit."""
+        trash = self._evict_for(id_, size)
+        if trash:
+            await to_thread(_remove_all, trash)
+
+    @asynccontextmanager
+    async def reserve(self, id_: str, size: int):
+        """
+        Makes room for size more bytes, and holds it until the block exits.
+
+        Writes admitted at the same time see each other's share. Record what
+        was written with add_usage or measure within the block.
+        """
+        key = self.get_key(id_)
+        trash = self._evict_for(id_, size)
+        self._reserved[key] += size
+        try:
+            if trash:
+                await to_thread(_remove_all, trash)
+            yield
+        finally:
+            self._reserved[key] -= size
+            if self._reserved[key] <= 0:
+                del self._reserved[key]
+
     @property
     def root_path(self) -> Path:
         return self._path
 
-    def check(self):
+    async def check(self) -> None:
         DAY = 60 * 60 * 24
         now = time.time()
-        for size_dir in self._path.iterdir():
-            if not size_dir.is_dir():
+        trash: list[Path] = []
+        for key, accessed in list(self._accessed.items()):
+            d = now - accessed
+            _L.debug(f"check {key} ({d})")
+            if d > DAY and key not in self._pinned:
+                trash.extend(self._evict(key))
+                _L.info(f"prune {key} ({d})")
+        if trash:
+            await to_thread(_remove_all, trash)
+
+    def _evict_for(self, id_: str, size: int) -> list[Path]:
+        """Evicts until size more bytes fit, returns what to remove."""
+        if self._budget is None:
+            return []
+        key = self.get_key(id_)
+        usage = self.get_usage()
+        if usage + size <= self._budget:
+            return []
+
+        candidates = sorted(
+            (
+                _
+                for _ in self._usage
+                if _ != key and _ not in self._pinned and _ not in self._reserved
+            ),
+            key=lambda _: self._accessed.get(_, 0.0),
+        )
+        trash: list[Path] = []
+        for victim in candidates:
+            if usage + size <= self._budget:
+                break
+            usage -= self._usage.get(victim, 0)
+            trash.extend(self._evict(victim))
+            _L.info(f"evict {victim} for {id_}")
+        if usage + size > self._budget:
+            _L.warning(f"storage over budget: {usage + size} > {self._budget}")
+        return trash
+
+    def _evict(self, key: str) -> list[Path]:
+        """
+        Forgets everything of the storage key and moves its folders to the
+        trash, returns what to remove.
+        """
+        self._usage.pop(key, None)
+        self._accessed.pop(key, None)
+        for id_ in self._ids.get(key, {key}):
+            for manifests in self._cache.values():
+                manifests.pop(id_, None)
+            if self._index is not None:
+                with self._index:
+                    self._index.execute(
+                        "DELETE FROM manifest WHERE node_id = ?", (id_,)
+                    )
+
+        rv: list[Path] = []
+        trash_dir = self._path / _TRASH_NAME
+        for size_dir in self._iter_size_dirs():
+            node_dir = size_dir / key
+            if not node_dir.is_dir():
                 continue
-            max_size = int(size_dir.name)
+            trash_dir.mkdir(exist_ok=True)
+            # Renaming is quick, readers never see half a folder.
+            target = trash_dir / f"{size_dir.name}-{key}-{time.time_ns()}"
+            node_dir.rename(target)
+            rv.append(target)
+        return rv
 
-            # Check each node_id subdirectory
-            for node_dir in size_dir.iterdir():
-                if not node_dir.is_dir():
-                    continue
-                node_id = node_dir.name
-                s = node_dir.stat()
-                d = now - s.st_mtime
-                _L.debug(f"check {node_dir} ({d})")
-                if d > DAY:
-                    shutil.rmtree(str(node_dir))
-                    if max_size in self._cache and node_id in self._cache[max_size]:
-                        del self._cache[max_size][node_id]
-                    _L.info(f"prune {node_dir} ({d})")
+    def _get_key_size(self, key: str) -> int:
+        return sum(
+            _get_size(_ / key) for _ in self._iter_size_dirs() if (_ / key).is_dir()
+        )
+
+    def _iter_size_dirs(self):
+        for child in self._path.iterdir():
+            if child.is_dir() and child.name.isdigit():
+                yield child
 
 
 @asynccontextmanager
-async def _watch(fn: Callable[[], None]):
+async def _watch(fn: Callable[[], Awaitable[None]]):
     task = create_task(_loop(fn))
     try:
         yield
@@ -90,7 +391,70 @@ async def _watch(fn: Callable[[], None]):
             task = None
 
 
-async def _loop(fn: Callable[[], None]):
+async def _loop(fn: Callable[[], Awaitable[None]]):
     while True:
         await sleep(60 * 60)
-        fn()
+        await fn()
+
+
+def _get_size(path: Path) -> int:
+    rv = 0
+    for dirpath, _dirnames, filenames in path.walk():
+        for filename in filenames:
+            try:
+                rv += (dirpath / filename).stat().st_size
+            except FileNotFoundError:
+                pass
+    return rv
+
+
+def _remove_all(paths: list[Path]) -> None:
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _is_safe_key(hash_: str) -> bool:
+    # Becomes a folder name.
+    return bool(hash_) and hash_ not in (".", "..") and "/" not in hash_
+
+
+def _open_index(path: Path) -> sqlite3.Connection:
+    index = sqlite3.connect(path)
+    with index:
+        index.execute(
+            """
+            CREATE TABLE IF NOT EXISTS manifest (
+                node_id TEXT NOT NULL,
+                max_size INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                manifest TEXT NOT NULL,
+                PRIMARY KEY (node_id, max_size)
+            )
+            """
+        )
+    return index
+
+
+def _dump_manifest(manifest: list[ImageDict], root: Path) -> str:
+    # Paths are relative to the root, so the root can be moved.
+    return json.dumps(
+        [
+            {
+                **item,
+                "id": Path(item["id"]).relative_to(root).as_posix(),
+                "modified_time": _encode_datetime(item["modified_time"]),
+            }
+            for item in manifest
+        ]
+    )
+
+
+def _load_manifest(text: str, root: Path) -> list[ImageDict]:
+    manifest: list[ImageDict] = json.loads(text, object_hook=json_decoder_hook)
+    for item in manifest:
+        item["id"] = str(root / item["id"])
+    return manifest
+
+
+def _encode_datetime(value: datetime) -> dict[str, Any]:
+    return {"__type__": "datetime", "__value__": value.isoformat()}
@@ -1,10 +1,12 @@
 from datetime import datetime
-from typing import TypedDict
+from typing import Any, NotRequired, TypedDict
 
 
 class ImageSizeDict(TypedDict):
     width: int
     height: int
+    # Of incomplete manifests, where positions are not final yet.
+    path: NotRequired[str]
 
 
 class VideoSizeDict(TypedDict):
@@ -38,6 +40,33 @@ class SearchNodeDict(NodeDict):
     parent_path: str
 
 
+class SearchPageDict(TypedDict):
+    items: list[SearchNodeDict]
+    next_cursor: str | None
+    total: int
+
+
+class SearchSnapshotEntryDict(TypedDict):
+    param: dict[str, Any]
+    nodes: list[SearchNodeDict]
+
+
+class SearchSnapshotDict(TypedDict):
+    version: int
+    checkpoint: float
+    history: list[dict[str, Any]]
+    cache: list[SearchSnapshotEntryDict]
+
+
+class CacheStatsDict(TypedDict):
+    budget: int
+    size: int
+    count: int
+    hits: int
+    misses: int
+    evictions: int
+
+
 class ImageDict(TypedDict):
     type: str
     width: int
@@ -46,3 +75,30 @@ class ImageDict(TypedDict):
     id: str
     etag: str
     modified_time: datetime
+
+
+class SuggestionDict(TypedDict):
+    text: str
+    # "history" for a recent search, "name" for a node name
+    kind: str
+
+
+class DuplicateGroupDict(TypedDict):
+    hash: str
+    size: int
+    # bytes taken by all but one copy
+    wasted: int
+    nodes: list[NodeDict]
+
+
+class UnpackJobDict(TypedDict):
+    id: str
+    priority: str
+    waited: float
+    running: float
+
+
+class UnpackQueueDict(TypedDict):
+    concurrency: int
+    running: list[UnpackJobDict]
+    queued: list[UnpackJobDict]
@@ -1,7 +1,10 @@
 import asyncio
+import os
 import re
-from asyncio import create_subprocess_exec
+from asyncio import Event, Task, create_subprocess_exec
 from asyncio.subprocess import PIPE
+from collections import OrderedDict
+from collections.abc import Mapping
 from concurrent.futures import ProcessPoolExecutor
 from contextlib import asynccontextmanager
 from itertools import zip_longest
@@ -9,15 +12,41 @@ from logging import getLogger
 from mimetypes import guess_type
 from pathlib import Path
 from typing import Self
+from zipfile import BadZipFile, ZipFile, ZipInfo
 
 from wcpan.drive.core.types import Drive, Node
 
-from .image import calculate_scaled_dimensions, resize_image_to
+from .archive import (
+    extract_zip_entry,
+    get_entry_path,
+    is_archive,
+    is_zip,
+    open_zip,
+    probe_zip_entry,
+)
+from .image import (
+    calculate_scaled_dimensions,
+    get_output_suffix,
+    probe_images,
+    resize_image_to,
+)
+from .lib import get_node
+from .scheduler import Priority, UnpackScheduler
 from .singleflight import SingleFlight
 from .storage import StorageManager, create_storage_manager
-from .types import ImageDict
-
-
+from .types import ImageDict, UnpackQueueDict
+
+
+# Pages per executor call, enough to amortize the round trip.
+_PROBE_BATCH_SIZE = 16
+# Pages probed at once while extracting, enough to keep the pool busy.
+_MAX_PENDING_PROBES = os.process_cpu_count() or 1
+# Entries of one archive probed at once, each reads a range from the drive.
+_MAX_ZIP_PROBES = 4
+# Central directories kept open for random access.
+_MAX_ZIP_FILES = 8
+# Archives being downloaded and extracted at once.
+_DEFAULT_CONCURRENCY = 2
 _L = getLogger(__name__)
 
 
@@ -25,11 +54,103 @@ class UnpackFailedError(Exception):
     pass
 
 
+class _Progress:
+    """
+    Manifest of an unpack in flight, published entry by entry.
+
+    Entries are published in archive order, and finish replaces them with the
+    final manifest, which is in another order. So they are looked up by id,
+    their positions are not stable.
+    """
+
+    def __init__(self) -> None:
+        self.entries: list[ImageDict] = []
+        self.complete = False
+        self._by_id: dict[str, ImageDict] = {}
+        self._error: BaseException | None = None
+        self._changed = Event()
+
+    def publish(self, item: ImageDict) -> None:
+        self.entries.append(item)
+        self._by_id[item["id"]] = item
+        self._notify()
+
+    def finish(self, manifest: list[ImageDict]) -> None:
+        self.entries = manifest
+        self._by_id = {_["id"]: _ for _ in manifest}
+        self.complete = True
+        self._notify()
+
+    def fail(self, error: BaseException) -> None:
+        self._error = error
+        self.complete = True
+        self._notify()
+
+    async def wait_for(self, index: int) -> None:
+        """
+        Waits until the entry at index is published or the unpack is over.
+
+        Raises UnpackFailedError if the unpack failed.
+        """
+        while len(self.entries) <= index and not self.complete:
+            await self._changed.wait()
+        self._raise_error()
+
+    async def wait_for_id(self, id_: str) -> ImageDict:
+        """
+        Waits until the entry of id_ is published.
+
+        Raises KeyError if the unpack is over without it, UnpackFailedError if
+        the unpack failed.
+        """
+        while id_ not in self._by_id and not self.complete:
+            await self._changed.wait()
+        self._raise_error()
+        return self._by_id[id_]
+
+    def _raise_error(self) -> None:
+        if self._error is None:
+            return
+        if isinstance(self._error, UnpackFailedError):
+            raise self._error
+        raise UnpackFailedError(str(self._error) or "unpack was canceled")
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = Event()
+
+
 @asynccontextmanager
-async def create_unpack_engine(drive: Drive, port: int, unpack_path: str):
+async def create_unpack_engine(
+    drive: Drive,
+    port: int,
+    unpack_path: str,
+    storage_path: Path | None = None,
+    *,
+    concurrency: int = _DEFAULT_CONCURRENCY,
+    prefetch: int = 0,
+    prefetch_budget: int | None = None,
+    storage_budget: int | None = None,
+):
     with ProcessPoolExecutor() as executor:
-        async with create_storage_manager() as storage:
-            yield UnpackEngine(drive, port, unpack_path, storage, executor)
+        async with create_storage_manager(
+            storage_path, budget=storage_budget
+        ) as storage:
+            engine = UnpackEngine(
+                drive,
+                port,
+                unpack_path,
+                storage,
+                executor,
+                concurrency=concurrency,
+                prefetch=prefetch,
+                prefetch_budget=prefetch_budget,
+            )
+            await engine.reattach()
+            try:
+                yield engine
+            finally:
+                await engine.aclose()
 
 
 class UnpackEngine:
@@ -39,25 +160,181 @@ class UnpackEngine:
         port: int,
         unpack_path: str,
         storage: StorageManager,
-        resize_executor: ProcessPoolExecutor,
+        executor: ProcessPoolExecutor,
+        *,
+        concurrency: int = _DEFAULT_CONCURRENCY,
+        prefetch: int = 0,
+        prefetch_budget: int | None = None,
     ) -> None:
         self._drive = drive
         self._port = port
         self._unpack_path = unpack_path
         self._singleflight = SingleFlight[tuple[str, int], list[ImageDict]]()
-        self._resize_singleflight = SingleFlight[tuple[str, int, int], Path]()
+        self._resize_singleflight = SingleFlight[
+            tuple[str, str, int, str | None], Path
+        ]()
+        self._extract_singleflight = SingleFlight[tuple[str, str], Path]()
         self._storage = storage
-        self._resize_executor = resize_executor
-
-    async def get_manifest(self, node: Node, max_size: int = 0) -> list[ImageDict]:
+        # For image work, resizing and probing. Has to be processes, MediaInfo
+        # is not thread safe.
+        self._executor = executor
+        # Local unpacks in flight, by node id.
+        self._progress: dict[str, _Progress] = {}
+        self._tasks: set[Task[list[ImageDict]]] = set()
+        # ZIP files read in place, least recently used first.
+        self._zip_files = OrderedDict[str, ZipFile]()
+        # Archives are downloaded and extracted through here.
+        self._scheduler = UnpackScheduler(concurrency)
+        # Archives to unpack ahead of the one being read, 0 to disable.
+        self._prefetch = prefetch
+        # Storage bytes above which nothing is prefetched, None for no limit.
+        self._prefetch_budget = prefetch_budget
+        self._prefetch_planner: Task[None] | None = None
+        self._prefetch_tasks: dict[str, Task[list[ImageDict]]] = {}
+
+    async def aclose(self) -> None:
+        tasks = [*self._tasks, *self._prefetch_tasks.values()]
+        if self._prefetch_planner is not None:
+            tasks.append(self._prefetch_planner)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for zip_file in self._zip_files.values():
+            zip_file.close()
+        self._zip_files.clear()
+
+    async def reattach(self) -> None:
+        """Picks up extractions on disk, unless the archive has changed."""
+        stale: list[tuple[str, str]] = []
+        restored = 0
+        for id_, hash_ in self._storage.get_indexed():
+            node = await get_node(self._drive, id_)
+            if node is None or node.hash != hash_:
+                stale.append((id_, hash_))
+            else:
+                self._storage.restore(id_, hash_)
+                restored += 1
+        # After restoring, files shared with a live node are kept.
+        for id_, hash_ in stale:
+            self._storage.bind(id_, hash_)
+            self._storage.drop(id_)
+        if restored or stale:
+            _L.info(f"reattached {restored} archives, dropped {len(stale)}")
+
+    async def get_manifest(
+        self,
+        node: Node,
+        max_size: int = 0,
+        *,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> list[ImageDict]:
         if node.is_directory:
             return await self._get_remote_manifest(node, max_size)
-        return await self._get_local_manifest(node, max_size)
+        manifest = await self._get_local_manifest(node, max_size, priority)
+        if priority == Priority.INTERACTIVE:
+            self._storage.touch(node.id)
+        return manifest
+
+    def get_queue_status(self) -> UnpackQueueDict:
+        return self._scheduler.get_status()
+
+    def prefetch(self, node: Node) -> None:
+        """
+        Unpacks the archives after node in its folder ahead of time.
+
+        Prefetches still queued for other archives are canceled, the reader
+        has moved on.
+        """
+        if self._prefetch <= 0 or node.is_directory or node.parent_id is None:
+            return
+        if self._prefetch_planner is not None:
+            self._prefetch_planner.cancel()
+        self._prefetch_planner = asyncio.create_task(self._plan_prefetch(node))
+
+    async def get_partial_manifest(
+        self, node: Node, max_size: int = 0
+    ) -> tuple[list[ImageDict], bool]:
+        """
+        Returns the manifest so far and whether it is complete.
+
+        Does not wait for the whole archive, only for the first entry. Entries
+        are in archive order until the manifest is complete, then they take
+        the same order as get_manifest. So the entries of an incomplete
+        manifest are addressed by get_entry_path, not by position.
+        """
+        if node.is_directory:
+            return await self.get_manifest(node, max_size), True
+        manifest = self._get_local_cache(node, max_size)
+        if manifest is not None:
+            return manifest, True
+
+        progress = self._start_local_unpack(node)
+        await progress.wait_for(0)
+        if progress.complete:
+            return await self.get_manifest(node, max_size), True
+        manifest = progress.entries.copy()
+        if max_size != 0:
+            manifest = self._resize_manifest(manifest, max_size)
+        return manifest, False
+
+    async def get_manifest_item(self, node: Node, image_id: int) -> ImageDict:
+        """
+        Returns one entry of the unsized manifest.
+
+        Positions are only final once the whole archive is extracted, see
+        get_manifest_entry for pages of an unpack in flight.
+
+        Raises IndexError if the manifest has no such entry.
+        """
+        manifest = await self.get_manifest(node, 0)
+        return manifest[image_id]
+
+    async def get_manifest_entry(self, node: Node, path: str) -> ImageDict:
+        """
+        Returns one entry of the unsized manifest by its path in the archive,
+        as soon as it is extracted.
+
+        Raises KeyError if the complete manifest has no such entry.
+        """
+        if node.is_directory:
+            raise KeyError(path)
+        # Binds the hash first, the entry is laid out by it.
+        manifest = self._get_local_cache(node, 0)
+        id_ = str(self._storage.get_path(node.id, 0) / path)
+        if manifest is not None:
+            for item in manifest:
+                if item["id"] == id_:
+                    return item
+            raise KeyError(path)
+
+        progress = self._start_local_unpack(node)
+        return await progress.wait_for_id(id_)
+
+    def get_entry_path(self, node: Node, data: ImageDict) -> str:
+        """Path of an archive image in the archive, see get_manifest_entry."""
+        self._storage.bind(node.id, node.hash)
+        top = self._storage.get_path(node.id, 0)
+        return Path(data["id"]).relative_to(top).as_posix()
 
     async def get_local_image_path(
-        self, node: Node, image_id: int, data: ImageDict, max_size: int
+        self,
+        node: Node,
+        data: ImageDict,
+        max_size: int,
+        type_: str | None = None,
     ) -> Path:
+        """
+        Path of the image at max_size, resized on first use.
+
+        With type_ the resized image is written in that type instead of the
+        source one, see get_output_types. Images which need no resizing are
+        returned as is.
+        """
+        self._storage.bind(node.id, node.hash)
+        self._storage.touch(node.id)
         source_path = Path(data["id"])
+        if not source_path.exists() and is_zip(node):
+            await self._extract_zip_entry(node, source_path)
         if max_size == 0:
             return source_path
 
@@ -70,22 +347,32 @@ class UnpackEngine:
         source_root = self._storage.get_path(node.id, 0)
         variant_root = self._storage.get_path(node.id, max_size)
         variant_path = variant_root / source_path.relative_to(source_root)
+        if type_ is not None:
+            # Keeps the source name, variants of a.png and a.jpg stay apart.
+            variant_path = variant_path.with_name(
+                variant_path.name + get_output_suffix(type_)
+            )
         if variant_path.exists():
             return variant_path
 
-        key = (node.id, image_id, max_size)
+        key = (self._storage.get_key(node.id), data["id"], max_size, type_)
 
         async def on_first():
             if variant_path.exists():
                 return variant_path
             loop = asyncio.get_event_loop()
-            await loop.run_in_executor(
-                self._resize_executor,
-                resize_image_to,
-                source_path,
-                variant_path,
-                max_size,
-            )
+            # Smaller than the source, which is a fine upper bound.
+            async with self._storage.reserve(node.id, data["size"]):
+                with self._storage.pin(node.id):
+                    await loop.run_in_executor(
+                        self._executor,
+                        resize_image_to,
+                        source_path,
+                        variant_path,
+                        max_size,
+                        type_,
+                    )
+                self._storage.add_usage(node.id, variant_path.stat().st_size)
             return variant_path
 
         async def on_middle():
@@ -97,26 +384,34 @@ class UnpackEngine:
             key, on_first=on_first, on_middle=on_middle
         )
 
-    async def _get_local_manifest(self, node: Node, max_size: int) -> list[ImageDict]:
-        manifest = self._storage.get_cache_or_none(node.id, max_size)
+    async def _get_local_manifest(
+        self, node: Node, max_size: int, priority: Priority
+    ) -> list[ImageDict]:
+        manifest = self._get_local_cache(node, max_size)
         if manifest is not None:
             return manifest
 
         if max_size != 0:
-            original_manifest = await self.get_manifest(node, 0)
+            original_manifest = await self.get_manifest(node, 0, priority=priority)
             manifest = self._resize_manifest(original_manifest, max_size)
-            self._storage.set_cache(node.id, max_size, manifest)
+            self._storage.set_cache(node.id, max_size, manifest, hash_=node.hash)
             return manifest
 
-        key = (node.id, 0)
+        # Nodes with the same content share one unpack.
+        key = (self._storage.get_key(node.id), 0)
+        # Someone wants it now, it may be queued as a prefetch.
+        self._scheduler.promote(node.id, priority)
 
         async def on_first():
-            result = await self._do_unpack(node)
-            self._storage.set_cache(node.id, max_size, result)
+            result = await self._do_unpack(node, priority)
+            self._storage.set_cache(node.id, max_size, result, hash_=node.hash)
             return result
 
         async def on_middle():
-            return self._storage.get_cache(node.id, max_size)
+            result = self._get_local_cache(node, max_size)
+            if result is None:
+                raise KeyError(node.id)
+            return result
 
         try:
             return await self._singleflight(key, on_first=on_first, on_middle=on_middle)
@@ -143,18 +438,30 @@ class UnpackEngine:
         except KeyError:
             raise UnpackFailedError(f"{node.id} unpack was canceled")
 
+    def _get_local_cache(self, node: Node, max_size: int) -> list[ImageDict] | None:
+        self._storage.bind(node.id, node.hash)
+        manifest = self._storage.get_shared_cache_or_none(node.id, max_size)
+        if manifest is None:
+            return None
+        if self._storage.get_cache_or_none(node.id, max_size) is None:
+            # Same content as another node, which is unpacked already.
+            self._storage.set_cache(node.id, max_size, manifest, hash_=node.hash)
+        return manifest
+
     def get_cache_by_max_size(self, max_size: int):
         return self._storage.get_cache_by_max_size(max_size)
 
     def clear_cache(self):
         self._storage.clear_cache()
 
-    async def _do_unpack(self, node: Node) -> list[ImageDict]:
+    async def _do_unpack(
+        self, node: Node, priority: Priority = Priority.INTERACTIVE
+    ) -> list[ImageDict]:
         try:
             if node.is_directory:
                 manifest = await self._unpack_remote(node)
             else:
-                manifest = await self._unpack_local(node.id)
+                manifest = await self._unpack_local(node, priority)
             return manifest
         except UnpackFailedError:
             raise
@@ -162,73 +469,330 @@ class UnpackEngine:
             _L.exception("unpack failed, abort")
             raise UnpackFailedError(str(e)) from e
 
-    async def _unpack_local(self, node_id: str) -> list[ImageDict]:
+    def _start_local_unpack(self, node: Node) -> _Progress:
+        key = self._storage.get_key(node.id)
+        progress = self._progress.get(key, None)
+        if progress is not None:
+            self._scheduler.promote(node.id, Priority.INTERACTIVE)
+            return progress
+
+        # Registered here so the caller can wait on it right away,
+        # _unpack_local picks it up.
+        progress = _Progress()
+        self._progress[key] = progress
+        task = asyncio.create_task(self.get_manifest(node, 0))
+        self._tasks.add(task)
+        task.add_done_callback(lambda _: self._on_unpack_done(key, progress, _))
+        return progress
+
+    async def _plan_prefetch(self, node: Node) -> None:
+        assert node.parent_id is not None
+        parent = await get_node(self._drive, node.parent_id)
+        if parent is None:
+            return
+        children = await self._drive.get_children(parent)
+        siblings = sorted(
+            (_ for _ in children if not _.is_directory and not _.is_trashed),
+            key=lambda _: FuzzyName(_.name),
+        )
+        index = next((i for i, _ in enumerate(siblings) if _.id == node.id), None)
+        if index is None:
+            return
+        archives = [_ for _ in siblings[index + 1 :] if is_archive(_)][: self._prefetch]
+        wanted = {_.id for _ in archives}
+
+        for id_, task in list(self._prefetch_tasks.items()):
+            if id_ in wanted:
+                continue
+            # Leave running ones alone, the work is half done.
+            if self._scheduler.get_queued_priority(id_) == Priority.PREFETCH:
+                _L.debug(f"cancel prefetch {id_}")
+                task.cancel()
+
+        usage = 0
+        if self._prefetch_budget is not None:
+            usage = self._storage.get_usage()
+        for archive in archives:
+            if archive.id in self._prefetch_tasks:
+                continue
+            if self._get_local_cache(archive, 0) is not None:
+                continue
+            if self._storage.get_key(archive.id) in self._progress:
+                continue
+            # The archive size is the best guess of what it takes extracted.
+            usage += archive.size or 0
+            if self._prefetch_budget is not None and usage > self._prefetch_budget:
+                _L.debug(f"prefetch budget reached, stop at {archive.id}")
+                break
+            _L.debug(f"prefetch {archive.id}")
+            task = asyncio.create_task(
+                self.get_manifest(archive, 0, priority=Priority.PREFETCH)
+            )
+            self._prefetch_tasks[archive.id] = task
+            task.add_done_callback(
+                lambda _, id_=archive.id: self._on_prefetch_done(id_, _)
+            )
+
+    def _on_prefetch_done(self, node_id: str, task: Task[list[ImageDict]]) -> None:
+        if self._prefetch_tasks.get(node_id, None) is task:
+            del self._prefetch_tasks[node_id]
+        # Failures are logged by _do_unpack.
+        if not task.cancelled():
+            task.exception()
+
+    def _on_unpack_done(
+        self, key: str, progress: _Progress, task: Task[list[ImageDict]]
+    ) -> None:
+        self._tasks.discard(task)
+        if not progress.complete:
+            # _unpack_local never took over, it was canceled or the manifest
+            # came from elsewhere.
+            if self._progress.get(key, None) is progress:
+                del self._progress[key]
+            if task.cancelled():
+                progress.fail(UnpackFailedError(f"{key} unpack was canceled"))
+            elif (e := task.exception()) is not None:
+                progress.fail(e)
+            else:
+                progress.finish(task.result())
+        # Waiters get failures through the progress, _do_unpack logged them.
+        if not task.cancelled():
+            task.exception()
+
+    async def _unpack_local(self, node: Node, priority: Priority) -> list[ImageDict]:
+        key = self._storage.get_key(node.id)
+        progress = self._progress.setdefault(key, _Progress())
+        try:
+            async with self._scheduler.slot(node.id, priority):
+                with self._storage.pin(node.id):
+                    manifest = None
+                    if is_zip(node):
+                        manifest = await self._index_zip(node)
+                    if manifest is None:
+                        # The archive size is the best guess before it is
+                        # extracted.
+                        async with self._storage.reserve(node.id, node.size or 0):
+                            try:
+                                manifest = await self._extract_local(node.id, progress)
+                            finally:
+                                await self._storage.measure(node.id)
+        except BaseException as e:
+            progress.fail(e)
+            raise
+        finally:
+            del self._progress[key]
+        progress.finish(manifest)
+        return manifest
+
+    async def _index_zip(self, node: Node) -> list[ImageDict] | None:
+        """
+        Lists images from the central directory, without extracting them.
+
+        Returns None if it is not a ZIP file after all.
+        """
+        try:
+            zip_file = await self._get_zip_file(node)
+        except BadZipFile:
+            _L.info(f"{node.id} is not a zip file, extract instead")
+            return None
+
+        top = self._storage.get_path(node.id, 0)
+        entries: list[tuple[Path, tuple[str, ZipInfo]]] = []
+        for info in zip_file.infolist():
+            if info.is_dir():
+                continue
+            path = get_entry_path(top, info)
+            if path is None:
+                _L.warning(f"unexpected entry path: {info.filename}")
+                continue
+            type_ = _guess_image_type(path)
+            if type_ is None:
+                continue
+            entries.append((path, (type_, info)))
+        entries = _sort_like_walk(entries, top)
+
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(_MAX_ZIP_PROBES)
+
+        async def probe(info: ZipInfo) -> tuple[int, int] | None:
+            async with slots:
+                return await asyncio.to_thread(
+                    probe_zip_entry, self._drive, node, loop, zip_file, info
+                )
+
+        probes = await asyncio.gather(
+            *(probe(info) for _path, (_type, info) in entries)
+        )
+
+        rv: list[ImageDict] = []
+        for (path, (type_, info)), probe in zip(entries, probes):
+            if probe is None:
+                continue
+            width, height = probe
+            rv.append(
+                _to_local_image(path, type_, (width, height, info.file_size), node)
+            )
+        return rv
+
+    async def _get_zip_file(self, node: Node) -> ZipFile:
+        zip_file = self._zip_files.get(node.id, None)
+        if zip_file is not None:
+            self._zip_files.move_to_end(node.id)
+            return zip_file
+
+        loop = asyncio.get_running_loop()
+        zip_file = await asyncio.to_thread(open_zip, self._drive, node, loop)
+        self._zip_files[node.id] = zip_file
+        while len(self._zip_files) > _MAX_ZIP_FILES:
+            _id, evicted = self._zip_files.popitem(last=False)
+            # Entries being read keep the file open.
+            evicted.close()
+        return zip_file
+
+    async def _extract_zip_entry(self, node: Node, path: Path) -> Path:
+        key = (self._storage.get_key(node.id), str(path))
+
+        async def on_first():
+            if path.exists():
+                return path
+            try:
+                zip_file = await self._get_zip_file(node)
+                top = self._storage.get_path(node.id, 0)
+                info = next(
+                    _ for _ in zip_file.infolist() if get_entry_path(top, _) == path
+                )
+                async with self._storage.reserve(node.id, info.file_size):
+                    with self._storage.pin(node.id):
+                        await asyncio.to_thread(extract_zip_entry, zip_file, info, path)
+                    self._storage.add_usage(node.id, info.file_size)
+            except Exception as e:
+                _L.exception(f"failed to extract {path}")
+                raise UnpackFailedError(str(e)) from e
+            return path
+
+        async def on_middle():
+            if not path.exists():
+                raise UnpackFailedError(f"{path} was not extracted")
+            return path
+
+        return await self._extract_singleflight(
+            key, on_first=on_first, on_middle=on_middle
+        )
+
+    async def _extract_local(
+        self, node_id: str, progress: _Progress
+    ) -> list[ImageDict]:
+        top = self._storage.get_path(node_id, 0)
         cmd = [
             self._unpack_path,
             _get_node_url(self._port, node_id),
-            str(self._storage.get_path(node_id, 0)),
+            str(top),
         ]
 
         _L.debug(" ".join(cmd))
 
+        parent_node = await self._drive.get_node_by_id(node_id)
         p = await create_subprocess_exec(
             *cmd,
             stdout=PIPE,
             stderr=PIPE,
         )
-        _out, err = await p.communicate()
+        assert p.stdout is not None
+        assert p.stderr is not None
+
+        async def publish(path: Path, slots: asyncio.Semaphore) -> None:
+            try:
+                item = await self._probe_local(path, top, parent_node)
+            finally:
+                slots.release()
+            if item is not None:
+                progress.publish(item)
+
+        # The helper prints the path of every entry it finishes, they are
+        # published as soon as they are probed.
+        async def publish_all(stdout: asyncio.StreamReader) -> None:
+            slots = asyncio.Semaphore(_MAX_PENDING_PROBES)
+            async with asyncio.TaskGroup() as group:
+                async for line in stdout:
+                    await slots.acquire()
+                    path = Path(os.fsdecode(line.rstrip(b"\n")))
+                    group.create_task(publish(path, slots))
+
+        try:
+            _, err = await asyncio.gather(publish_all(p.stdout), p.stderr.read())
+            await p.wait()
+        finally:
+            if p.returncode is None:
+                p.kill()
+                await p.wait()
         if p.returncode != 0:
             raise UnpackFailedError(
                 f"unpack failed code: {p.returncode}\n\n{err.decode('utf-8')}"
             )
-        return await self._scan_local(node_id)
 
-    async def _scan_local(self, node_id: str) -> list[ImageDict]:
+        # Published entries are in archive order, the final manifest is not.
+        probed = {_["id"]: _ for _ in progress.entries}
+        return await self._scan_local(node_id, probed)
+
+    async def _probe_local(
+        self, path: Path, top: Path, parent_node: Node
+    ) -> ImageDict | None:
+        if not path.is_relative_to(top):
+            _L.warning(f"unexpected entry path: {path}")
+            return None
+        type_ = _guess_image_type(path)
+        if type_ is None:
+            return None
+        loop = asyncio.get_running_loop()
+        probes = await loop.run_in_executor(self._executor, probe_images, [path])
+        if probes[0] is None:
+            return None
+        return _to_local_image(path, type_, probes[0], parent_node)
+
+    async def _scan_local(
+        self, node_id: str, probed: Mapping[str, ImageDict] | None = None
+    ) -> list[ImageDict]:
+        """
+        Lists extracted images in FuzzyName order.
+
+        Entries in probed are taken as they are, the rest are probed.
+        """
         parent_node = await self._drive.get_node_by_id(node_id)
+        if probed is None:
+            probed = {}
 
-        # First pass: collect all image files
-        files_to_process: list[tuple[Path, str]] = []
         top = self._storage.get_path(node_id, 0)
-        for dirpath, dirnames, filenames in top.walk():
-            dirnames.sort(key=FuzzyName)
-            filenames.sort(key=FuzzyName)
-            for filename in filenames:
-                path = dirpath / filename
-                type_, _encoding = guess_type(path)
-                if type_ is None:
-                    continue
-                if not type_.startswith("image/"):
-                    continue
-
-                files_to_process.append((path, type_))
-
+        files_to_process = await asyncio.to_thread(_find_images, top)
         if not files_to_process:
             return []
+        pending = [path for path, _type in files_to_process if str(path) not in probed]
 
-        results: list[tuple[int, Path, str, int, int]] = []
-        for idx, (path, type_) in enumerate(files_to_process):
-            try:
-                width, height = self._get_image_size(path)
-                results.append((idx, path, type_, width, height))
-            except Exception as e:
-                _L.exception(f"failed to process image: {e}")
-
-        # Sort by index to preserve order
-        results.sort(key=lambda x: x[0])
-
-        # Build final result list using list comprehension
-        rv: list[ImageDict] = [
-            {
-                "id": str(path),
-                "type": type_,
-                "size": path.stat().st_size,
-                "etag": parent_node.hash,
-                "modified_time": parent_node.modified_time,
-                "width": width,
-                "height": height,
-            }
-            for _idx, path, type_, width, height in results
+        # Probe in batches over the pool, gather keeps the batch order.
+        loop = asyncio.get_running_loop()
+        batches = [
+            pending[_ : _ + _PROBE_BATCH_SIZE]
+            for _ in range(0, len(pending), _PROBE_BATCH_SIZE)
         ]
+        probes = await asyncio.gather(
+            *(
+                loop.run_in_executor(self._executor, probe_images, batch)
+                for batch in batches
+            )
+        )
+        probe_by_path = dict(
+            zip(pending, (_ for batch in probes for _ in batch), strict=True)
+        )
+
+        rv: list[ImageDict] = []
+        for path, type_ in files_to_process:
+            item = probed.get(str(path), None)
+            if item is not None:
+                rv.append(item)
+                continue
+            probe = probe_by_path[path]
+            if probe is None:
+                continue
+            rv.append(_to_local_image(path, type_, probe, parent_node))
         return rv
 
     def _resize_manifest(
@@ -245,12 +809,6 @@ class UnpackEngine:
             rv.append(resized)
         return rv
 
-    def _get_image_size(self, path: Path) -> tuple[int, int]:
-        from wcpan.drive.cli.lib import get_image_info
-
-        image_info = get_image_info(path)
-        return image_info.width, image_info.height
-
     async def _unpack_remote(self, node: Node) -> list[ImageDict]:
         return await self._scan_remote(node)
 
@@ -305,5 +863,67 @@ class FuzzyName:
         return False
 
 
+def _find_images(top: Path) -> list[tuple[Path, str]]:
+    """Lists images under top with their types, in FuzzyName order."""
+    rv: list[tuple[Path, str]] = []
+    for dirpath, dirnames, filenames in top.walk():
+        dirnames.sort(key=FuzzyName)
+        filenames.sort(key=FuzzyName)
+        for filename in filenames:
+            path = dirpath / filename
+            type_ = _guess_image_type(path)
+            if type_ is None:
+                continue
+            rv.append((path, type_))
+    return rv
+
+
+def _sort_like_walk[T](
+    entries: list[tuple[Path, T]], top: Path
+) -> list[tuple[Path, T]]:
+    """Sorts paths under top in the order _find_images lists them."""
+
+    def visit(depth: int, group: list[tuple[Path, T]]) -> list[tuple[Path, T]]:
+        files: list[tuple[Path, T]] = []
+        folders: dict[str, list[tuple[Path, T]]] = {}
+        for entry in group:
+            parts = entry[0].relative_to(top).parts
+            if len(parts) == depth + 1:
+                files.append(entry)
+            else:
+                folders.setdefault(parts[depth], []).append(entry)
+        files.sort(key=lambda _: FuzzyName(_[0].name))
+        rv = files
+        for name in sorted(folders, key=FuzzyName):
+            rv.extend(visit(depth + 1, folders[name]))
+        return rv
+
+    return visit(0, entries)
+
+
+def _guess_image_type(path: Path) -> str | None:
+    type_, _encoding = guess_type(path)
+    if type_ is None:
+        return None
+    if not type_.startswith("image/"):
+        return None
+    return type_
+
+
+def _to_local_image(
+    path: Path, type_: str, probe: tuple[int, int, int], parent_node: Node
+) -> ImageDict:
+    width, height, size = probe
+    return {
+        "id": str(path),
+        "type": type_,
+        "size": size,
+        "etag": parent_node.hash,
+        "modified_time": parent_node.modified_time,
+        "width": width,
+        "height": height,
+    }
+
+
 def _get_node_url(port: int, node_id: str) -> str:
     return f"http://localhost:{port}/api/v1/nodes/{node_id}/stream"
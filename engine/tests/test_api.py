@@ -1,6 +1,6 @@
 import asyncio
 from datetime import datetime
-from pathlib import Path
+from pathlib import Path, PurePath
 from tempfile import TemporaryDirectory
 from typing import Any, cast
 from unittest import IsolatedAsyncioTestCase
@@ -22,6 +22,7 @@ class ApiTestCase(IsolatedAsyncioTestCase):
 
         static_path = self.enterContext(TemporaryDirectory())
         self.enterContext(patch("engine.main.create_drive_from_config"))
+        self.enterContext(patch("engine.search.NodeIndex.build"))
         app = await self.enterAsyncContext(
             _application_context(
                 port=9999,
@@ -29,6 +30,8 @@ class ApiTestCase(IsolatedAsyncioTestCase):
                 drive_path="fake_drive",
                 static_path=static_path,
                 token="1234",
+                search_cache_size=1024 * 1024,
+                search_snapshot_path=None,
             )
         )
         client = await self.enterAsyncContext(TestClient(TestServer(app)))
@@ -211,6 +214,94 @@ class ApiTestCase(IsolatedAsyncioTestCase):
         self.assertEqual(rv.status, 204)
         aexpect(drive.delete).assert_called_once_with(make_node({"id": "1"}))
 
+    async def testSearchWithPagination(self):
+        assert self._client.app
+
+        drive = self._client.app[KEY_DRIVE]
+        drive.find_nodes_by_regex = AsyncMock(
+            return_value=[
+                make_node({"id": str(_), "name": f"alice {_}", "parent_id": "root"})
+                for _ in range(3)
+            ]
+        )
+        drive.get_node_by_id = AsyncMock(return_value=make_node({"id": "root"}))
+        drive.resolve_path = AsyncMock(return_value=PurePath("/"))
+        headers = {
+            "Authorization": "Token 1234",
+        }
+
+        rv = await self._client.get("/api/v1/nodes?name=alice&limit=2")
+        self.assertEqual(rv.status, 401)
+        rv = await self._client.get("/api/v1/nodes?name=alice&limit=2", headers=headers)
+        self.assertEqual(rv.status, 200)
+        body = await rv.json()
+        self.assertEqual(body["total"], 3)
+        self.assertEqual([_["id"] for _ in body["items"]], ["0", "1"])
+
+        rv = await self._client.get(
+            "/api/v1/nodes",
+            params={"name": "alice", "limit": 2, "cursor": body["next_cursor"]},
+            headers=headers,
+        )
+        self.assertEqual(rv.status, 200)
+        body = await rv.json()
+        self.assertEqual([_["id"] for _ in body["items"]], ["2"])
+        self.assertIsNone(body["next_cursor"])
+        drive.find_nodes_by_regex.assert_called_once()
+
+        rv = await self._client.get(
+            "/api/v1/nodes",
+            params={"name": "alice", "limit": 2, "cursor": "0-2"},
+            headers=headers,
+        )
+        self.assertEqual(rv.status, 410)
+
+    async def testSuggest(self):
+        headers = {
+            "Authorization": "Token 1234",
+        }
+
+        rv = await self._client.get("/api/v1/suggest?q=ali")
+        self.assertEqual(rv.status, 401)
+        rv = await self._client.get("/api/v1/suggest?q=ali", headers=headers)
+        self.assertEqual(rv.status, 200)
+        self.assertEqual(await rv.json(), [])
+        rv = await self._client.get("/api/v1/suggest?q=ali&limit=0", headers=headers)
+        self.assertEqual(rv.status, 400)
+
+    async def testDuplicatesBeforeIndexReady(self):
+        rv = await self._client.get("/api/v1/duplicates")
+        self.assertEqual(rv.status, 401)
+        rv = await self._client.get(
+            "/api/v1/duplicates", headers={"Authorization": "Token 1234"}
+        )
+        self.assertEqual(rv.status, 503)
+
+    async def testUnpackQueue(self):
+        rv = await self._client.get("/api/v1/unpacks")
+        self.assertEqual(rv.status, 401)
+        rv = await self._client.get(
+            "/api/v1/unpacks", headers={"Authorization": "Token 1234"}
+        )
+        self.assertEqual(rv.status, 200)
+        self.assertEqual(
+            await rv.json(), {"concurrency": 2, "running": [], "queued": []}
+        )
+
+    async def testSearchCacheStats(self):
+        rv = await self._client.get("/api/v1/caches/searches")
+        self.assertEqual(rv.status, 401)
+        rv = await self._client.get(
+            "/api/v1/caches/searches",
+            headers={
+                "Authorization": "Token 1234",
+            },
+        )
+        self.assertEqual(rv.status, 200)
+        body = await rv.json()
+        self.assertEqual(body["budget"], 1024 * 1024)
+        self.assertEqual(body["count"], 0)
+
     async def testImageListForFolders(self):
         assert self._client.app
 
@@ -302,6 +393,7 @@ class ApiTestCase(IsolatedAsyncioTestCase):
         self.assertEqual(rv.status, 200)
         body = await rv.json()
         self.assertEqual(len(body), 0)
+        self.assertEqual(rv.headers["X-Manifest-Complete"], "true")
         fake_create_process.assert_called_once_with(
             "fake_unpack",
             "http://localhost:9999/api/v1/nodes/1/stream",
@@ -310,6 +402,16 @@ class ApiTestCase(IsolatedAsyncioTestCase):
             stderr=asyncio.subprocess.PIPE,
         )
 
+        rv = await self._client.get(
+            "/api/v1/nodes/1/images?progressive=1",
+            headers={
+                "Authorization": f"Token 1234",
+            },
+        )
+        self.assertEqual(rv.status, 200)
+        self.assertEqual(await rv.json(), [])
+        self.assertEqual(rv.headers["X-Manifest-Complete"], "true")
+
     async def testImageListForFilesWithMaxSizeReturnsScaledManifest(self):
         assert self._client.app
 
@@ -403,6 +505,56 @@ class ApiTestCase(IsolatedAsyncioTestCase):
             self.assertEqual(img.size, (1024, 576))
         self.assertIsNone(ue._storage.get_cache_or_none("1", 1024))  # type: ignore[attr-defined]
 
+    async def testImageForFileNegotiatesType(self):
+        assert self._client.app
+
+        node = make_node(
+            {
+                "id": "1",
+                "is_directory": False,
+                "hash": "etag-1",
+            }
+        )
+        drive = self._client.app[KEY_DRIVE]
+        drive.get_node_by_id = AsyncMock(return_value=node)
+
+        ue = self._client.app[KEY_UNPACK_ENGINE]
+        source_path = ue._storage.get_path("1", 0) / "page.png"  # type: ignore[attr-defined]
+        source_path.parent.mkdir(parents=True, exist_ok=True)
+        Image.new("RGB", (1920, 1080), color="red").save(source_path, format="PNG")
+        ue._storage.set_cache(  # type: ignore[attr-defined]
+            "1",
+            0,
+            [
+                {
+                    "id": str(source_path),
+                    "type": "image/png",
+                    "size": source_path.stat().st_size,
+                    "etag": "etag-1",
+                    "modified_time": datetime.fromisoformat(
+                        "1900-01-01T00:00:00+00:00"
+                    ),
+                    "width": 1920,
+                    "height": 1080,
+                }
+            ],
+        )
+        variant_root = ue._storage.get_path("1", 1024)  # type: ignore[attr-defined]
+
+        for accept, type_, name in [
+            ("image/avif,image/webp,*/*;q=0.8", "image/avif", "page.png.avif"),
+            ("image/avif;q=0,image/webp", "image/webp", "page.png.webp"),
+            ("*/*", "image/png", "page.png"),
+        ]:
+            rv = await self._client.get(
+                "/api/v1/nodes/1/images/0?max_size=1024", headers={"Accept": accept}
+            )
+            self.assertEqual(rv.status, 200)
+            self.assertEqual(rv.content_type, type_)
+            self.assertEqual(rv.headers["Vary"], "Accept")
+            with Image.open(variant_root / name) as img:
+                self.assertEqual(img.size, (1024, 576))
+
     async def testImageForFileMissingIndexReturns404(self):
         assert self._client.app
 
@@ -423,6 +575,47 @@ class ApiTestCase(IsolatedAsyncioTestCase):
 
         self.assertEqual(rv.status, 404)
 
+    async def testImageForFileByPath(self):
+        assert self._client.app
+
+        node = make_node(
+            {
+                "id": "1",
+                "is_directory": False,
+                "hash": "etag-1",
+            }
+        )
+        drive = self._client.app[KEY_DRIVE]
+        drive.get_node_by_id = AsyncMock(return_value=node)
+
+        ue = self._client.app[KEY_UNPACK_ENGINE]
+        source_path = ue._storage.get_path("1", 0) / "b" / "page.png"  # type: ignore[attr-defined]
+        source_path.parent.mkdir(parents=True, exist_ok=True)
+        Image.new("RGB", (16, 9), color="red").save(source_path, format="PNG")
+        ue._storage.set_cache(  # type: ignore[attr-defined]
+            "1",
+            0,
+            [
+                {
+                    "id": str(source_path),
+                    "type": "image/png",
+                    "size": source_path.stat().st_size,
+                    "etag": "etag-1",
+                    "modified_time": datetime.fromisoformat(
+                        "1900-01-01T00:00:00+00:00"
+                    ),
+                    "width": 16,
+                    "height": 9,
+                }
+            ],
+        )
+
+        rv = await self._client.get("/api/v1/nodes/1/entries/b/page.png")
+        self.assertEqual(rv.status, 200)
+        self.assertEqual(await rv.read(), source_path.read_bytes())
+        rv = await self._client.get("/api/v1/nodes/1/entries/b/other.png")
+        self.assertEqual(rv.status, 404)
+
     async def testCacheImageListSkipsDeletedNodes(self):
         assert self._client.app
 
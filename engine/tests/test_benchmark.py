@@ -0,0 +1,26 @@
+from unittest import IsolatedAsyncioTestCase
+
+from benchmarks.search import parse_args, run
+
+
+class SearchBenchmarkTest(IsolatedAsyncioTestCase):
+    async def testRun(self):
+        config, output = parse_args(
+            ["--nodes", "500", "--vocabulary", "50", "--rounds", "1", "--batches", "2"]
+        )
+        self.assertIsNone(output)
+
+        result = await run(config)
+        self.assertEqual(result["drive"]["nodes"], 501)
+        self.assertEqual(result["search"]["cold"]["count"], config.queries)
+        self.assertEqual(result["invalidate"]["batch"]["count"], 2)
+
+    async def testRunWithoutIndex(self):
+        config, _output = parse_args(
+            ["--nodes", "500", "--vocabulary", "50", "--rounds", "1", "--no-index"]
+        )
+        self.assertFalse(config.index)
+
+        result = await run(config)
+        self.assertNotIn("index", result)
+        self.assertEqual(result["search"]["cold"]["count"], config.queries)
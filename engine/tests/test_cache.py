@@ -0,0 +1,49 @@
+from unittest import TestCase
+
+from engine.cache import LruCache
+
+
+class LruCacheTest(TestCase):
+    def setUp(self):
+        self._cache = LruCache[str, str](10)
+
+    def testEvictLeastRecentlyUsed(self):
+        self._cache.set("a", "a", 4)
+        self._cache.set("b", "b", 4)
+        self._cache.get("a")
+        self._cache.set("c", "c", 4)
+
+        self.assertEqual(list(self._cache), ["a", "c"])
+        self.assertEqual(self._cache.get_stats()["evictions"], 1)
+        self.assertEqual(self._cache.get_stats()["size"], 8)
+
+    def testKeepOversizedNewestEntry(self):
+        self._cache.set("a", "a", 4)
+        self._cache.set("b", "b", 20)
+
+        self.assertEqual(list(self._cache), ["b"])
+
+    def testReplaceEntry(self):
+        self._cache.set("a", "a", 4)
+        self._cache.set("a", "b", 6)
+
+        self.assertEqual(self._cache.peek("a"), "b")
+        self.assertEqual(self._cache.get_stats()["size"], 6)
+
+    def testCountHitsAndMisses(self):
+        self._cache.set("a", "a", 1)
+        self._cache.get("a")
+        self._cache.get("b")
+        self._cache.peek("a")
+
+        stats = self._cache.get_stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def testDiscard(self):
+        self._cache.set("a", "a", 4)
+        self._cache.discard("a")
+        self._cache.discard("b")
+
+        self.assertNotIn("a", self._cache)
+        self.assertEqual(self._cache.get_stats()["size"], 0)
@@ -6,6 +6,7 @@ from PIL import Image
 
 from engine.image import (
     calculate_scaled_dimensions,
+    probe_images,
     resize_image_to,
 )
 
@@ -99,3 +100,71 @@ class TestResizeImage(TestCase):
             with Image.open(output_path) as img:
                 self.assertEqual(img.size, (1024, 576))
                 self.assertEqual(img.format, "PNG")
+
+    def test_resize_large_jpeg_decodes_reduced(self):
+        """JPEG is decoded at a reduced scale, never below the target."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp_path = Path(tmpdir)
+            image_path = tmp_path / "test_image.jpg"
+            output_path = tmp_path / "resized" / "test_image.jpg"
+
+            img = Image.new("RGB", (3000, 4500), color="red")
+            img.save(image_path, format="JPEG", quality=85)
+
+            with self.assertLogs("engine.image", level="INFO") as logs:
+                width, height = resize_image_to(image_path, output_path, 600)
+
+            self.assertEqual((width, height), (400, 600))
+            self.assertIn("(decoded 750x1125)", logs.output[0])
+            for stage in ("open", "decode", "resize", "save"):
+                self.assertIn(f"{stage} ", logs.output[0])
+            self.assertNotIn("reduce ", logs.output[0])
+            with Image.open(output_path) as img:
+                self.assertEqual(img.size, (400, 600))
+
+    def test_resize_keeps_mode(self):
+        """Reduction works for alpha and palette images alike."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp_path = Path(tmpdir)
+            for mode in ("RGBA", "P", "L"):
+                image_path = tmp_path / f"{mode}.png"
+                output_path = tmp_path / "resized" / f"{mode}.png"
+                Image.new(mode, (2000, 1000)).save(image_path, format="PNG")
+
+                width, height = resize_image_to(image_path, output_path, 300)
+
+                self.assertEqual((width, height), (300, 150))
+                with Image.open(output_path) as img:
+                    self.assertEqual(img.size, (300, 150))
+                    self.assertEqual(img.mode, mode)
+
+    def test_resize_to_other_type(self):
+        """Any mode can be written as WebP."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp_path = Path(tmpdir)
+            image_path = tmp_path / "test_image.png"
+            output_path = tmp_path / "resized" / "test_image.png.webp"
+            Image.new("P", (1920, 1080)).save(image_path, format="PNG")
+
+            resize_image_to(image_path, output_path, 1024, "image/webp")
+
+            with Image.open(output_path) as img:
+                self.assertEqual(img.size, (1024, 576))
+                self.assertEqual(img.format, "WEBP")
+
+
+class TestProbeImages(TestCase):
+    """Tests for batch image probing."""
+
+    def test_probe_keeps_order_and_skips_broken(self):
+        """Each path gets its own result, broken images become None."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp_path = Path(tmpdir)
+            good_path = tmp_path / "good.png"
+            bad_path = tmp_path / "bad.jpg"
+            Image.new("RGB", (30, 20), color="green").save(good_path, format="PNG")
+            bad_path.write_bytes(b"not an image")
+
+            rv = probe_images([bad_path, good_path])
+
+            self.assertEqual(rv, [None, (30, 20, good_path.stat().st_size)])
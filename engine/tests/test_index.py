@@ -0,0 +1,332 @@
+import random
+from dataclasses import replace
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import AsyncMock, NonCallableMock, patch
+
+from engine.index import NodeIndex, _PrefixTable, _SortedKeys
+
+from .test_search import create_file
+
+
+class NodeIndexTest(TestCase):
+    def setUp(self):
+        self._index = NodeIndex()
+        self._index.add(create_file("[CircleA] Alice", id="1"))
+        self._index.add(create_file("[CircleB] Bob", id="2"))
+        self._index.add(create_file("alice in wonderland", id="3"))
+
+    def testFindSingleToken(self):
+        rv = self._index.find([["alice"]])
+        self.assertEqual(set(rv), {"1", "3"})
+
+    def testFindAllTokens(self):
+        rv = self._index.find([["circlea", "alice"]])
+        self.assertEqual(set(rv), {"1"})
+
+    def testFindAlternatives(self):
+        rv = self._index.find([["circleb"], ["wonder"]])
+        self.assertEqual(set(rv), {"2", "3"})
+
+    def testFindShortTokenCanNotNarrowDown(self):
+        rv = self._index.find([["bo"]])
+        self.assertIsNone(rv)
+
+    def testFindNothing(self):
+        rv = self._index.find([["charlie"]])
+        self.assertEqual(set(rv), set())
+
+    def testReindexRenamedNode(self):
+        self._index.add(create_file("charlie", id="1", parent_id="2"))
+        self.assertEqual(set(self._index.find([["alice"]])), {"3"})
+        self.assertEqual(set(self._index.find([["charlie"]])), {"1"})
+        self.assertEqual(self._index.get_parent_id("1"), "2")
+
+    def testRemove(self):
+        self._index.remove("3")
+        self.assertEqual(set(self._index.find([["alice"]])), {"1"})
+        self.assertIsNone(self._index.get_name("3"))
+        self.assertEqual(len(self._index), 2)
+
+
+class NodeIndexPrefixTest(TestCase):
+    def setUp(self):
+        self._index = NodeIndex()
+        self._index.add(create_file("[CircleA] Alice", id="1"))
+        self._index.add(create_file("Alice-in-Wonderland", id="2"))
+        self._index.add(create_file("Bob", id="3"))
+
+    def testFindByPrefix(self):
+        self.assertEqual(list(self._index.find_by_prefix("ALI")), ["1", "2"])
+        self.assertEqual(list(self._index.find_by_prefix("wonder")), ["2"])
+        self.assertEqual(list(self._index.find_by_prefix("[circlea")), ["1"])
+        self.assertEqual(list(self._index.find_by_prefix("lice")), [])
+
+    def testRenameAndRemove(self):
+        self._index.add(create_file("Carol", id="1"))
+        self._index.remove("2")
+        self.assertEqual(list(self._index.find_by_prefix("ali")), [])
+        self.assertEqual(list(self._index.find_by_prefix("car")), ["1"])
+
+
+class NodeIndexSubtreeTest(TestCase):
+    def setUp(self):
+        self._index = NodeIndex()
+        for node in [
+            create_file("a", id="a", parent_id="root"),
+            create_file("b", id="b", parent_id="a"),
+            create_file("c", id="c", parent_id="b"),
+            create_file("d", id="d", parent_id="root"),
+            create_file("e", id="e", parent_id="d"),
+        ]:
+            self._index.add(node)
+
+    def testIterSubtree(self):
+        self.assertEqual(set(self._index.iter_subtree("a")), {"b", "c"})
+        self.assertEqual(set(self._index.iter_subtree("c")), set())
+
+    def testFilterSubtree(self):
+        rv = self._index.filter_subtree(["a", "c", "e"], "a")
+        self.assertEqual(list(rv), ["c"])
+
+    def testMoveNode(self):
+        self._index.add(create_file("b", id="b", parent_id="d"))
+        self.assertEqual(set(self._index.iter_subtree("a")), set())
+        self.assertEqual(set(self._index.iter_subtree("d")), {"b", "c", "e"})
+
+    def testRemoveNode(self):
+        self._index.remove("e")
+        self.assertEqual(set(self._index.iter_subtree("d")), set())
+
+    def testRemoveMiddleSibling(self):
+        self._index.add(create_file("f", id="f", parent_id="root"))
+        self._index.remove("d")
+        self.assertEqual(set(self._index.iter_subtree("root")), {"a", "b", "c", "f"})
+        # Children outlive a removed parent until they are moved or removed.
+        self.assertEqual(set(self._index.iter_subtree("d")), {"e"})
+        self.assertIsNone(self._index.get_name("d"))
+
+
+class NodeIndexSizeTest(TestCase):
+    def setUp(self):
+        self._index = NodeIndex()
+        for id_, size in [("a", 30), ("b", 10), ("c", 20), ("d", 20)]:
+            self._index.add(replace(create_file(id_, id=id_), size=size))
+
+    def testFindBySize(self):
+        self.assertEqual(list(self._index.find_by_size(20, None)), ["c", "d", "a"])
+        self.assertEqual(list(self._index.find_by_size(None, 20)), ["b", "c", "d"])
+        self.assertEqual(list(self._index.find_by_size(15, 25)), ["c", "d"])
+        self.assertEqual(list(self._index.find_by_size(40, None)), [])
+        self.assertEqual(self._index.count_by_size(None, None), 4)
+
+    def testIterLargest(self):
+        self.assertEqual(list(self._index.iter_largest()), ["a", "d", "c", "b"])
+        self.assertEqual(list(self._index.iter_largest(20)), ["d", "c", "b"])
+        self.assertEqual(list(self._index.iter_largest(5)), [])
+
+    def testUpdateSize(self):
+        self._index.find_by_size(None, None)
+        self._index.add(replace(create_file("b", id="b"), size=40))
+        self._index.remove("a")
+        self.assertEqual(list(self._index.find_by_size(None, None)), ["c", "d", "b"])
+        self.assertEqual(self._index.get_size("b"), 40)
+        self.assertIsNone(self._index.get_size("a"))
+
+
+class SortedKeysTest(TestCase):
+    def setUp(self):
+        # Small blocks so every operation crosses them.
+        self.enterContext(patch("engine.index._BLOCK_SIZE", 2))
+
+    def testAgreeWithSortedList(self):
+        rng = random.Random(0)
+        pairs = {(rng.randrange(10), _) for _ in range(30)}
+        keys = _SortedKeys(((n, k) for k, n in pairs), typecode="q")
+        for _ in range(200):
+            k, n = rng.randrange(10), rng.randrange(60)
+            if (k, n) in pairs:
+                pairs.discard((k, n))
+                keys.remove(k, n)
+            else:
+                pairs.add((k, n))
+                keys.add(k, n)
+
+            expected = sorted(pairs)
+            lower, upper = sorted((rng.randrange(11), rng.randrange(11)))
+            wanted = [n for k, n in expected if lower <= k < upper]
+            self.assertEqual(list(keys.iter_range(lower, upper)), wanted)
+            self.assertEqual(keys.count(lower, upper), len(wanted))
+            self.assertEqual(len(keys), len(pairs))
+        self.assertEqual(
+            list(keys.iter_reversed()), [n for _, n in reversed(sorted(pairs))]
+        )
+        self.assertEqual(
+            list(keys.iter_reversed(5)),
+            [n for k, n in reversed(sorted(pairs)) if k < 5],
+        )
+        self.assertEqual(
+            list(keys.iter_range(None, None)), [_ for __, _ in sorted(pairs)]
+        )
+
+    def testEmpty(self):
+        keys = _SortedKeys[float](typecode="d")
+        self.assertEqual(keys.count(None, None), 0)
+        keys.remove(1.0, 1)
+        keys.add(1.0, 1)
+        self.assertEqual(list(keys.iter_range(1.0, 2.0)), [1])
+
+
+class PrefixTableTest(TestCase):
+    def setUp(self):
+        # Small blocks so every operation crosses them.
+        self.enterContext(patch("engine.index._BLOCK_SIZE", 2))
+
+    def testAgreeWithSortedTails(self):
+        rng = random.Random(0)
+        words = ["a", "ab", "B", "ba", "[a"]
+        names: dict[int, str] = {}
+
+        def make_name() -> str:
+            return " ".join(rng.choices(words, k=rng.randint(1, 3)))
+
+        for number in range(20):
+            names[number] = make_name()
+        table = _PrefixTable([names[_] for _ in range(20)])
+        for _ in range(200):
+            number = rng.randrange(30)
+            table.discard(number)
+            if number in names and rng.random() < 0.5:
+                del names[number]
+            else:
+                names[number] = make_name()
+                table.add(number, names[number])
+
+            prefix = rng.choice(["", "a", "ab", "b", "[a", "a b"])
+            tails = sorted(
+                (tail, number)
+                for number, name in names.items()
+                for tail in {name.lower()}
+                | {
+                    name[_:].lower()
+                    for _ in range(len(name))
+                    if name[_].isalnum() and not name[_ - 1 : _].isalnum()
+                }
+                if tail.startswith(prefix)
+            )
+            self.assertEqual(list(table.iter_range(prefix)), [_ for __, _ in tails])
+
+
+class NodeIndexFieldTest(TestCase):
+    def setUp(self):
+        self._index = NodeIndex()
+        for id_, mime_type, day in [("a", "video/mp4", 3), ("b", "image/png", 1)]:
+            node = create_file(id_, id=id_)
+            self._index.add(
+                replace(
+                    node,
+                    mime_type=mime_type,
+                    changed_time=node.changed_time.replace(day=day),
+                )
+            )
+
+    def testFindByMimeType(self):
+        self.assertEqual(set(self._index.find_by_mime_type("video/mp4")), {"a"})
+        self._index.add(replace(create_file("a", id="a"), mime_type="video/webm"))
+        self.assertEqual(set(self._index.find_by_mime_type("video/mp4")), set())
+        self.assertEqual(
+            set(self._index.iter_mime_types()), {"video/webm", "image/png"}
+        )
+
+    def testFindByChangedTime(self):
+        a = self._index.get_changed_time("a")
+        b = self._index.get_changed_time("b")
+        assert a is not None and b is not None
+        self.assertEqual(list(self._index.find_by_changed_time(None, None)), ["b", "a"])
+        self.assertEqual(list(self._index.find_by_changed_time(b, a)), ["b"])
+        self._index.remove("b")
+        self.assertEqual(self._index.count_by_changed_time(None, None), 1)
+
+
+class NodeIndexHashTest(TestCase):
+    def setUp(self):
+        self._index = NodeIndex()
+        for id_, hash_ in [("1", "x"), ("2", "x"), ("3", "y")]:
+            node = replace(create_file(id_, id=id_), is_directory=False, hash=hash_)
+            self._index.add(node)
+
+    def testFindDuplicates(self):
+        self.assertEqual(set(self._index.iter_duplicate_hashes()), {"x"})
+        self.assertEqual(set(self._index.find_by_hash("x")), {"1", "2"})
+
+    def testUpdateHash(self):
+        self._index.add(replace(create_file("2", id="2"), is_directory=False, hash="y"))
+        self.assertEqual(set(self._index.iter_duplicate_hashes()), {"y"})
+        self._index.remove("3")
+        self.assertEqual(set(self._index.iter_duplicate_hashes()), set())
+        self.assertEqual(set(self._index.find_by_hash("x")), {"1"})
+
+    def testShrinkGroup(self):
+        self._index.add(replace(create_file("4", id="4"), is_directory=False, hash="x"))
+        self._index.remove("1")
+        self.assertEqual(set(self._index.find_by_hash("x")), {"2", "4"})
+        self._index.remove("4")
+        self.assertEqual(set(self._index.iter_duplicate_hashes()), set())
+        self.assertEqual(set(self._index.find_by_hash("x")), {"2"})
+        self.assertEqual(set(self._index.find_by_hash("z")), set())
+
+    def testIgnoreFolders(self):
+        self._index.add(replace(create_file("4", id="4"), hash="y"))
+        self.assertEqual(set(self._index.find_by_hash("y")), {"3"})
+
+
+class NodeIndexBuildTest(IsolatedAsyncioTestCase):
+    async def testBuild(self):
+        root = create_file("", id="root")
+        children = [
+            create_file("alice", id="1"),
+            create_file("bob", id="2"),
+        ]
+
+        async def fake_walk(node, *, include_trashed: bool = False):
+            yield node, children[:1], children[1:]
+
+        drive = NonCallableMock()
+        drive.get_root = AsyncMock(return_value=root)
+        drive.walk = fake_walk
+
+        index = NodeIndex()
+        self.assertFalse(index.is_ready)
+        await index.build(drive)
+        self.assertTrue(index.is_ready)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.get_name("2"), "bob")
+
+    async def testChangeWhileSorting(self):
+        root = create_file("", id="root")
+        children = [
+            replace(create_file("alice", id="1"), size=10),
+            replace(create_file("bob", id="2"), size=20),
+        ]
+
+        async def fake_walk(node, *, include_trashed: bool = False):
+            yield node, children, []
+
+        drive = NonCallableMock()
+        drive.get_root = AsyncMock(return_value=root)
+        drive.walk = fake_walk
+        index = NodeIndex()
+
+        async def fake_to_thread(fn, *args):
+            # Changes from the feed land while the thread sorts.
+            index.add(replace(children[0], size=30))
+            index.remove("2")
+            index.add(replace(create_file("carol", id="3"), size=5))
+            return fn(*args)
+
+        with patch("engine.index.to_thread", fake_to_thread):
+            await index.build(drive)
+
+        self.assertEqual(list(index.find_by_size(None, None)), ["3", "1"])
+        self.assertEqual(index.count_by_changed_time(None, None), 2)
+        self.assertEqual(list(index.find_by_prefix("bob")), [])
+        self.assertEqual(list(index.find_by_prefix("car")), ["3"])
@@ -0,0 +1,116 @@
+from dataclasses import replace
+from datetime import datetime, timezone
+from unittest import TestCase
+
+from engine.index import NodeIndex
+from engine.query import QuerySyntaxError, parse_query
+
+from .test_search import create_file
+
+
+_NOW = datetime(2026, 10, 18, tzinfo=timezone.utc)
+_G = 1024 * 1024 * 1024
+
+
+class ParseQueryTest(TestCase):
+    def testNormalize(self):
+        rv = parse_query('  alice   "bob  carol" OR -ext:.mkv ')
+        self.assertEqual(str(rv), 'name:alice name:"bob  carol" OR NOT ext:mkv')
+
+    def testPrecedence(self):
+        rv = parse_query("a OR b c")
+        self.assertEqual(str(rv), "name:a OR name:b name:c")
+        rv = parse_query("(a OR b) c")
+        self.assertEqual(str(rv), "(name:a OR name:b) name:c")
+        rv = parse_query("NOT (a b)")
+        self.assertEqual(str(rv), "NOT (name:a name:b)")
+
+    def testSize(self):
+        self.assertEqual(_size_bounds("size:>1G"), (_G + 1, None))
+        self.assertEqual(_size_bounds("size:>=1G"), (_G, None))
+        self.assertEqual(_size_bounds("size:<1k"), (None, 1023))
+        self.assertEqual(_size_bounds("size:<=1kb"), (None, 1024))
+        self.assertEqual(_size_bounds("size:1M..2M"), (1 << 20, 2 << 20))
+        self.assertEqual(_size_bounds("size:100"), (100, 100))
+
+    def testChangedTime(self):
+        october = datetime(2026, 10, 1, tzinfo=timezone.utc).timestamp()
+        november = datetime(2026, 11, 1, tzinfo=timezone.utc).timestamp()
+        self.assertEqual(_time_bounds("changed:2026-10"), (october, november))
+        self.assertEqual(_time_bounds("changed:>2026-10"), (november, None))
+        self.assertEqual(_time_bounds("changed:<2026-10"), (None, october))
+        self.assertEqual(
+            _time_bounds("changed:2026-10..2026-10-31"), (october, november)
+        )
+        week_ago = datetime(2026, 10, 11, tzinfo=timezone.utc).timestamp()
+        self.assertEqual(_time_bounds("changed:>1w"), (week_ago, None))
+
+    def testNormalizeAge(self):
+        rv = parse_query("changed:>1w", now=_NOW)
+        self.assertEqual(str(rv), "changed:2026-10-11T00:00:00+00:00..")
+        rv = parse_query("changed:2w..1w", now=_NOW)
+        self.assertEqual(
+            str(rv), "changed:2026-10-04T00:00:00+00:00..2026-10-11T00:00:00+00:00"
+        )
+        # The normalized text stands for the same period later on.
+        later = datetime(2027, 1, 1, tzinfo=timezone.utc)
+        again = parse_query(str(rv), now=later)
+        self.assertEqual((again.begin, again.end), (rv.begin, rv.end))  # type: ignore
+
+    def testSyntaxError(self):
+        for text in ["", "a AND", "(a", "a)", "size:big", "changed:yesterday", "OR"]:
+            with self.subTest(text=text), self.assertRaises(QuerySyntaxError):
+                parse_query(text)
+
+
+class EvaluateQueryTest(TestCase):
+    def setUp(self):
+        self._index = NodeIndex()
+        for id_, name, mime_type, size, changed_time in [
+            ("1", "alice.mkv", "video/x-matroska", 2 * _G, datetime(2026, 10, 2)),
+            ("2", "alice.mp4", "video/mp4", 3 * _G, datetime(2026, 9, 2)),
+            ("3", "bob.mp4", "video/mp4", 100, datetime(2026, 10, 3)),
+            ("4", "alice.jpg", "image/jpeg", 10, datetime(2026, 10, 4)),
+        ]:
+            node = replace(
+                create_file(name, id=id_),
+                mime_type=mime_type,
+                size=size,
+                changed_time=changed_time.replace(tzinfo=timezone.utc),
+            )
+            self._index.add(node)
+
+    def evaluate(self, text: str) -> set[str]:
+        query = parse_query(text, now=_NOW)
+        rv = query.evaluate(self._index)
+        # The index and the plain node test must agree.
+        for id_ in ["1", "2", "3", "4"]:
+            self.assertEqual(query.test(self._index, id_), id_ in rv)
+        return rv
+
+    def testAnd(self):
+        rv = self.evaluate("(ext:mkv OR ext:mp4) size:>1G changed:2026-10")
+        self.assertEqual(rv, {"1"})
+
+    def testOr(self):
+        self.assertEqual(self.evaluate("bob OR mime:image/jpeg"), {"3", "4"})
+
+    def testNot(self):
+        self.assertEqual(self.evaluate("alice -mime:video/*"), {"4"})
+        self.assertEqual(self.evaluate("NOT alice"), {"3"})
+
+    def testMimePrefix(self):
+        self.assertEqual(self.evaluate("mime:video/*"), {"1", "2", "3"})
+
+    def testChangedSince(self):
+        self.assertEqual(self.evaluate("changed:>=2026-10-03"), {"3", "4"})
+
+
+def _size_bounds(text: str):
+    query = parse_query(text)
+    return query.lower, query.upper  # type: ignore
+
+
+def _time_bounds(text: str):
+    query = parse_query(text, now=_NOW)
+    return query.begin, query.end  # type: ignore
@@ -0,0 +1,35 @@
+from unittest import TestCase
+
+from engine.rank import score_name, top_k
+
+
+class ScoreNameTest(TestCase):
+    def testContiguousIsBetter(self):
+        terms = [["alice", "wonder"]]
+        self.assertGreater(
+            score_name("Alice Wonderland", terms),
+            score_name("Alice in Wonderland", terms),
+        )
+
+    def testPrefixIsBetter(self):
+        terms = [["alice"]]
+        self.assertGreater(score_name("alice 1", terms), score_name("[a] alice", terms))
+        self.assertGreater(score_name("[a] alice", terms), score_name("xalice", terms))
+
+    def testCoverageIsBetter(self):
+        terms = [["alice", "bob"]]
+        self.assertGreater(score_name("alice bob", terms), score_name("alice", terms))
+        self.assertGreater(score_name("alice", terms), score_name("alice long", terms))
+
+    def testBestAlternative(self):
+        rv = score_name("bob", [["alice"], ["bob"]])
+        self.assertEqual(rv, score_name("bob", [["bob"]]))
+
+    def testNoMatch(self):
+        self.assertEqual(score_name("carol", [["alice"]]), 0.0)
+
+
+class TopKTest(TestCase):
+    def testTopK(self):
+        rv = top_k(iter([3, 1, 4, 1, 5, 9, 2, 6]), 3, key=float)
+        self.assertEqual(rv, [9, 6, 5])
@@ -0,0 +1,95 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from engine.scheduler import Priority, UnpackScheduler
+
+
+class UnpackSchedulerTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._scheduler = UnpackScheduler(1)
+        self._order: list[str] = []
+        self._release = asyncio.Event()
+
+    async def _run(self, key: str, priority: Priority) -> None:
+        async with self._scheduler.slot(key, priority):
+            self._order.append(key)
+            await self._release.wait()
+
+    async def _start(self, key: str, priority: Priority) -> asyncio.Task[None]:
+        task = asyncio.create_task(self._run(key, priority))
+        await asyncio.sleep(0)
+        return task
+
+    async def testInteractiveFirst(self):
+        tasks = [
+            await self._start("running", Priority.PREFETCH),
+            await self._start("prefetch", Priority.PREFETCH),
+            await self._start("interactive", Priority.INTERACTIVE),
+        ]
+
+        status = self._scheduler.get_status()
+        self.assertEqual([_["id"] for _ in status["running"]], ["running"])
+        self.assertEqual(
+            [(_["id"], _["priority"]) for _ in status["queued"]],
+            [("interactive", "interactive"), ("prefetch", "prefetch")],
+        )
+
+        self._release.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual(self._order, ["running", "interactive", "prefetch"])
+
+    async def testPromote(self):
+        tasks = [
+            await self._start("running", Priority.INTERACTIVE),
+            await self._start("a", Priority.INTERACTIVE),
+            await self._start("b", Priority.PREFETCH),
+            await self._start("c", Priority.INTERACTIVE),
+        ]
+        self._scheduler.promote("b", Priority.INTERACTIVE)
+
+        self._release.set()
+        await asyncio.gather(*tasks)
+        # Keeps the arrival order within a priority.
+        self.assertEqual(self._order, ["running", "a", "b", "c"])
+
+    async def testCancelQueued(self):
+        running = await self._start("running", Priority.INTERACTIVE)
+        queued = await self._start("queued", Priority.PREFETCH)
+
+        queued.cancel()
+        await asyncio.gather(queued, return_exceptions=True)
+        self.assertEqual(self._scheduler.get_status()["queued"], [])
+
+        self._release.set()
+        await running
+        self.assertEqual(self._scheduler.get_status()["running"], [])
+
+    async def testCancelQueuedWhileReleasing(self):
+        running = await self._start("running", Priority.INTERACTIVE)
+        queued = await self._start("queued", Priority.PREFETCH)
+        after = await self._start("after", Priority.PREFETCH)
+
+        # The slot is freed before the canceled waiter wakes up.
+        self._release.set()
+        queued.cancel()
+        rv = await asyncio.gather(running, queued, after, return_exceptions=True)
+
+        self.assertEqual(rv[0], None)
+        self.assertIsInstance(rv[1], asyncio.CancelledError)
+        self.assertEqual(rv[2], None)
+        self.assertEqual(self._order, ["running", "after"])
+        status = self._scheduler.get_status()
+        self.assertEqual((status["running"], status["queued"]), ([], []))
+
+    async def testConcurrency(self):
+        self._scheduler = UnpackScheduler(2)
+        tasks = [await self._start(str(_), Priority.INTERACTIVE) for _ in range(3)]
+
+        status = self._scheduler.get_status()
+        self.assertEqual(status["concurrency"], 2)
+        self.assertEqual([_["id"] for _ in status["running"]], ["0", "1"])
+        self.assertEqual([_["id"] for _ in status["queued"]], ["2"])
+
+        self._release.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual(self._order, ["0", "1", "2"])
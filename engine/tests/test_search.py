@@ -1,11 +1,20 @@
-from datetime import datetime, timezone
+import json
+from collections.abc import Collection
+from dataclasses import replace
+from datetime import datetime, timedelta, timezone
+from pathlib import PurePath
 from typing import cast
 from unittest import IsolatedAsyncioTestCase
 from unittest.mock import AsyncMock, Mock, NonCallableMock
 
 from wcpan.drive.core.types import Node
 
-from engine.search import SearchEngine, SearchParam
+from engine.search import (
+    CursorExpiredError,
+    InvalidPatternError,
+    SearchEngine,
+    SearchParam,
+)
 from engine.types import SearchNodeDict
 
 
@@ -26,6 +35,22 @@ class SearchTest(IsolatedAsyncioTestCase):
         await self._engine(name=r"alice")
         self.assertEqual(self._drive.find_nodes_by_regex.call_count, 1)
 
+    async def testInvalidateAmongManyNames(self):
+        await self._engine(name="CircleA (AuthorA)", fuzzy=True)
+        await self._engine(name="alice")
+        cache = get_internal_cache(self._engine)
+        for param in cache:
+            matcher = self._engine._cache.peek(param).matcher  # type: ignore
+            # Leading .* backtracks from every position of the haystack.
+            self.assertFalse(matcher.pattern.startswith(".*"))
+
+        names = [f"unrelated {_:05}" for _ in range(20000)]
+        self._engine.invalidate_cache_by_nodes(map(create_file, names))
+        self.assertEqual(len(cache), 2)
+        names.append("[CircleA] AuthorA 1")
+        self._engine.invalidate_cache_by_nodes(map(create_file, names))
+        self.assertEqual([_.name for _ in cache], ["alice"])
+
     async def testInvalidateCacheByNode(self):
         # given
         await self._engine(name="CircleA (AuthorA)", fuzzy=True)
@@ -49,6 +74,440 @@ class SearchTest(IsolatedAsyncioTestCase):
             in cache
         )
 
+    async def testInvalidateCacheByNodes(self):
+        # given
+        await self._engine(name="CircleA (AuthorA)", fuzzy=True)
+        await self._engine(name="CircleB (AuthorB)", fuzzy=True)
+        await self._engine(name="CircleC (AuthorC)", fuzzy=True)
+
+        # when
+        self._engine.invalidate_cache_by_nodes(
+            [
+                create_file("[CircleA] partial"),
+                create_file("AuthorC"),
+            ]
+        )
+
+        # then
+        cache = get_internal_cache(self._engine)
+        self.assertEqual(
+            [_.name for _ in cache],
+            ["CircleB (AuthorB)"],
+        )
+
+    async def testWalkUnderParentPathWithoutIndex(self):
+        folder = create_file("folder", id="folder", parent_id="root")
+        files = [
+            create_file("alice", id="1", parent_id="folder"),
+            create_file("bob", id="2", parent_id="folder"),
+        ]
+
+        async def fake_walk(node: Node):
+            yield node, [], files
+
+        self._drive.get_node_by_path = AsyncMock(return_value=folder)
+        self._drive.get_node_by_id = AsyncMock(
+            return_value=replace(folder, parent_id=None)
+        )
+        self._drive.resolve_path = AsyncMock(return_value=PurePath("/folder"))
+        self._drive.walk = fake_walk
+
+        nodes = await self._engine(name="alice", parent_path="/folder")
+        self.assertEqual([_["id"] for _ in nodes], ["1"])
+
+    async def testHistoryDoesNotEvictCache(self):
+        for i in range(20):
+            await self._engine(name=f"alice {i}")
+
+        cache = get_internal_cache(self._engine)
+        self.assertEqual(len(cache), 20)
+        self.assertEqual(len(list(self._engine.history)), 10)
+
+
+class IndexedSearchTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        root = create_file("", id="root")
+        self._files = {
+            _.id: _
+            for _ in [
+                create_file("[CircleA] Alice", id="1", parent_id="root"),
+                create_file("[CircleB] Bob", id="2", parent_id="root"),
+                create_file("Alice-in-Wonderland", id="3", parent_id="root"),
+            ]
+        }
+
+        async def fake_walk(node: Node, *, include_trashed: bool = False):
+            yield node, list(self._files.values()), []
+
+        async def fake_get_node_by_id(id: str):
+            return root if id == "root" else self._files[id]
+
+        self._drive = create_fake_drive([])
+        self._drive.get_root = AsyncMock(return_value=root)
+        self._drive.walk = fake_walk
+        self._drive.get_node_by_id = AsyncMock(wraps=fake_get_node_by_id)
+        self._drive.resolve_path = AsyncMock(return_value=PurePath("/"))
+        self._engine = SearchEngine(self._drive)
+        await self._engine.build_index()
+
+    async def testSearchWithoutScanningDrive(self):
+        nodes = await self._engine(name="alice")
+        self.assertEqual({_["id"] for _ in nodes}, {"1", "3"})
+        self._drive.find_nodes_by_regex.assert_not_called()
+
+    async def testFuzzySearch(self):
+        nodes = await self._engine(name="alice wonder", fuzzy=True)
+        self.assertEqual([_["id"] for _ in nodes], ["3"])
+
+    async def testNormalSearchIsNotFuzzy(self):
+        nodes = await self._engine(name="alice wonder")
+        self.assertEqual(nodes, [])
+
+    async def testSearchUnderParentPath(self):
+        folder = create_file("folder", id="4", parent_id="root")
+        inner = create_file("Alice Inner", id="5", parent_id="4")
+        self._engine.apply_changes([(False, folder), (False, inner)])
+        self._files.update({_.id: _ for _ in (folder, inner)})
+        self._drive.get_node_by_path = AsyncMock(return_value=folder)
+
+        nodes = await self._engine(name="alice", parent_path="/folder")
+        self.assertEqual([_["id"] for _ in nodes], ["5"])
+        nodes = await self._engine(parent_path="/folder")
+        self.assertEqual([_["id"] for _ in nodes], ["5"])
+
+    async def testSearchWithSize(self):
+        self._files["1"] = replace(self._files["1"], size=100)
+        self._files["3"] = replace(self._files["3"], size=10)
+        self._engine.apply_changes(
+            [(False, self._files["1"]), (False, self._files["3"])]
+        )
+
+        nodes = await self._engine(name="alice", size=50)
+        self.assertEqual([_["id"] for _ in nodes], ["1"])
+        nodes = await self._engine(name="alice", size=-50)
+        self.assertEqual([_["id"] for _ in nodes], ["3"])
+
+    async def testSearchBySizeOnly(self):
+        self._files["2"] = replace(self._files["2"], size=100)
+        self._engine.apply_changes([(False, self._files["2"])])
+
+        nodes = await self._engine(size=50)
+        self.assertEqual([_["id"] for _ in nodes], ["2"])
+        self._drive.find_nodes_by_regex.assert_not_called()
+
+        self._files["3"] = replace(self._files["3"], size=200)
+        self._engine.apply_changes([(False, self._files["3"])])
+        nodes = await self._engine(size=50)
+        self.assertEqual({_["id"] for _ in nodes}, {"2", "3"})
+
+    async def testSearchWithSizeUnderParentPath(self):
+        folder = create_file("folder", id="4", parent_id="root")
+        inner = replace(create_file("Alice Inner", id="5", parent_id="4"), size=10)
+        self._engine.apply_changes([(False, folder), (False, inner)])
+        self._files.update({_.id: _ for _ in (folder, inner)})
+        self._drive.get_node_by_path = AsyncMock(return_value=folder)
+
+        nodes = await self._engine(parent_path="/folder", size=5)
+        self.assertEqual([_["id"] for _ in nodes], ["5"])
+        nodes = await self._engine(parent_path="/folder", size=-5)
+        self.assertEqual(nodes, [])
+
+    async def testQuery(self):
+        self._files["3"] = replace(self._files["3"], mime_type="video/mp4")
+        self._engine.apply_changes([(False, self._files["3"])])
+
+        nodes = await self._engine(query="alice -mime:video/*")
+        self.assertEqual([_["id"] for _ in nodes], ["1"])
+        nodes = await self._engine(query="bob OR mime:video/mp4")
+        self.assertEqual({_["id"] for _ in nodes}, {"2", "3"})
+        self._drive.find_nodes_by_regex.assert_not_called()
+
+    async def testQueryIsNormalized(self):
+        await self._engine(query="alice  OR  bob")
+        await self._engine(query="alice OR name:bob")
+        cache = get_internal_cache(self._engine)
+        self.assertEqual(len(cache), 1)
+
+    async def testQueryWithoutIndex(self):
+        engine = SearchEngine(self._drive)
+        nodes = await engine(query="alice NOT wonder")
+        self.assertEqual([_["id"] for _ in nodes], ["1"])
+
+    async def testInvalidQuery(self):
+        with self.assertRaises(InvalidPatternError):
+            await self._engine(query="(alice")
+        with self.assertRaises(InvalidPatternError):
+            await self._engine(query="alice", name="bob")
+
+    async def testRankedSearch(self):
+        nodes = await self._engine(name="alice", fuzzy=True, top=1)
+        self.assertEqual([_["id"] for _ in nodes], ["3"])
+        # Others are never fetched.
+        fetched = {_.args[0] for _ in self._drive.get_node_by_id.await_args_list}
+        self.assertNotIn("1", fetched)
+
+        nodes = await self._engine(name="alice", fuzzy=True, top=5)
+        self.assertEqual([_["id"] for _ in nodes], ["3", "1"])
+
+    async def testRankedSearchSkipsTrashed(self):
+        self._files["3"] = replace(self._files["3"], is_trashed=True)
+        self._engine.apply_changes([(False, self._files["3"])])
+
+        nodes = await self._engine(name="alice", top=1)
+        self.assertEqual([_["id"] for _ in nodes], ["1"])
+
+    async def testRankedSearchWithoutIndex(self):
+        self._drive.find_nodes_by_regex = AsyncMock(
+            return_value=[self._files["1"], self._files["3"]]
+        )
+        engine = SearchEngine(self._drive)
+        nodes = await engine(name="alice", top=1)
+        self.assertEqual([_["id"] for _ in nodes], ["3"])
+
+    async def testLargest(self):
+        for id_, size in [("1", 30), ("2", 10), ("3", 20)]:
+            self._files[id_] = replace(self._files[id_], size=size)
+        self._files["3"] = replace(self._files["3"], is_trashed=True)
+        self._engine.apply_changes([(False, _) for _ in self._files.values()])
+
+        nodes = await self._engine(top=2)
+        self.assertEqual([_["id"] for _ in nodes], ["1", "2"])
+        nodes = await self._engine(size=-25, top=5)
+        self.assertEqual([_["id"] for _ in nodes], ["2"])
+        nodes = await self._engine(size=15, top=5)
+        self.assertEqual([_["id"] for _ in nodes], ["1"])
+        self._drive.find_nodes_by_regex.assert_not_called()
+
+        with self.assertRaises(InvalidPatternError):
+            await self._engine(top=0)
+
+    async def testSuggest(self):
+        await self._engine(name="Alice in")
+
+        rv = self._engine.suggest("ali", limit=10)
+        self.assertEqual(
+            rv,
+            [
+                {"text": "Alice in", "kind": "history"},
+                {"text": "[CircleA] Alice", "kind": "name"},
+                {"text": "Alice-in-Wonderland", "kind": "name"},
+            ],
+        )
+        self.assertEqual(len(self._engine.suggest("ali", limit=2)), 2)
+        self.assertEqual(len(list(self._engine.history)), 1)
+        self.assertEqual(len(get_internal_cache(self._engine)), 1)
+
+    async def testIterDuplicates(self):
+        copies = {
+            "1": ("small", 10),
+            "2": ("small", 10),
+            "3": ("large", 100),
+            "4": ("large", 100),
+            "5": ("large", 100),
+        }
+        for id_, (hash_, size) in copies.items():
+            node = create_file(f"copy {id_}", id=id_, parent_id="root")
+            node = replace(node, is_directory=False, hash=hash_, size=size)
+            self._files[id_] = node
+        self._files["5"] = replace(self._files["5"], is_trashed=True)
+        self._engine.apply_changes([(False, _) for _ in self._files.values()])
+
+        groups = [_ async for _ in self._engine.iter_duplicates()]
+        self.assertEqual([_["hash"] for _ in groups], ["large", "small"])
+        self.assertEqual([_["wasted"] for _ in groups], [100, 10])
+        self.assertEqual([_["id"] for _ in groups[0]["nodes"]], ["3", "4"])
+
+        groups = [_ async for _ in self._engine.iter_duplicates(min_size=50)]
+        self.assertEqual([_["hash"] for _ in groups], ["large"])
+
+    async def testGetPage(self):
+        page = await self._engine.get_page(name="circle", limit=1)
+        self.assertEqual(page["total"], 2)
+        self.assertEqual([_["id"] for _ in page["items"]], ["1"])
+        self.assertIsNotNone(page["next_cursor"])
+
+        page = await self._engine.get_page(
+            name="circle", cursor=page["next_cursor"], limit=1
+        )
+        self.assertEqual([_["id"] for _ in page["items"]], ["2"])
+        self.assertIsNone(page["next_cursor"])
+
+    async def testGetPageWithExpiredCursor(self):
+        page = await self._engine.get_page(name="circle", limit=1)
+        cursor = page["next_cursor"]
+        assert cursor
+        self._engine.invalidate_cache_by_node(create_file("circle"))
+        await self._engine.get_page(name="circle", limit=1)
+
+        with self.assertRaises(CursorExpiredError):
+            await self._engine.get_page(name="circle", cursor=cursor, limit=1)
+
+    async def testApplyUpdateChange(self):
+        await self._engine(name="alice")
+        node = create_file("Alice Returns", id="4", parent_id="root")
+        self._files[node.id] = node
+
+        self._engine.apply_changes([(False, node)])
+
+        nodes = await self._engine(name="alice")
+        self.assertEqual({_["id"] for _ in nodes}, {"1", "3", "4"})
+
+    async def testApplyRemoveChange(self):
+        await self._engine(name="alice")
+
+        self._engine.apply_changes([(True, "3")])
+
+        cache = get_internal_cache(self._engine)
+        self.assertEqual(len(cache), 0)
+        nodes = await self._engine(name="alice")
+        self.assertEqual([_["id"] for _ in nodes], ["1"])
+
+    async def testApplyRenameChange(self):
+        await self._engine(name="bob")
+        node = replace(self._files["2"], name="[CircleB] Charlie")
+        self._files[node.id] = node
+
+        self._engine.apply_changes([(False, node)])
+
+        nodes = await self._engine(name="bob")
+        self.assertEqual(nodes, [])
+
+    async def testRestoreSnapshot(self):
+        # given
+        await self._engine(name="alice")
+        await self._engine(name="bob")
+        snapshot = json.loads(json.dumps(self._engine.dump_snapshot()))
+        # The drive moves on after the snapshot.
+        self._files["2"] = replace(
+            self._files["2"],
+            name="[CircleB] Bobby",
+            changed_time=datetime.now(timezone.utc) + timedelta(hours=1),
+        )
+
+        # when
+        engine = SearchEngine(self._drive)
+        engine.load_snapshot(snapshot)
+
+        # then
+        cache = get_internal_cache(engine)
+        self.assertEqual([_.name for _ in engine.history], ["bob", "alice"])
+        self.assertEqual(len(cache), 2)
+        await engine.build_index()
+        self.assertEqual([_.name for _ in cache], ["alice"])
+        nodes = await engine(name="alice")
+        self.assertEqual({_["id"] for _ in nodes}, {"1", "3"})
+
+    async def testRestoreBrokenSnapshot(self):
+        await self._engine(name="alice")
+        await self._engine(name="bob")
+        snapshot = json.loads(json.dumps(self._engine.dump_snapshot()))
+        del snapshot["cache"][1]["param"]["name"]
+
+        engine = SearchEngine(self._drive)
+        with self.assertRaises(TypeError):
+            engine.load_snapshot(snapshot)
+
+        self.assertEqual(list(engine.history), [])
+        self.assertEqual(len(get_internal_cache(engine)), 0)
+        await engine.build_index()
+        nodes = await engine(name="alice")
+        self.assertEqual({_["id"] for _ in nodes}, {"1", "3"})
+
+
+class MaterializeTest(IsolatedAsyncioTestCase):
+    async def testResolveEachAncestorOnce(self):
+        # given
+        tree = {
+            _.id: _
+            for _ in [
+                create_file("", id="root", parent_id=""),
+                create_file("a", id="a", parent_id="root"),
+                create_file("b", id="b", parent_id="a"),
+                create_file("c", id="c", parent_id="a"),
+            ]
+        }
+        hits = [
+            create_file("alice 1", id="1", parent_id="b"),
+            create_file("alice 2", id="2", parent_id="b"),
+            create_file("alice 3", id="3", parent_id="c"),
+            create_file("alice 4", id="4", parent_id="a"),
+        ]
+
+        async def fake_resolve_path(node: Node):
+            return PurePath("/") if node.id == "root" else PurePath("/", node.name)
+
+        drive = create_fake_drive(hits)
+        drive.get_node_by_id = AsyncMock(side_effect=lambda _: tree[_])
+        drive.resolve_path = AsyncMock(wraps=fake_resolve_path)
+        engine = SearchEngine(drive)
+
+        # when
+        nodes = await engine(name="alice")
+
+        # then
+        self.assertEqual(
+            [(_["parent_path"], _["name"]) for _ in nodes],
+            [
+                ("/a", "alice 4"),
+                ("/a/b", "alice 1"),
+                ("/a/b", "alice 2"),
+                ("/a/c", "alice 3"),
+            ],
+        )
+        self.assertEqual(drive.get_node_by_id.call_count, len(tree))
+        self.assertEqual(drive.resolve_path.call_count, 2)
+
+
+class RefineTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tree = {
+            _.id: _
+            for _ in [
+                create_file("", id="root", parent_id=""),
+                create_file("a", id="a", parent_id="root"),
+                create_file("b", id="b", parent_id="a"),
+            ]
+        }
+        hits = [
+            replace(create_file("alice 1", id="1", parent_id="b"), size=10),
+            replace(create_file("alice 2", id="2", parent_id="a"), size=20),
+            replace(create_file("bob alice", id="3", parent_id="b"), size=30),
+        ]
+
+        async def fake_resolve_path(node: Node):
+            return PurePath("/") if node.id == "root" else PurePath("/", node.name)
+
+        self._drive = create_fake_drive(hits)
+        self._drive.get_node_by_id = AsyncMock(side_effect=lambda _: tree[_])
+        self._drive.resolve_path = AsyncMock(wraps=fake_resolve_path)
+        self._engine = SearchEngine(self._drive)
+        await self._engine(name="alice")
+
+    async def testRefineLongerName(self):
+        nodes = await self._engine(name="ALICE 1")
+        self.assertEqual([_["id"] for _ in nodes], ["1"])
+        self.assertEqual(self._drive.find_nodes_by_regex.await_count, 1)
+
+    async def testRefineNarrowerScope(self):
+        nodes = await self._engine(name="alice", parent_path="/a/b")
+        self.assertEqual([_["id"] for _ in nodes], ["1", "3"])
+        self.assertEqual(self._drive.find_nodes_by_regex.await_count, 1)
+
+    async def testRefineStricterSize(self):
+        nodes = await self._engine(name="alice", size=20)
+        self.assertEqual({_["id"] for _ in nodes}, {"2", "3"})
+        nodes = await self._engine(name="alice", size=25)
+        self.assertEqual([_["id"] for _ in nodes], ["3"])
+        self.assertEqual(self._drive.find_nodes_by_regex.await_count, 1)
+
+        # Not contained by "alice".
+        await self._engine(name="bob")
+        self.assertEqual(self._drive.find_nodes_by_regex.await_count, 2)
+
+    async def testDoNotRefineFuzzy(self):
+        await self._engine(name="alice 1", fuzzy=True)
+        self.assertEqual(self._drive.find_nodes_by_regex.await_count, 2)
+
 
 def create_fake_drive(nodes: list[SearchNodeDict]):
     drive = NonCallableMock()
@@ -56,14 +515,14 @@ def create_fake_drive(nodes: list[SearchNodeDict]):
     return drive
 
 
-def get_internal_cache(engine: SearchEngine) -> dict[SearchParam, list[SearchNodeDict]]:
+def get_internal_cache(engine: SearchEngine) -> Collection[SearchParam]:
     return engine._cache  # type: ignore
 
 
-def create_file(name: str) -> Node:
+def create_file(name: str, *, id: str = "", parent_id: str = "") -> Node:
     return Node(
-        id="",
-        parent_id="",
+        id=id,
+        parent_id=parent_id,
         name=name,
         is_directory=True,
         is_trashed=False,
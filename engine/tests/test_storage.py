@@ -0,0 +1,199 @@
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+from engine.storage import create_storage_manager
+from engine.types import ImageDict
+
+
+class PersistentStorageTest(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self._path = Path(self.enterContext(TemporaryDirectory()))
+
+    async def testRestoreAfterRestart(self):
+        async with create_storage_manager(self._path) as storage:
+            manifest = [_make_image(storage.get_path("1", 0) / "a.png")]
+            storage.set_cache("1", 0, manifest, hash_="h1")
+            storage.set_cache("1", 640, manifest, hash_="h1")
+            # Without a hash it is not worth keeping.
+            storage.set_cache("2", 0, [])
+
+        async with create_storage_manager(self._path) as storage:
+            self.assertIsNone(storage.get_cache_or_none("1", 0))
+            self.assertEqual(storage.get_indexed(), [("1", "h1")])
+            storage.restore("1", "h1")
+            self.assertEqual(storage.get_cache("1", 0), manifest)
+            self.assertEqual(storage.get_cache("1", 640), manifest)
+
+    async def testRestoreOtherHash(self):
+        async with create_storage_manager(self._path) as storage:
+            storage.set_cache("1", 0, [], hash_="h1")
+
+        async with create_storage_manager(self._path) as storage:
+            storage.restore("1", "h2")
+            self.assertIsNone(storage.get_cache_or_none("1", 0))
+
+    async def testDrop(self):
+        async with create_storage_manager(self._path) as storage:
+            path = storage.get_path("1", 0) / "a.png"
+            path.parent.mkdir(parents=True)
+            path.write_bytes(b"")
+            storage.set_cache("1", 0, [_make_image(path)], hash_="h1")
+
+            storage.drop("1")
+
+            self.assertIsNone(storage.get_cache_or_none("1", 0))
+            self.assertEqual(storage.get_indexed(), [])
+            self.assertFalse(path.parent.exists())
+
+    async def testTemporary(self):
+        async with create_storage_manager() as storage:
+            storage.set_cache("1", 0, [], hash_="h1")
+            self.assertEqual(storage.get_indexed(), [])
+
+
+class ContentAddressedTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._storage = await self.enterAsyncContext(create_storage_manager())
+
+    async def testShareByHash(self):
+        self._storage.bind("1", "h1")
+        self._storage.bind("2", "h1")
+        self.assertEqual(self._storage.get_path("1", 0), self._storage.get_path("2", 0))
+        self.assertEqual(self._storage.get_path("1", 0).name, "h1")
+
+        manifest = [_make_image(self._storage.get_path("1", 0) / "a.png")]
+        self._storage.set_cache("1", 0, manifest)
+        self.assertIsNone(self._storage.get_cache_or_none("2", 0))
+        self.assertIs(self._storage.get_shared_cache_or_none("2", 0), manifest)
+
+    async def testFallbackToId(self):
+        self.assertEqual(self._storage.get_path("1", 0).name, "1")
+        self._storage.bind("1", "")
+        self.assertEqual(self._storage.get_path("1", 0).name, "1")
+        self._storage.bind("2", "../x")
+        self.assertEqual(self._storage.get_path("2", 0).name, "2")
+
+    async def testHashChanged(self):
+        self._storage.bind("1", "h1")
+        self._storage.set_cache("1", 0, [])
+        self._storage.bind("1", "h2")
+        self.assertIsNone(self._storage.get_cache_or_none("1", 0))
+        self.assertEqual(self._storage.get_path("1", 0).name, "h2")
+
+    async def testDropKeepsSharedFiles(self):
+        self._storage.bind("1", "h1")
+        self._storage.bind("2", "h1")
+        path = self._storage.get_path("1", 0)
+        path.mkdir(parents=True)
+
+        self._storage.drop("1")
+        self.assertTrue(path.exists())
+        self._storage.drop("2")
+        self.assertFalse(path.exists())
+
+
+class BudgetTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._storage = await self.enterAsyncContext(create_storage_manager(budget=10))
+
+    def _write(self, id_: str, size: int) -> Path:
+        path = self._storage.get_path(id_, 0) / "a.png"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * size)
+        self._storage.set_cache(id_, 0, [_make_image(path)])
+        self._storage.add_usage(id_, size)
+        return path
+
+    async def testEvictLeastRecentlyUsed(self):
+        a = self._write("a", 4)
+        b = self._write("b", 4)
+        # Read a after b, b goes first.
+        with patch("engine.storage.time.time", return_value=time.time() + 1):
+            self._storage.touch("a")
+
+        await self._storage.make_room("c", 4)
+
+        self.assertTrue(a.exists())
+        self.assertFalse(b.exists())
+        self.assertIsNone(self._storage.get_cache_or_none("b", 0))
+        self.assertEqual(self._storage.get_usage(), 4)
+
+    async def testKeepPinned(self):
+        a = self._write("a", 4)
+        b = self._write("b", 4)
+        self._storage.touch("b")
+
+        with self._storage.pin("a"):
+            await self._storage.make_room("c", 4)
+
+        self.assertTrue(a.exists())
+        self.assertFalse(b.exists())
+
+    async def testReserveInFlight(self):
+        a = self._write("a", 4)
+        b = self._write("b", 4)
+        self._storage.touch("b")
+
+        async with self._storage.reserve("c", 2):
+            self.assertTrue(a.exists())
+            # Fits besides a and b, but not besides c as well.
+            async with self._storage.reserve("d", 2):
+                self.assertFalse(a.exists())
+                self.assertTrue(b.exists())
+                self.assertEqual(self._storage.get_usage(), 8)
+        self.assertEqual(self._storage.get_usage(), 4)
+
+    async def testWithinBudget(self):
+        a = self._write("a", 4)
+        await self._storage.make_room("b", 6)
+        self.assertTrue(a.exists())
+
+    async def testPruneStale(self):
+        a = self._write("a", 4)
+        b = self._write("b", 4)
+
+        # Two days later, only b was read since.
+        later = time.time() + 2 * 60 * 60 * 24
+        with patch("engine.storage.time.time", return_value=later):
+            self._storage.touch("b")
+            await self._storage.check()
+
+        self.assertFalse(a.exists())
+        self.assertTrue(b.exists())
+        self.assertEqual(self._storage.get_usage(), 4)
+
+    async def testMeasure(self):
+        path = self._storage.get_path("a", 0) / "a.png"
+        path.parent.mkdir(parents=True)
+        path.write_bytes(b"x" * 3)
+        (self._storage.get_path("a", 640) / "a.png").parent.mkdir(parents=True)
+        (self._storage.get_path("a", 640) / "a.png").write_bytes(b"x" * 2)
+
+        await self._storage.measure("a")
+        self.assertEqual(self._storage.get_usage(), 5)
+
+    async def testScanAfterRestart(self):
+        with TemporaryDirectory() as tmp:
+            async with create_storage_manager(Path(tmp)) as storage:
+                path = storage.get_path("a", 0) / "a.png"
+                path.parent.mkdir(parents=True)
+                path.write_bytes(b"x" * 3)
+
+            async with create_storage_manager(Path(tmp)) as storage:
+                self.assertEqual(storage.get_usage(), 3)
+
+
+def _make_image(path: Path) -> ImageDict:
+    return {
+        "id": str(path),
+        "type": "image/png",
+        "size": 1,
+        "etag": "h1",
+        "modified_time": datetime(2000, 1, 1, tzinfo=timezone.utc),
+        "width": 2,
+        "height": 3,
+    }
@@ -0,0 +1,395 @@
+import asyncio
+import io
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import replace
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import AsyncMock, NonCallableMock, patch
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+from PIL import Image
+from wcpan.drive.core.exceptions import NodeNotFoundError
+
+from engine.archive import probe_zip_entry
+from engine.scheduler import Priority
+from engine.storage import StorageManager
+from engine.unpack import UnpackEngine, create_unpack_engine
+
+from .test_search import create_file
+
+
+class ScanLocalTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(TemporaryDirectory())
+        self._storage = StorageManager(Path(tmp))
+        executor = self.enterContext(ProcessPoolExecutor(max_workers=2))
+        drive = NonCallableMock()
+        drive.get_node_by_id = AsyncMock(return_value=create_file("a.zip", id="1"))
+        self._engine = UnpackEngine(drive, 9999, "fake_unpack", self._storage, executor)
+
+    async def testKeepFuzzyNameOrder(self):
+        top = self._storage.get_path("1", 0)
+        (top / "b").mkdir(parents=True)
+        for i in range(40, 0, -1):
+            Image.new("RGB", (i, 10)).save(top / "b" / f"{i}.png", format="PNG")
+        Image.new("RGB", (1, 1)).save(top / "a.png", format="PNG")
+        (top / "b" / "0.jpg").write_bytes(b"broken")
+        (top / "b" / "notes.txt").write_text("not an image")
+
+        rv = await self._engine._scan_local("1")  # type: ignore
+
+        self.assertEqual(
+            [Path(_["id"]).relative_to(top).as_posix() for _ in rv],
+            ["a.png"] + [f"b/{_}.png" for _ in range(1, 41)],
+        )
+        self.assertEqual(rv[1]["width"], 1)
+        self.assertEqual(rv[-1]["width"], 40)
+
+
+class ProgressiveManifestTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = Path(self.enterContext(TemporaryDirectory()))
+        self._storage = StorageManager(tmp / "storage")
+        executor = self.enterContext(ProcessPoolExecutor(max_workers=2))
+        drive = NonCallableMock()
+        self._node = replace(create_file("a.rar", id="1"), is_directory=False)
+        drive.get_node_by_id = AsyncMock(return_value=self._node)
+
+        # Extracts 2.png, waits for the gate, then extracts 1.png.
+        source = tmp / "source"
+        source.mkdir()
+        Image.new("RGB", (2, 1)).save(source / "2.png", format="PNG")
+        Image.new("RGB", (1, 1)).save(source / "1.png", format="PNG")
+        self._gate = tmp / "gate"
+        unpack_path = tmp / "unpack"
+        unpack_path.write_text(
+            "\n".join(
+                [
+                    "#!/bin/sh",
+                    "set -e",
+                    'mkdir -p "$2"',
+                    f'cp "{source}/2.png" "$2/2.png"',
+                    'echo "$2/2.png"',
+                    f'while [ ! -e "{self._gate}" ]; do sleep 0.01; done',
+                    f'cp "{source}/1.png" "$2/1.png"',
+                    'echo "$2/1.png"',
+                ]
+            )
+        )
+        unpack_path.chmod(0o755)
+
+        self._engine = UnpackEngine(
+            drive, 9999, str(unpack_path), self._storage, executor
+        )
+        self.addAsyncCleanup(self._engine.aclose)
+
+    async def testServeBeforeComplete(self):
+        manifest, complete = await self._engine.get_partial_manifest(self._node)
+        self.assertFalse(complete)
+        self.assertEqual([Path(_["id"]).name for _ in manifest], ["2.png"])
+
+        self.assertEqual(self._engine.get_entry_path(self._node, manifest[0]), "2.png")
+        item = await self._engine.get_manifest_entry(self._node, "2.png")
+        self.assertEqual(Path(item["id"]).name, "2.png")
+        # Positions wait for the final order.
+        first = asyncio.create_task(self._engine.get_manifest_item(self._node, 0))
+
+        manifest, complete = await self._engine.get_partial_manifest(self._node, 1)
+        self.assertFalse(complete)
+        self.assertEqual(manifest[0]["width"], 1)
+        self.assertFalse(first.done())
+
+        self._gate.touch()
+        item = await self._engine.get_manifest_entry(self._node, "1.png")
+        self.assertEqual(Path(item["id"]).name, "1.png")
+        item = await first
+        self.assertEqual(Path(item["id"]).name, "1.png")
+
+        await self._engine.get_manifest(self._node)
+        manifest, complete = await self._engine.get_partial_manifest(self._node)
+        self.assertTrue(complete)
+        # Takes the final order once complete.
+        self.assertEqual([Path(_["id"]).name for _ in manifest], ["1.png", "2.png"])
+        item = await self._engine.get_manifest_item(self._node, 1)
+        self.assertEqual(Path(item["id"]).name, "2.png")
+        item = await self._engine.get_manifest_entry(self._node, "2.png")
+        self.assertEqual(Path(item["id"]).name, "2.png")
+
+    async def testMissingItem(self):
+        missing = asyncio.create_task(
+            self._engine.get_manifest_entry(self._node, "3.png")
+        )
+        await self._engine.get_partial_manifest(self._node)
+        self._gate.touch()
+        with self.assertRaises(KeyError):
+            await missing
+        with self.assertRaises(KeyError):
+            await self._engine.get_manifest_entry(self._node, "3.png")
+        with self.assertRaises(IndexError):
+            await self._engine.get_manifest_item(self._node, 2)
+
+    async def testEntryByHash(self):
+        node = replace(self._node, hash="h1")
+        self._gate.touch()
+        item = await self._engine.get_manifest_entry(node, "1.png")
+        self.assertEqual(Path(item["id"]).parent.name, "h1")
+        self.assertEqual(self._engine.get_entry_path(node, item), "1.png")
+
+    async def testShareWithFullManifest(self):
+        partial = self._engine.get_partial_manifest(self._node)
+        manifest, complete = await partial
+        self.assertFalse(complete)
+        self._gate.touch()
+        manifest = await self._engine.get_manifest(self._node)
+        self.assertEqual([Path(_["id"]).name for _ in manifest], ["1.png", "2.png"])
+
+
+class ZipTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(TemporaryDirectory())
+        self._storage = StorageManager(Path(tmp))
+        executor = self.enterContext(ProcessPoolExecutor(max_workers=2))
+
+        buffer = io.BytesIO()
+        with ZipFile(buffer, "w") as fout:
+            for name, width in [("b/10.png", 10), ("b/9.png", 9), ("a.png", 1)]:
+                page = io.BytesIO()
+                Image.new("RGB", (width, 1)).save(page, format="PNG")
+                fout.writestr(name, page.getvalue(), compress_type=ZIP_DEFLATED)
+            fout.writestr("c/big.png", _make_big_png(), compress_type=ZIP_STORED)
+            fout.writestr("notes.txt", "not an image")
+        self._data = buffer.getvalue()
+        self._read_size = 0
+
+        self._node = replace(
+            create_file("a.cbz", id="1"),
+            is_directory=False,
+            size=len(self._data),
+            hash="h1",
+        )
+        drive = NonCallableMock()
+        drive.get_node_by_id = AsyncMock(return_value=self._node)
+        drive.download_file = self._download_file
+        self._engine = UnpackEngine(drive, 9999, "fake_unpack", self._storage, executor)
+        self.addAsyncCleanup(self._engine.aclose)
+
+    @asynccontextmanager
+    async def _download_file(self, node):
+        test = self
+
+        class Readable:
+            offset = 0
+
+            async def seek(self, offset: int) -> int:
+                self.offset = offset
+                return offset
+
+            async def read(self, length: int) -> bytes:
+                chunk = test._data[self.offset : self.offset + length]
+                self.offset += len(chunk)
+                test._read_size += len(chunk)
+                return chunk
+
+        yield Readable()
+
+    async def testManifestWithoutExtraction(self):
+        manifest = await self._engine.get_manifest(self._node)
+
+        top = self._storage.get_path("1", 0)
+        self.assertEqual(
+            [Path(_["id"]).relative_to(top).as_posix() for _ in manifest],
+            ["a.png", "b/9.png", "b/10.png", "c/big.png"],
+        )
+        self.assertEqual([_["width"] for _ in manifest], [1, 9, 10, 1600])
+        self.assertEqual(manifest[3]["height"], 1200)
+        self.assertFalse(top.exists())
+        self.assertLess(self._read_size, len(self._data) // 2)
+
+    async def testBoundProbes(self):
+        running = 0
+        peak = 0
+        lock = threading.Lock()
+
+        def probe(*args):
+            nonlocal running, peak
+            with lock:
+                running += 1
+                peak = max(peak, running)
+            try:
+                time.sleep(0.01)
+                return probe_zip_entry(*args)
+            finally:
+                with lock:
+                    running -= 1
+
+        with (
+            patch("engine.unpack._MAX_ZIP_PROBES", 2),
+            patch("engine.unpack.probe_zip_entry", probe),
+        ):
+            manifest = await self._engine.get_manifest(self._node)
+
+        self.assertEqual(len(manifest), 4)
+        self.assertEqual(peak, 2)
+
+    async def testExtractRequestedEntry(self):
+        manifest = await self._engine.get_manifest(self._node)
+
+        path = await self._engine.get_local_image_path(self._node, manifest[2], 0)
+        with Image.open(path) as image:
+            self.assertEqual(image.size, (10, 1))
+        top = self._storage.get_path("1", 0)
+        self.assertEqual(sorted(_.name for _ in top.rglob("*")), ["10.png", "b"])
+
+    async def testShareSameContent(self):
+        manifest = await self._engine.get_manifest(self._node)
+        await self._engine.get_local_image_path(self._node, manifest[0], 0)
+        read_size = self._read_size
+
+        copy = replace(self._node, id="2", name="b.cbz")
+        self.assertEqual(await self._engine.get_manifest(copy), manifest)
+        path = await self._engine.get_local_image_path(copy, manifest[0], 0)
+        self.assertEqual(path, Path(manifest[0]["id"]))
+        self.assertEqual(self._read_size, read_size)
+
+
+def _make_big_png() -> bytes:
+    # Incompressible pixels, so the page is much larger than its header.
+    image = Image.frombytes("RGB", (1600, 1200), os.urandom(1600 * 1200 * 3))
+    page = io.BytesIO()
+    image.save(page, format="PNG", compress_level=0)
+    return page.getvalue()
+
+
+class ReattachTest(IsolatedAsyncioTestCase):
+    async def testDropChangedArchives(self):
+        tmp = Path(self.enterContext(TemporaryDirectory()))
+        nodes = {
+            "1": replace(create_file("a.rar", id="1"), hash="h1"),
+            "2": replace(create_file("b.rar", id="2"), hash="h2"),
+        }
+
+        async def get_node_by_id(id_: str):
+            if id_ not in nodes:
+                raise NodeNotFoundError(id_)
+            return nodes[id_]
+
+        drive = NonCallableMock()
+        drive.get_node_by_id = AsyncMock(wraps=get_node_by_id)
+
+        async with create_unpack_engine(drive, 9999, "fake_unpack", tmp) as engine:
+            storage = engine._storage  # type: ignore
+            storage.set_cache("1", 0, [], hash_="h1")
+            storage.set_cache("2", 0, [], hash_="h2")
+            storage.set_cache("3", 0, [], hash_="h3")
+            storage.bind("2", "h2")
+            storage.get_path("2", 0).mkdir(parents=True)
+
+        nodes["2"] = replace(nodes["2"], hash="h2.1")
+        async with create_unpack_engine(drive, 9999, "fake_unpack", tmp) as engine:
+            storage = engine._storage  # type: ignore
+            self.assertEqual(storage.get_cache_or_none("1", 0), [])
+            self.assertIsNone(storage.get_cache_or_none("2", 0))
+            self.assertFalse((storage.root_path / "0" / "h2").exists())
+            self.assertEqual(storage.get_indexed(), [("1", "h1")])
+
+
+class PrefetchTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(TemporaryDirectory())
+        self._storage = StorageManager(Path(tmp))
+        executor = self.enterContext(ProcessPoolExecutor(max_workers=1))
+
+        self._parent = create_file("comic", id="0")
+        self._children = [
+            _make_archive(name, id_)
+            for name, id_ in [("v1.zip", "1"), ("v10.zip", "10"), ("v3.zip", "3")]
+        ] + [
+            _make_archive("v2.zip", "2"),
+            _make_archive("v2.nfo", "n"),
+            replace(_make_archive("cover.jpg", "c"), is_image=True),
+            create_file("v4", id="4", parent_id="0"),
+        ]
+        drive = NonCallableMock()
+        drive.get_node_by_id = AsyncMock(return_value=self._parent)
+        drive.get_children = AsyncMock(return_value=self._children)
+        self._drive = drive
+        self._executor = executor
+
+    def _create_engine(self, **kwargs) -> UnpackEngine:
+        engine = UnpackEngine(
+            self._drive,
+            9999,
+            "fake_unpack",
+            self._storage,
+            self._executor,
+            concurrency=1,
+            **kwargs,
+        )
+        self.addAsyncCleanup(engine.aclose)
+
+        # Stands in for unpacking, blocks until released.
+        self._release = asyncio.Event()
+        self._started: list[tuple[str, Priority]] = []
+
+        async def get_manifest(node, max_size=0, *, priority=Priority.INTERACTIVE):
+            self._started.append((node.id, priority))
+            async with engine._scheduler.slot(node.id, priority):  # type: ignore
+                await self._release.wait()
+            return []
+
+        engine.get_manifest = get_manifest  # type: ignore
+        return engine
+
+    async def _prefetch(self, engine: UnpackEngine, id_: str) -> None:
+        engine.prefetch(next(_ for _ in self._children if _.id == id_))
+        assert engine._prefetch_planner  # type: ignore
+        await engine._prefetch_planner  # type: ignore
+        await asyncio.sleep(0)
+
+    async def testNextInFuzzyNameOrder(self):
+        engine = self._create_engine(prefetch=2)
+        await self._prefetch(engine, "1")
+
+        self.assertEqual(
+            self._started, [("2", Priority.PREFETCH), ("3", Priority.PREFETCH)]
+        )
+        self._release.set()
+
+    async def testCancelQueuedWhenMoved(self):
+        engine = self._create_engine(prefetch=1)
+        await self._prefetch(engine, "1")
+        await self._prefetch(engine, "2")
+        # 2 was running, so it stays.
+        self.assertEqual(
+            self._started, [("2", Priority.PREFETCH), ("3", Priority.PREFETCH)]
+        )
+
+        await self._prefetch(engine, "10")
+        self.assertEqual(self._started[-1], ("3", Priority.PREFETCH))
+        status = engine.get_queue_status()
+        self.assertEqual([_["id"] for _ in status["running"]], ["2"])
+        self.assertEqual(status["queued"], [])
+        self._release.set()
+
+    async def testBudget(self):
+        engine = self._create_engine(prefetch=2, prefetch_budget=150)
+        await self._prefetch(engine, "1")
+
+        self.assertEqual(self._started, [("2", Priority.PREFETCH)])
+        self._release.set()
+
+    async def testDisabled(self):
+        engine = self._create_engine()
+        engine.prefetch(self._children[0])
+        self.assertIsNone(engine._prefetch_planner)  # type: ignore
+
+
+def _make_archive(name: str, id_: str):
+    return replace(
+        create_file(name, id=id_, parent_id="0"), is_directory=False, size=100
+    )
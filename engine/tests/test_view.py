@@ -14,6 +14,7 @@ class ViewTestCase(IsolatedAsyncioTestCase):
 
         static_path = self.enterContext(TemporaryDirectory())
         self.enterContext(patch("engine.main.create_drive_from_config"))
+        self.enterContext(patch("engine.search.NodeIndex.build"))
         app = await self.enterAsyncContext(
             _application_context(
                 port=9999,
@@ -21,6 +22,8 @@ class ViewTestCase(IsolatedAsyncioTestCase):
                 drive_path="drive_path",
                 static_path=static_path,
                 token="1234",
+                search_cache_size=1024 * 1024,
+                search_snapshot_path=None,
             )
         )
         client = await self.enterAsyncContext(TestClient(TestServer(app)))
@@ -4,6 +4,7 @@
 #include <archive_entry.h>
 
 #include <cerrno>
+#include <iostream>
 #include <memory>
 
 #include "unpack.hxx"
@@ -119,7 +120,7 @@ unpack_to(unpack::archive_context& context)
       continue;
     }
 
-    context.update_entry_path(entry);
+    auto entry_path = context.update_entry_path(entry);
 
     rv = archive_write_header(writer.get(), entry);
     if (rv != ARCHIVE_OK) {
@@ -132,6 +133,13 @@ unpack_to(unpack::archive_context& context)
     if (rv != ARCHIVE_OK) {
       throw archive_error(writer.get(), "archive_write_finish_entry");
     }
+
+    // report finished entries one per line, so the caller can serve them
+    // before the whole archive is extracted, the caller finds the others
+    // when it is done
+    if (entry_path.find('\n') == std::string::npos) {
+      std::cout << entry_path << std::endl;
+    }
   }
 }
 
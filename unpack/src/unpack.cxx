@@ -72,7 +72,7 @@ unpack::archive_context::archive_context(const std::string& archive_uri,
 {
 }
 
-void
+std::string
 unpack::archive_context::update_entry_path(archive_entry* entry)
 {
   auto entry_name = archive_entry_pathname(entry);
@@ -85,6 +85,7 @@ unpack::archive_context::update_entry_path(archive_entry* entry)
   if (!rv) {
     throw std::runtime_error(std::format("utf-8 failure: {}", entry_path));
   }
+  return entry_path;
 }
 
 std::string
@@ -39,7 +39,7 @@ public:
   archive_context(archive_context&&) = delete;
   archive_context& operator=(archive_context&&) = delete;
 
-  void update_entry_path(archive_entry* entry);
+  std::string update_entry_path(archive_entry* entry);
 
 private:
   std::string to_output_path(const std::string& entry_name);